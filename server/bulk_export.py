@@ -0,0 +1,86 @@
+import io
+import json
+import os
+import tarfile
+import time
+import zipfile
+from typing import Iterable, Iterator, List
+
+from server.utils import get_file_source
+
+# формат -> (media type, расширение файла)
+BULK_FORMATS = {
+    "zip": ("application/zip", "zip"),
+    "tar": ("application/gzip", "tar.gz"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+}
+
+
+class _ChunkWriter(io.RawIOBase):
+    '''
+    Поток без seek, из которого архив забирается кусками по мере записи
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def config_name(cfg_file: str) -> str:
+    '''
+    Имя конфига в архиве - по имени папки клиента
+    '''
+    return f"{os.path.basename(os.path.dirname(cfg_file))}.conf"
+
+
+def iter_zip(cfg_files: Iterable[str]) -> Iterator[bytes]:
+    writer = _ChunkWriter()
+    with zipfile.ZipFile(writer, "w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+        for cfg_file in cfg_files:
+            zip_file.writestr(config_name(cfg_file), get_file_source(cfg_file) + "\n")
+            yield writer.pop()
+    yield writer.pop()
+
+
+def iter_tar(cfg_files: Iterable[str]) -> Iterator[bytes]:
+    writer = _ChunkWriter()
+    with tarfile.open(fileobj=writer, mode="w|gz") as tar_file:
+        for cfg_file in cfg_files:
+            data = (get_file_source(cfg_file) + "\n").encode()
+            info = tarfile.TarInfo(config_name(cfg_file))
+            info.size = len(data)
+            info.mtime = int(time.time())
+            info.mode = 0o600
+            tar_file.addfile(info, io.BytesIO(data))
+            yield writer.pop()
+    yield writer.pop()
+
+
+def iter_ndjson(cfg_files: Iterable[str]) -> Iterator[bytes]:
+    for cfg_file in cfg_files:
+        row = {"name": config_name(cfg_file)[:-len(".conf")], "config": get_file_source(cfg_file)}
+        yield (json.dumps(row) + "\n").encode()
+
+
+def iter_bulk(cfg_files: Iterable[str], format_: str) -> Iterator[bytes]:
+    '''
+    Отдаем конфиги потоком: в памяти одновременно держится только один конфиг
+    :param format_: zip, tar или ndjson
+    '''
+    if format_ == "zip":
+        return iter_zip(cfg_files)
+    if format_ == "tar":
+        return iter_tar(cfg_files)
+    return iter_ndjson(cfg_files)
@@ -0,0 +1,224 @@
+import datetime
+import logging
+import os
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import Session, col, delete, select
+
+from server.models import UserConfigs
+from server.schemas import Client, ListClients
+
+
+def client_to_row(client: Client, ip: Optional[str] = None) -> UserConfigs:
+    return UserConfigs(name=client.name,
+                       pub_key=client.pub_key,
+                       ip=ip,
+                       created=client.conf_created,
+                       used=bool(client.used),
+                       pooled=bool(client.pooled),
+                       cfg_path=client.cfg_file)
+
+
+def client_to_values(client: Client) -> dict:
+    '''
+    Поля реестра, которые видны на диске (без IP - он берется из wg0.conf)
+    '''
+    return {"name": client.name,
+            "pub_key": client.pub_key,
+            "created": client.conf_created,
+            "used": bool(client.used),
+            "pooled": bool(client.pooled),
+            "cfg_path": client.cfg_file}
+
+
+def row_to_client(row: UserConfigs) -> Client:
+    return Client(name=row.name,
+                  conf_created=row.created,
+                  used=row.used,
+                  cfg_file=row.cfg_path,
+                  path_to_cfg=os.path.dirname(row.cfg_path) if row.cfg_path else None,
+                  pub_key=row.pub_key,
+                  pooled=row.pooled)
+
+
+class ClientRegistry:
+    '''
+    Реестр клиентов в sqlite вместо обхода /etc/wireguard/clients.
+
+    Записи добавляются и удаляются вместе с генерацией и удалением клиентов,
+    список и сводка строятся одним запросом. Диск остается источником правды:
+    sync() сверяет реестр с результатом clients_scan (при старте и после ручных правок).
+    После каждого изменения вызывается on_change, например чтобы сбросить кеш статуса.
+    '''
+
+    # строк в одном INSERT, чтобы не упереться в лимит переменных sqlite
+    _CHUNK = 500
+
+    def __init__(self, engine, clients_folder: str = "/etc/wireguard/clients",
+                 on_change: Optional[Callable[[], None]] = None,
+                 logger: Optional[logging.Logger] = None):
+        self.engine = engine
+        self.clients_folder = clients_folder
+        self.on_change = on_change
+        self.logger = logger or logging.getLogger(__name__)
+
+    def _changed(self):
+        if self.on_change:
+            self.on_change()
+
+    def add_many(self, rows: Iterable[UserConfigs]):
+        '''
+        Регистрируем пачку новых клиентов одной транзакцией
+        '''
+        self.upsert_many(row.model_dump(exclude={"id"}) for row in rows)
+
+    def upsert_many(self, values: Iterable[dict]):
+        '''
+        Добавляем или обновляем клиентов по имени одной транзакцией.
+        Обновляются только переданные поля, поэтому запись от наблюдателя за папкой
+        и запись при генерации могут прийти в любом порядке
+        '''
+        groups: Dict[tuple, List[dict]] = {}
+        for row in values:
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+        if not groups:
+            return
+        with Session(self.engine) as session:
+            for keys, rows in groups.items():
+                for start in range(0, len(rows), self._CHUNK):
+                    stmt = sqlite_insert(UserConfigs).values(rows[start:start + self._CHUNK])
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=["name"],
+                        set_={key: stmt.excluded[key] for key in keys if key != "name"})
+                    session.exec(stmt)
+            session.commit()
+        self._changed()
+
+    def update_ips(self, ips: Dict[str, str]) -> int:
+        '''
+        Обновляем IP клиентов по wg0.conf
+        :param ips: публичный ключ -> IP клиента
+        :return: количество измененных записей
+        '''
+        with Session(self.engine) as session:
+            rows = session.exec(select(UserConfigs.id, UserConfigs.pub_key, UserConfigs.ip)).all()
+            changed = [{"id": row_id, "ip": ips[pub_key]} for row_id, pub_key, ip in rows
+                       if pub_key in ips and ips[pub_key] != ip]
+            if changed:
+                session.execute(update(UserConfigs), changed)
+                session.commit()
+        if changed:
+            self._changed()
+        return len(changed)
+
+    def remove_many(self, pub_keys: Iterable[str] = (), names: Iterable[str] = ()):
+        '''
+        Удаляем клиентов из реестра одной транзакцией
+        '''
+        pub_keys = [key for key in pub_keys if key]
+        names = [name for name in names if name]
+        if not pub_keys and not names:
+            return
+        with Session(self.engine) as session:
+            if pub_keys:
+                session.exec(delete(UserConfigs).where(col(UserConfigs.pub_key).in_(pub_keys)))
+            if names:
+                session.exec(delete(UserConfigs).where(col(UserConfigs.name).in_(names)))
+            session.commit()
+        self._changed()
+
+    def set_flags(self, names: Iterable[str], **values):
+        '''
+        Меняем поля used/pooled/created у клиентов по имени папки
+        '''
+        names = list(names)
+        if not names:
+            return
+        with Session(self.engine) as session:
+            rows = session.exec(select(UserConfigs).where(col(UserConfigs.name).in_(names))).all()
+            for row in rows:
+                row.sqlmodel_update(values)
+                session.add(row)
+            session.commit()
+        self._changed()
+
+    def mark_claimed(self, cfg_files: Iterable[str]):
+        '''
+        Конфиги выданы из пула. Время создания сбрасываем, как и ctime папки при снятии
+        маркера пула, чтобы автоочистка отсчитывала время с момента выдачи
+        '''
+        names = [os.path.basename(os.path.dirname(cfg_file)) for cfg_file in cfg_files]
+        self.set_flags(names, pooled=False, created=datetime.datetime.now())
+
+    def mark_pooled(self, cfg_files: Iterable[str]):
+        names = [os.path.basename(os.path.dirname(cfg_file)) for cfg_file in cfg_files]
+        self.set_flags(names, pooled=True)
+
+    def get(self, name: str) -> Optional[Client]:
+        with Session(self.engine) as session:
+            row = session.exec(select(UserConfigs).where(UserConfigs.name == name)).first()
+        return row_to_client(row) if row else None
+
+    def get_by_pub_key(self, pub_key: str) -> Optional[Client]:
+        with Session(self.engine) as session:
+            row = session.exec(select(UserConfigs).where(UserConfigs.pub_key == pub_key)).first()
+        return row_to_client(row) if row else None
+
+    def by_pub_key(self) -> Dict[str, Client]:
+        '''
+        Все клиенты реестра с индексом по публичному ключу
+        '''
+        return {client.pub_key: client for client in self.list_clients().clients if client.pub_key}
+
+    def list_clients(self) -> ListClients:
+        with Session(self.engine) as session:
+            rows = session.exec(select(UserConfigs).order_by(UserConfigs.id)).all()
+        return ListClients(clients=[row_to_client(row) for row in rows])
+
+    def counts(self) -> Tuple[int, int]:
+        '''
+        :return: (всего клиентов, из них используемых)
+        '''
+        with Session(self.engine) as session:
+            total = session.exec(select(func.count()).select_from(UserConfigs)).one()
+            used = session.exec(select(func.count()).select_from(UserConfigs)
+                                .where(UserConfigs.used == True)).one()  # noqa: E712
+        return total, used
+
+    def sync(self, clients: ListClients, ips: Optional[Dict[str, str]] = None) -> int:
+        '''
+        Сверяем реестр с клиентами на диске
+        :param clients: результат clients_scan
+        :param ips: публичный ключ -> IP клиента из wg0.conf
+        :return: количество исправленных записей
+        '''
+        ips = ips or {}
+        on_disk = {client.name: client for client in clients.clients}
+        changed = 0
+        with Session(self.engine) as session:
+            rows = {row.name: row for row in session.exec(select(UserConfigs)).all()}
+            for name, row in rows.items():
+                if name not in on_disk:
+                    session.delete(row)
+                    changed += 1
+            for name, client in on_disk.items():
+                row = rows.get(name)
+                ip = ips.get(client.pub_key)
+                if row is None:
+                    session.add(client_to_row(client, ip=ip))
+                    changed += 1
+                    continue
+                values = {"pub_key": client.pub_key, "used": bool(client.used),
+                          "pooled": bool(client.pooled), "cfg_path": client.cfg_file,
+                          "created": client.conf_created, "ip": ip or row.ip}
+                if any(getattr(row, key) != value for key, value in values.items()):
+                    row.sqlmodel_update(values)
+                    session.add(row)
+                    changed += 1
+            session.commit()
+        if changed:
+            self.logger.info(f"РЕЕСТР. Синхронизировано с диском {changed} записей")
+            self._changed()
+        return changed
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import os
+from typing import Iterable, List, Optional, Set, Tuple
+
+import watchfiles
+
+from server.client_registry import ClientRegistry, client_to_values
+from server.ini_file_core import ServerConfig, client_scan, clients_scan, peer_ip
+
+
+class ClientsWatcher:
+    '''
+    Держит реестр клиентов в актуальном состоянии по событиям inotify.
+
+    Следим за папкой клиентов и wg0.conf: если оператор вручную положил или удалил .lock
+    или папку клиента, пересканируется только эта папка. Полный обход делается при
+    старте, после перезапуска наблюдателя и если за один раз пришло слишком много
+    изменений (очередь событий могла переполниться).
+    '''
+
+    def __init__(self,
+                 registry: ClientRegistry,
+                 cfg_folder: str = "/etc/wireguard",
+                 wg0_file: str = "/etc/wireguard/wg0.conf",
+                 rescan_threshold: int = 1000,
+                 logger: Optional[logging.Logger] = None):
+        '''
+        :param rescan_threshold: при большем количестве измененных клиентов за раз - полный обход
+        '''
+        self.registry = registry
+        self.cfg_folder = os.path.abspath(cfg_folder)
+        self.clients_folder = os.path.join(self.cfg_folder, "clients")
+        self.wg0_file = os.path.abspath(wg0_file)
+        self.rescan_threshold = rescan_threshold
+        self.logger = logger or logging.getLogger(__name__)
+
+    def _peer_ips(self):
+        srv_cfg_file = ServerConfig(self.wg0_file)
+        return {pub_key: str(peer_ip(row.AllowedIPs)) for pub_key, row in srv_cfg_file.peers.items()
+                if row.get("AllowedIPs")}
+
+    def _client_name(self, path: str) -> Optional[str]:
+        rel_path = os.path.relpath(path, self.clients_folder)
+        name = rel_path.split(os.sep)[0]
+        if name in (".", "..") or rel_path.startswith(".." + os.sep):
+            return None
+        return name
+
+    def watch_filter(self, change, path: str) -> bool:
+        return path == self.wg0_file or self._client_name(path) is not None
+
+    def full_rescan(self) -> int:
+        '''
+        Полная сверка реестра с диском
+        '''
+        return self.registry.sync(clients_scan(self.clients_folder), ips=self._peer_ips())
+
+    def apply(self, changes: Iterable[Tuple[watchfiles.Change, str]]):
+        '''
+        Применяем пачку событий к реестру
+        '''
+        names: Set[str] = set()
+        wg0_changed = False
+        for _, path in changes:
+            if path == self.wg0_file:
+                wg0_changed = True
+                continue
+            name = self._client_name(path)
+            if name:
+                names.add(name)
+        if len(names) > self.rescan_threshold:
+            self.logger.info(f"РЕЕСТР. Изменено {len(names)} клиентов, полная сверка с диском")
+            self.full_rescan()
+            return
+
+        upserts: List[dict] = []
+        removed: List[str] = []
+        for name in names:
+            client = client_scan(os.path.join(self.clients_folder, name))
+            if client is None:
+                removed.append(name)
+            else:
+                upserts.append(client_to_values(client))
+        self.registry.upsert_many(upserts)
+        self.registry.remove_many(names=removed)
+        if wg0_changed:
+            self.registry.update_ips(self._peer_ips())
+
+    async def run(self, stop_event: Optional[asyncio.Event] = None, retry_seconds: int = 30):
+        '''
+        Следим за изменениями пока не выставлен stop_event.
+        Если наблюдатель упал (например, папки еще нет) - ждем и начинаем заново с полного обхода
+        '''
+        rescan = False
+        while not (stop_event and stop_event.is_set()):
+            try:
+                if rescan:
+                    await asyncio.to_thread(self.full_rescan)
+                async for changes in watchfiles.awatch(self.cfg_folder,
+                                                       watch_filter=self.watch_filter,
+                                                       stop_event=stop_event):
+                    await asyncio.to_thread(self.apply, changes)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                self.logger.warning(f"РЕЕСТР. Наблюдение за {self.cfg_folder} прервано: {ex}")
+                rescan = True
+                try:
+                    await asyncio.wait_for(stop_event.wait() if stop_event else asyncio.sleep(retry_seconds),
+                                           timeout=retry_seconds)
+                except asyncio.TimeoutError:
+                    pass
@@ -0,0 +1,161 @@
+import asyncio
+import collections
+import logging
+import os
+import pathlib
+import threading
+from concurrent.futures import Executor
+from typing import Callable, List, Optional
+
+# файл-маркер в папке клиента: конфиг сгенерирован заранее и ещё никому не выдан
+POOL_MARKER = "pool.ready"
+
+
+class ConfigPool:
+    '''
+    Пул заранее сгенерированных, но ещё не выданных конфигов клиентов.
+
+    /get-wire забирает готовый конфиг из пула за O(1), а пул пополняется в фоне:
+    как только в нём остаётся меньше low_watermark конфигов, догенерируем до high_watermark.
+    Состояние пула хранится на диске маркером POOL_MARKER, поэтому после перезапуска
+    пул восстанавливается через load().
+    '''
+
+    def __init__(self,
+                 generator: Callable[[int], List[str]],
+                 clients_folder: str = "/etc/wireguard/clients",
+                 low_watermark: int = 10,
+                 high_watermark: int = 50,
+                 executor: Optional[Executor] = None,
+                 on_ready: Optional[Callable[[List[str]], None]] = None,
+                 on_claim: Optional[Callable[[List[str]], None]] = None,
+                 logger: Optional[logging.Logger] = None):
+        '''
+        :param generator: функция, которая генерирует N клиентов и возвращает пути к их client.conf
+        :param clients_folder: папка с конфигами клиентов
+        :param low_watermark: при меньшем количестве готовых конфигов запускается пополнение
+        :param high_watermark: до какого количества пополняем пул
+        :param executor: в каком пуле потоков пополнять, None - пул по умолчанию
+        :param on_ready: вызывается в потоке пополнения со списком новых конфигов пула
+        :param on_claim: вызывается со списком забираемых конфигов до снятия маркеров пула,
+            пока автоочистка их еще не трогает
+        '''
+        self.generator = generator
+        self.clients_folder = clients_folder
+        self.low_watermark = low_watermark
+        self.high_watermark = max(high_watermark, low_watermark)
+        self.executor = executor
+        self.on_ready = on_ready
+        self.on_claim = on_claim
+        self.logger = logger or logging.getLogger(__name__)
+        self._ready: collections.deque = collections.deque()
+        self._refill_lock = threading.Lock()
+        self._refill_task: Optional[asyncio.Future] = None
+
+    def __len__(self):
+        return len(self._ready)
+
+    def load(self):
+        '''
+        Восстанавливаем пул по маркерам в папках клиентов
+        '''
+        self._ready.clear()
+        if not os.path.isdir(self.clients_folder):
+            return
+        for entry in os.scandir(self.clients_folder):
+            if not entry.is_dir():
+                continue
+            cfg_file = os.path.join(entry.path, "client.conf")
+            if os.path.exists(os.path.join(entry.path, POOL_MARKER)) and os.path.exists(cfg_file):
+                self._ready.append(cfg_file)
+        self.logger.info(f"ПУЛ. Восстановлено {len(self._ready)} готовых конфигов")
+
+    def claim(self) -> Optional[str]:
+        '''
+        Забираем готовый конфиг из пула и снимаем с него маркер пула.
+        :return: путь к client.conf или None если пул пуст
+        '''
+        claimed = self.claim_many(1)
+        return claimed[0] if claimed else None
+
+    def claim_many(self, count: int) -> List[str]:
+        '''
+        Забираем из пула до count готовых конфигов и снимаем с них маркеры пула.
+        Блокирующий вызов: on_claim обычно пишет в реестр
+        :return: список путей к client.conf, может быть короче count
+        '''
+        claimed = []
+        while len(claimed) < count and self._ready:
+            batch = []
+            while len(batch) < count - len(claimed) and self._ready:
+                cfg_file = self._ready.popleft()
+                # конфиг могли удалить вручную или через /del_all_cfg
+                if os.path.exists(os.path.join(os.path.dirname(cfg_file), POOL_MARKER)):
+                    batch.append(cfg_file)
+            if batch and self.on_claim:
+                self.on_claim(batch)
+            for cfg_file in batch:
+                try:
+                    pathlib.Path(os.path.dirname(cfg_file), POOL_MARKER).unlink()
+                except FileNotFoundError:
+                    continue
+                claimed.append(cfg_file)
+        return claimed
+
+    def release(self, cfg_files: List[str]) -> int:
+        '''
+        Возвращаем в пул забранные, но не выданные конфиги (выдача не удалась).
+        Они встают в начало очереди и выдаются первыми
+        :return: количество возвращенных конфигов
+        '''
+        released = 0
+        for cfg_file in reversed(cfg_files):
+            if not os.path.exists(cfg_file):
+                continue
+            pathlib.Path(os.path.dirname(cfg_file), POOL_MARKER).touch()
+            self._ready.appendleft(cfg_file)
+            released += 1
+        return released
+
+    def needs_refill(self) -> bool:
+        return len(self._ready) < self.low_watermark
+
+    def refill(self) -> int:
+        '''
+        Синхронно догенерируем пул до high_watermark.
+        :return: количество добавленных в пул конфигов
+        '''
+        if not self._refill_lock.acquire(blocking=False):
+            # пополнение уже идет
+            return 0
+        try:
+            need = self.high_watermark - len(self._ready)
+            if need <= 0:
+                return 0
+            self.logger.info(f"ПУЛ. Пополняем пул на {need} конфигов")
+            new_cfgs = self.generator(need)
+            for cfg_file in new_cfgs:
+                pathlib.Path(os.path.dirname(cfg_file), POOL_MARKER).touch()
+                self._ready.append(cfg_file)
+            if self.on_ready:
+                self.on_ready(new_cfgs)
+            return len(new_cfgs)
+        finally:
+            self._refill_lock.release()
+
+    def _refill_safe(self):
+        try:
+            self.refill()
+        except Exception as ex:
+            self.logger.warning(f"ПУЛ. Пополнение пула закончилось с ошибкой: {ex}")
+
+    def schedule_refill(self):
+        '''
+        Запускаем пополнение пула в фоне, если опустились ниже low_watermark.
+        Вызывать из event loop.
+        '''
+        if not self.needs_refill():
+            return
+        if self._refill_task and not self._refill_task.done():
+            return
+        self._refill_task = asyncio.get_running_loop().run_in_executor(self.executor, self._refill_safe)
@@ -0,0 +1,303 @@
+import codecs
+import collections
+import json
+import re
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+from fastapi import Request
+
+from server.handlers.sus_patterns import SusPatterns
+
+Message = Dict[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+
+# multipart part headers longer than this are not parsed
+_MAX_PART_HEADERS = 16 * 1024
+# a JSON string literal, possibly cut at the end, and whether it is a key
+_JSON_STRING = re.compile(r'"([^"\\]*(?:\\.[^"\\]*)*)(?:"(\s*:)?|\\?$)')
+
+
+def media_type(content_type: str) -> str:
+    return content_type.split(";", 1)[0].strip().lower()
+
+
+def _boundary(content_type: str) -> Optional[bytes]:
+    for param in content_type.split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "boundary" and value:
+            return value.strip('"').encode("latin-1")
+    return None
+
+
+def _json_strings(text: str) -> Iterator[str]:
+    """
+    String values of a JSON text that may be cut
+    anywhere; object keys are skipped.
+    """
+    for match in _JSON_STRING.finditer(text):
+        if match.group(2):
+            continue
+        try:
+            yield json.loads('"' + match.group(1) + '"')
+        except ValueError:
+            yield match.group(1)
+
+
+def replay_receive(messages: List[Message], receive: Receive) -> Receive:
+    """
+    Build a receive callable that returns the already
+    read messages first and then reads the rest.
+
+    Args:
+        messages (List[Message]):
+            Messages read during inspection.
+        receive (Receive):
+            The original ASGI receive callable.
+
+    Returns:
+        Receive:
+            The receive callable for the downstream app.
+    """
+    pending = collections.deque(messages)
+
+    async def replay() -> Message:
+        if pending:
+            return pending.popleft()
+        return await receive()
+
+    return replay
+
+
+class _TextScanner:
+    """
+    Incremental scan of a text stream. The tail of the
+    previous chunk is scanned again with the next one,
+    so matches up to `overlap` characters long are not
+    split by chunk boundaries.
+    """
+
+    def __init__(self, overlap: int) -> None:
+        self.overlap = overlap
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self.tail = ""
+
+    def feed(self, data: bytes, final: bool = False) -> Optional[Tuple[str, str]]:
+        text = self.decoder.decode(data, final)
+        if not text:
+            return None
+        window = self.tail + text
+        self.tail = window[-self.overlap:]
+        rule = SusPatterns.match(window)
+        return (window, rule) if rule else None
+
+
+class _JSONScanner:
+    """
+    JSON is scanned as a whole document: string values
+    of an object are checked, like query params are.
+    In a document cut by the limit every string
+    value of the inspected prefix is checked.
+    """
+
+    def __init__(self) -> None:
+        self.chunks: List[bytes] = []
+
+    def feed(self, data: bytes, final: bool = False) -> Optional[Tuple[str, str]]:
+        self.chunks.append(data)
+        if not final:
+            return None
+        text = b"".join(self.chunks).decode("utf-8", "replace")
+        self.chunks = []
+        try:
+            document = json.loads(text)
+        except ValueError:
+            document = text
+        values = document.values() if isinstance(document, dict) else [document]
+        for value in values:
+            if isinstance(value, str):
+                rule = SusPatterns.match(value)
+                if rule:
+                    return value, rule
+        return None
+
+    def feed_truncated(self, data: bytes) -> Optional[Tuple[str, str]]:
+        # the prefix cannot be parsed, its string values are found one by one
+        text = (b"".join(self.chunks) + data).decode("utf-8", "replace")
+        self.chunks = []
+        for value in _json_strings(text):
+            rule = SusPatterns.match(value)
+            if rule:
+                return value, rule
+        return None
+
+
+class _MultipartScanner:
+    """
+    Incremental multipart/form-data scan. Part headers
+    and plain form fields are scanned; the contents of
+    file parts are skipped up to the next delimiter.
+    """
+
+    def __init__(self, boundary: bytes, overlap: int) -> None:
+        self.delimiter = b"\r\n--" + boundary
+        self.overlap = overlap
+        # the first delimiter has no leading CRLF
+        self.buffer = bytearray(b"\r\n")
+        self.state = "preamble"
+        self.part: Optional[_TextScanner] = None
+        self.done = False
+
+    def feed(self, data: bytes, final: bool = False) -> Optional[Tuple[str, str]]:
+        self.buffer += data
+        while not self.done:
+            if self.state in ("preamble", "body"):
+                index = self.buffer.find(self.delimiter)
+                end = index if index >= 0 else max(len(self.buffer) - len(self.delimiter), 0)
+                if self.state == "body" and self.part is not None and end:
+                    found = self.part.feed(bytes(self.buffer[:end]), final=index >= 0)
+                    if found:
+                        return found
+                if index < 0:
+                    del self.buffer[:end]
+                    return None
+                del self.buffer[:index + len(self.delimiter)]
+                self.state = "headers"
+            else:
+                index = self.buffer.find(b"\r\n\r\n")
+                if self.buffer[:2] == b"--":
+                    # closing delimiter
+                    self.done = True
+                    return None
+                if index < 0:
+                    if len(self.buffer) > _MAX_PART_HEADERS:
+                        self.done = True
+                    return None
+                headers = bytes(self.buffer[:index]).decode("utf-8", "replace")
+                del self.buffer[:index + 4]
+                for line in headers.split("\r\n"):
+                    # only values: the "Name:" syntax itself trips the SSRF pattern
+                    value = line.partition(":")[2].strip()
+                    rule = SusPatterns.match(value) if value else None
+                    if rule:
+                        return value, rule
+                # file contents are discarded, not scanned
+                is_file = "filename=" in headers.lower()
+                self.part = None if is_file else _TextScanner(self.overlap)
+                self.state = "body"
+        return None
+
+
+class BodyInspector:
+    """
+    Streaming inspection of request bodies for suspicious patterns.
+
+    The body is read chunk by chunk from the ASGI receive
+    callable and scanned as it arrives, up to a limit per
+    content type (0 - not inspected, e.g. binary uploads).
+    The read chunks are replayed to the endpoint, the rest
+    of the body is passed through untouched, so memory is
+    bounded by the limit, not by the body size.
+    """
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, int]] = None,
+        default_limit: int = 64 * 1024,
+        overlap: int = 512,
+    ) -> None:
+        """
+        Initialize the BodyInspector.
+
+        Args:
+            limits (Optional[Dict[str, int]]):
+                Max inspected bytes per media type; keys are
+                exact types (`application/json`) or `type/*`.
+            default_limit (int):
+                Limit for media types not listed in `limits`.
+            overlap (int):
+                Characters of the previous chunk scanned again
+                with the next one.
+        """
+        self.limits = {key.lower(): value for key, value in (limits or {}).items()}
+        self.default_limit = default_limit
+        self.overlap = overlap
+
+    def limit_for(self, media: str) -> int:
+        if media in self.limits:
+            return self.limits[media]
+        wildcard = media.split("/", 1)[0] + "/*"
+        return self.limits.get(wildcard, self.default_limit)
+
+    def _scanner(self, content_type: str) -> Optional[Any]:
+        media = media_type(content_type)
+        if media == "application/json" or media.endswith("+json"):
+            return _JSONScanner()
+        if media == "multipart/form-data":
+            boundary = _boundary(content_type)
+            return _MultipartScanner(boundary, self.overlap) if boundary else None
+        return _TextScanner(self.overlap)
+
+    async def inspect(self, headers: Any, receive: Receive) -> Tuple[Optional[Tuple[str, str]], Receive]:
+        """
+        Scan the request body as it arrives.
+
+        Args:
+            headers (Mapping[str, str]):
+                Request headers (case-insensitive).
+            receive (Receive):
+                The ASGI receive callable.
+
+        Returns:
+            Tuple[Optional[Tuple[str, str]], Receive]:
+                (suspicious value, matched pattern) or None,
+                and the receive callable to pass downstream.
+        """
+        if "content-length" not in headers and "transfer-encoding" not in headers:
+            return None, receive
+        content_type = headers.get("content-type", "")
+        limit = self.limit_for(media_type(content_type))
+        scanner = self._scanner(content_type)
+        if limit <= 0 or scanner is None:
+            return None, receive
+
+        messages: List[Message] = []
+        read = 0
+        while read < limit:
+            message = await receive()
+            messages.append(message)
+            if message["type"] != "http.request":
+                break
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            inspected = body[:limit - read]
+            read += len(body)
+            truncated = more_body or len(inspected) < len(body)
+            if isinstance(scanner, _JSONScanner) and truncated and read >= limit:
+                found = scanner.feed_truncated(inspected)
+                if found:
+                    return found, replay_receive(messages, receive)
+                break
+            found = scanner.feed(inspected, final=not truncated)
+            if found:
+                return found, replay_receive(messages, receive)
+            if not more_body or getattr(scanner, "done", False):
+                break
+        return None, replay_receive(messages, receive)
+
+    async def inspect_request(self, request: Request) -> Optional[Tuple[str, str]]:
+        """
+        Scan the body of a Starlette request and let
+        the endpoint read it again afterwards.
+
+        Args:
+            request (Request):
+                The incoming request object.
+
+        Returns:
+            Optional[Tuple[str, str]]:
+                (suspicious value, matched pattern) or None.
+        """
+        found, receive = await self.inspect(request.headers, request.receive)
+        # the endpoint reads the body through this receive
+        request._receive = receive
+        return found
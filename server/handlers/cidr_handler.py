@@ -0,0 +1,156 @@
+import logging
+import threading
+from bisect import bisect_right
+from ipaddress import IPv4Address, IPv6Address, ip_address, ip_network
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+
+def parse_entry(entry: str) -> Tuple[int, int, int]:
+    """
+    Turn a whitelist/blacklist entry into an address interval.
+
+    Args:
+        entry (str):
+            A single IP address or a CIDR range, IPv4 or IPv6.
+
+    Returns:
+        Tuple[int, int, int]:
+            IP version, first and last address of the range as integers.
+
+    Raises:
+        ValueError: If the entry is not an IP address or CIDR range.
+    """
+    network = ip_network(entry.strip(), strict=False)
+    return (
+        network.version,
+        int(network.network_address),
+        int(network.broadcast_address),
+    )
+
+
+def _merge(intervals: List[Tuple[int, int]]) -> Tuple[List[int], List[int]]:
+    starts: List[int] = []
+    ends: List[int] = []
+    for start, end in sorted(intervals):
+        if ends and start <= ends[-1] + 1:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+
+class CIDRMatcher:
+    """
+    Compiled set of IP addresses and CIDR ranges.
+
+    Entries are turned into sorted, non-overlapping
+    intervals per IP version, so a lookup is one
+    binary search regardless of the number of ranges.
+    """
+
+    def __init__(self, entries: Optional[Iterable[str]] = None) -> None:
+        """
+        Initialize the CIDRMatcher.
+
+        Args:
+            entries (Optional[Iterable[str]]):
+                IP addresses and CIDR ranges. Invalid
+                entries are skipped and kept in `invalid`.
+        """
+        self.invalid: List[str] = []
+        intervals: Dict[int, List[Tuple[int, int]]] = {4: [], 6: []}
+        self.size = 0
+        for entry in entries or ():
+            try:
+                version, start, end = parse_entry(entry)
+            except ValueError:
+                self.invalid.append(entry)
+                continue
+            intervals[version].append((start, end))
+            self.size += 1
+        self._intervals = {version: _merge(items) for version, items in intervals.items()}
+
+    def __len__(self) -> int:
+        return self.size
+
+    def match(self, ip: Union[str, IPv4Address, IPv6Address]) -> bool:
+        """
+        Check whether the address falls into any entry.
+
+        Args:
+            ip (Union[str, IPv4Address, IPv6Address]):
+                The IP address to check.
+
+        Returns:
+            bool:
+                True if the address is covered by the set.
+
+        Raises:
+            ValueError: If `ip` is not a valid IP address.
+        """
+        addr = ip_address(ip) if isinstance(ip, str) else ip
+        if addr.version == 6 and addr.ipv4_mapped is not None:
+            addr = addr.ipv4_mapped
+        starts, ends = self._intervals[addr.version]
+        value = int(addr)
+        index = bisect_right(starts, value) - 1
+        return index >= 0 and value <= ends[index]
+
+    __contains__ = match
+
+
+class AccessListManager:
+    """
+    Compiled whitelist and blacklist of the security config.
+
+    The lists are compiled once and swapped in a single
+    assignment, so requests never see a half-built state.
+    Call `load` after the lists change (e.g. the DB was
+    edited); a different config object is compiled lazily.
+    """
+
+    def __init__(self) -> None:
+        """
+        Initialize the AccessListManager.
+        """
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._config: object = None
+        self._lists: Tuple[Optional[CIDRMatcher], Optional[CIDRMatcher]] = (None, None)
+
+    def load(self, config: object) -> None:
+        """
+        Recompile the lists of a config.
+
+        Args:
+            config (SecurityConfig):
+                The security configuration object.
+        """
+        whitelist = CIDRMatcher(config.whitelist) if config.whitelist else None
+        blacklist = CIDRMatcher(config.blacklist) if config.blacklist else None
+        for matcher in (whitelist, blacklist):
+            if matcher is not None and matcher.invalid:
+                self.logger.warning(f"Invalid IP or CIDR entries skipped: {matcher.invalid}")
+        with self._lock:
+            self._lists = (whitelist, blacklist)
+            self._config = config
+
+    def lists(self, config: object) -> Tuple[Optional[CIDRMatcher], Optional[CIDRMatcher]]:
+        """
+        Get the compiled lists of a config.
+
+        Args:
+            config (SecurityConfig):
+                The security configuration object.
+
+        Returns:
+            Tuple[Optional[CIDRMatcher], Optional[CIDRMatcher]]:
+                Whitelist and blacklist, None when a list is empty.
+        """
+        if self._config is not config:
+            self.load(config)
+        return self._lists
+
+
+access_list_manager = AccessListManager()
@@ -1,18 +1,21 @@
 # fastapi_guard/middleware.py
 import logging
 import time
-#from collections.abc import Awaitable, Callable
-from typing import Awaitable, Callable
+from typing import Iterable, Optional, Tuple, Union
 
 from cachetools import TTLCache
 from fastapi import FastAPI, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.datastructures import URL
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from server.models import SecurityConfig
+from server.handlers.prefix_trie import PrefixTrie
 from server.handlers.ipinfo_handler import IPInfoManager
 from server.handlers.ipban_handler import ip_ban_manager
+from server.handlers.body_inspector import BodyInspector
+from server.handlers.rate_limit_handler import RateLimitManager
+from server.metrics import http_rejected_total
 from server.utils import (
     detect_penetration_attempt,
     is_ip_allowed,
@@ -21,7 +24,11 @@ from server.utils import (
     log_suspicious_activity,
     setup_custom_logging,)
 
-class SecurityMiddleware(BaseHTTPMiddleware):
+# a rejection: HTTP status code and response body
+Rejection = Tuple[int, str]
+
+
+class SecurityMiddleware:
     """
     Middleware for implementing various
     security measures in a FastAPI application.
@@ -30,27 +37,37 @@ class SecurityMiddleware(BaseHTTPMiddleware):
     IP filtering, user agent filtering,
     and detection of potential
     penetration attempts.
+
+    It is a plain ASGI middleware: allowed requests are
+    passed on with the original `send`, so streaming
+    responses are not buffered, and rejections are
+    written to `send` directly. Websockets and lifespan
+    events are passed through unchecked.
     """
 
-    def __init__(self, app: FastAPI, config: SecurityConfig):
+    def __init__(self, app: ASGIApp, config: SecurityConfig):
         """
         Initialize the SecurityMiddleware.
 
         Args:
-            app (FastAPI):
-                The FastAPI application.
+            app (ASGIApp):
+                The next ASGI application.
             config (SecurityConfig):
                 Configuration object for security settings.
         """
-        super().__init__(app)
+        self.app = app
         self.config = config
+        self.excluded_paths = PrefixTrie(config.exclude_paths)
         self.rate_limit = config.rate_limit
         self.rate_limit_window = config.rate_limit_window
         self.request_counts: TTLCache = TTLCache(maxsize=10000, ttl=self.rate_limit_window)
         self.logger = logging.getLogger(__name__)
         self.ip_request_counts: TTLCache = TTLCache(maxsize=10000, ttl=3600)
         self.last_cloud_ip_refresh = 0
-        self.request_times: dict[str, list[float]] = {}
+        self.rate_limiter = RateLimitManager(config)
+        self.body_inspector = BodyInspector(
+            config.body_inspection_limits, config.body_inspection_default_limit
+        )
         self.suspicious_request_counts: dict[str, int] = {}
         self.last_cleanup = time.time()
         self.ipinfo_db = IPInfoManager(token=config.ipinfo_token, db_path=config.ipinfo_db_path)
@@ -65,7 +82,49 @@ class SecurityMiddleware(BaseHTTPMiddleware):
     async def setup_logger(self) -> None:
         self.logger = await setup_custom_logging("security.log")
 
-    async def dispatch(self, request: Request, call_next: Callable[[Request], Awaitable[Response]]) -> Response:
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """
+        Apply the security checks to an HTTP request.
+
+        Args:
+            scope (Scope):
+                The ASGI connection scope.
+            receive (Receive):
+                The ASGI receive callable.
+            send (Send):
+                The ASGI send callable.
+        """
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if self.config.enforce_https and scope.get("scheme") == "http":
+            https_url = URL(scope=scope).replace(scheme="https")
+            await self.send_response(
+                send,
+                status.HTTP_301_MOVED_PERMANENTLY,
+                b"",
+                [(b"location", str(https_url).encode("latin-1"))],
+            )
+            return
+
+        # Excluded paths
+        if not scope.get("client") or self.excluded_paths.match(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope, receive)
+        rejection = await self.dispatch(request)
+        if rejection is None:
+            # request.receive replays the part of the body read by the inspection
+            await self.app(scope, request.receive, send)
+        elif isinstance(rejection, Response):
+            await rejection(scope, request.receive, send)
+        else:
+            status_code, message = rejection
+            await self.send_response(send, status_code, message.encode("utf-8"))
+
+    async def dispatch(self, request: Request) -> Optional[Union[Rejection, Response]]:
         """
         Dispatch method to handle incoming
         requests and apply security measures.
@@ -78,30 +137,17 @@ class SecurityMiddleware(BaseHTTPMiddleware):
         Args:
             request (Request):
                 The incoming request object.
-            call_next (Callable[[Request], Awaitable[Response]]):
-                The next middleware or route handler in the chain.
 
         Returns:
-            Response: The response object, either
-            from the next handler or a security-related response.
+            Optional[Union[Rejection, Response]]: None if
+            the request may proceed, otherwise the rejection
+            or the response of `custom_request_check`.
         """
-        if self.config.enforce_https and request.url.scheme == "http":
-            https_url = request.url.replace(scheme="https")
-            return RedirectResponse(
-                https_url, status_code=status.HTTP_301_MOVED_PERMANENTLY
-            )
-
-        if not request.client:
-            return await call_next(request)
-
         client_ip = (
             request.headers.get("X-Forwarded-For", request.client.host)
             .split(",")[0]
             .strip()
         )
-        # Excluded paths
-        if any(request.url.path.startswith(path) for path in self.config.exclude_paths):
-            return await call_next(request)
 
         # Log request
         await log_request(request, self.logger)
@@ -118,9 +164,10 @@ class SecurityMiddleware(BaseHTTPMiddleware):
             await log_suspicious_activity(
                 request, f"Banned IP attempted access: {client_ip}", self.logger
             )
-            return await self.create_error_response(
+            return self.create_error_response(
                 status_code=status.HTTP_403_FORBIDDEN,
                 default_message="IP address banned",
+                reason="banned",
             )
 
         # Whitelist/blacklist
@@ -128,8 +175,8 @@ class SecurityMiddleware(BaseHTTPMiddleware):
             await log_suspicious_activity(
                 request, f"IP not allowed: {client_ip}", self.logger
             )
-            return await self.create_error_response(
-                status_code=status.HTTP_403_FORBIDDEN, default_message="Forbidden"
+            return self.create_error_response(
+                status_code=status.HTTP_403_FORBIDDEN, default_message="Forbidden", reason="ip_not_allowed"
             )
 
         # Cloud providers
@@ -139,9 +186,10 @@ class SecurityMiddleware(BaseHTTPMiddleware):
             await log_suspicious_activity(
                 request, f"Blocked cloud provider IP: {client_ip}", self.logger
             )
-            return await self.create_error_response(
+            return self.create_error_response(
                 status_code=status.HTTP_403_FORBIDDEN,
                 default_message="Cloud provider IP not allowed",
+                reason="cloud_provider",
             )
 
         # User agent
@@ -150,31 +198,28 @@ class SecurityMiddleware(BaseHTTPMiddleware):
             await log_suspicious_activity(
                 request, f"Blocked user agent: {user_agent}", self.logger
             )
-            return await self.create_error_response(
+            return self.create_error_response(
                 status_code=status.HTTP_403_FORBIDDEN,
                 default_message="User-Agent not allowed",
+                reason="user_agent",
             )
 
         # Rate limit
         if self.config.enable_rate_limiting:
-            current_time = time.time()
-            window_start = current_time - self.rate_limit_window
-
-            requests = [t for t in self.request_times.get(client_ip, []) if t > window_start]
-
-            if len(requests) >= self.rate_limit:
+            await self.cleanup_rate_limits()
+            exceeded = self.rate_limiter.check(client_ip, request.url.path)
+            if exceeded is not None:
                 await log_suspicious_activity(
-                    request, f"Rate limit exceeded for IP: {client_ip}", self.logger
+                    request, f"Rate limit {exceeded} exceeded for IP: {client_ip}", self.logger
                 )
-                return await self.create_error_response(
+                return self.create_error_response(
                     status_code=status.HTTP_429_TOO_MANY_REQUESTS,
                     default_message="Too many requests",
+                    reason="rate_limit",
                 )
-
-            self.request_times[client_ip] = requests + [current_time]
         # Sus Activity
         if self.config.enable_penetration_detection:
-            if await detect_penetration_attempt(request):
+            if await detect_penetration_attempt(request, self.body_inspector):
                 self.suspicious_request_counts[client_ip] = (
                     self.suspicious_request_counts.get(client_ip, 0) + 1
                 )
@@ -193,9 +238,10 @@ class SecurityMiddleware(BaseHTTPMiddleware):
                         f"IP banned due to suspicious activity: {client_ip}",
                         self.logger,
                     )
-                    return await self.create_error_response(
+                    return self.create_error_response(
                         status_code=status.HTTP_403_FORBIDDEN,
                         default_message="IP has been banned",
+                        reason="auto_ban",
                     )
 
                 await log_suspicious_activity(
@@ -203,9 +249,10 @@ class SecurityMiddleware(BaseHTTPMiddleware):
                     f"Suspicious activity detected for IP: {client_ip}",
                     self.logger,
                 )
-                return await self.create_error_response(
+                return self.create_error_response(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     default_message="Suspicious activity detected",
+                    reason="suspicious",
                 )
 
         # Custom request
@@ -214,7 +261,7 @@ class SecurityMiddleware(BaseHTTPMiddleware):
             if custom_response:
                 return custom_response
 
-        return await call_next(request)
+        return None
 
     async def refresh_cloud_ip_ranges(self) -> None:
         """Refresh cloud IP ranges asynchronously."""
@@ -224,15 +271,61 @@ class SecurityMiddleware(BaseHTTPMiddleware):
             cloud_handler.refresh()
         self.last_cloud_ip_refresh = int(time.time())
 
-    async def create_error_response(self, status_code: int, default_message: str    ) -> Response:
+    def create_error_response(self, status_code: int, default_message: str, reason: str = "other") -> Rejection:
+        """
+        Build the rejection and count it in the metrics.
+
+        Args:
+            status_code (int):
+                HTTP status code of the response.
+            default_message (str):
+                Body used when no custom response is configured.
+            reason (str):
+                Label for the wg_http_rejected_total counter.
+
+        Returns:
+            Rejection: Status code and response body.
+        """
+        http_rejected_total.inc(reason=reason)
         custom_message = self.config.custom_error_responses.get(
             status_code, default_message
         )
-        return Response(custom_message, status_code=status_code)
+        return status_code, custom_message
+
+    @staticmethod
+    async def send_response(
+        send: Send, status_code: int, body: bytes, headers: Iterable[Tuple[bytes, bytes]] = ()
+    ) -> None:
+        """
+        Write a complete response straight to the ASGI send.
+
+        Args:
+            send (Send):
+                The ASGI send callable.
+            status_code (int):
+                HTTP status code.
+            body (bytes):
+                Response body.
+            headers (Iterable[Tuple[bytes, bytes]]):
+                Extra raw headers.
+        """
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status_code,
+                "headers": [
+                    (b"content-type", b"text/plain; charset=utf-8"),
+                    (b"content-length", str(len(body)).encode("latin-1")),
+                    *headers,
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
 
     async def reset(self) -> None:
         self.request_counts.clear()
         self.ip_request_counts.clear()
+        self.rate_limiter.reset()
 
     @staticmethod
     def configure_cors(app: FastAPI, config: SecurityConfig) -> bool:
@@ -260,13 +353,8 @@ class SecurityMiddleware(BaseHTTPMiddleware):
         """Clean up expired rate limit windows"""
         current_time = time.time()
         if current_time - self.last_cleanup > 60:
-            window_start = current_time - self.config.rate_limit_window
-            for ip in list(self.request_times.keys()):
-                self.request_times[ip] = [
-                    t for t in self.request_times[ip] if t > window_start
-                ]
-                if not self.request_times[ip]:
-                    del self.request_times[ip]
+            # memory is bounded by rate_limit_max_keys anyway, this only frees it earlier
+            self.rate_limiter.cleanup(current_time)
             self.last_cleanup = current_time
 
     async def initialize(self) -> None:
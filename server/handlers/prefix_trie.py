@@ -0,0 +1,61 @@
+from typing import Dict, Iterable, Optional
+
+# marks the end of a stored prefix in a trie node
+_END = ""
+
+
+class PrefixTrie:
+    """
+    Character trie of path prefixes.
+
+    Answers "does the path start with any stored
+    prefix" by walking the path once, stopping at the
+    first stored prefix or the first missing character.
+    """
+
+    def __init__(self, prefixes: Optional[Iterable[str]] = None) -> None:
+        """
+        Initialize the PrefixTrie.
+
+        Args:
+            prefixes (Optional[Iterable[str]]):
+                Prefixes to store, e.g. `config.exclude_paths`.
+        """
+        self.root: Dict[str, dict] = {}
+        self.size = 0
+        for prefix in prefixes or ():
+            self.add(prefix)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, prefix: str) -> None:
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        if _END not in node:
+            node[_END] = {}
+            self.size += 1
+
+    def match(self, path: str) -> bool:
+        """
+        Check whether the path starts with a stored prefix.
+
+        Args:
+            path (str):
+                The request path.
+
+        Returns:
+            bool:
+                True if some stored prefix is a prefix of `path`.
+        """
+        node = self.root
+        if _END in node:
+            return True
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                return False
+            if _END in node:
+                return True
+        return False
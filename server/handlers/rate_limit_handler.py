@@ -0,0 +1,196 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+SLIDING_WINDOW = "sliding_window"
+TOKEN_BUCKET = "token_bucket"
+
+
+class RateLimiter:
+    """
+    Per-key rate limiter with fixed memory per key.
+
+    `sliding_window` keeps the counts of the current and
+    the previous window and weights the previous one by
+    the part of it still inside the sliding window.
+    `token_bucket` refills `limit` tokens per `window`
+    seconds and allows bursts up to `limit`.
+    The key space is an LRU bounded by `max_keys`.
+    """
+
+    def __init__(
+        self,
+        limit: int,
+        window: float,
+        algorithm: str = SLIDING_WINDOW,
+        max_keys: int = 10000,
+    ) -> None:
+        """
+        Initialize the RateLimiter.
+
+        Args:
+            limit (int):
+                Maximum requests per window.
+            window (float):
+                Window length in seconds.
+            algorithm (str):
+                `sliding_window` or `token_bucket`.
+            max_keys (int):
+                How many keys to remember; the least
+                recently seen key is dropped first.
+        """
+        if algorithm not in (SLIDING_WINDOW, TOKEN_BUCKET):
+            raise ValueError(f"Unknown rate limit algorithm: {algorithm}")
+        self.limit = limit
+        self.window = float(window)
+        self.algorithm = algorithm
+        self.max_keys = max_keys
+        self._states: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def _sliding_window(self, state: Optional[List[float]], now: float) -> Tuple[List[float], bool]:
+        # state: [window number, requests in it, requests in the previous one]
+        current = math.floor(now / self.window)
+        if state is None:
+            state = [current, 0, 0]
+        elif state[0] != current:
+            state[2] = state[1] if state[0] == current - 1 else 0
+            state[0], state[1] = current, 0
+        elapsed = now / self.window - current
+        estimated = state[2] * (1 - elapsed) + state[1]
+        if estimated >= self.limit:
+            return state, False
+        state[1] += 1
+        return state, True
+
+    def _token_bucket(self, state: Optional[List[float]], now: float) -> Tuple[List[float], bool]:
+        # state: [tokens left, time of the last refill]
+        if state is None:
+            state = [float(self.limit), now]
+        else:
+            refill = (now - state[1]) * self.limit / self.window
+            state[0] = min(float(self.limit), state[0] + refill)
+            state[1] = now
+        if state[0] < 1:
+            return state, False
+        state[0] -= 1
+        return state, True
+
+    def hit(self, key: str, now: Optional[float] = None) -> bool:
+        """
+        Count a request and check the budget.
+
+        Args:
+            key (str):
+                Who made the request, e.g. the client IP.
+            now (Optional[float]):
+                Current time, `time.time()` by default.
+
+        Returns:
+            bool:
+                True if the request fits into the budget.
+                Rejected requests are not counted.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            state = self._states.pop(key, None)
+            if self.algorithm == SLIDING_WINDOW:
+                state, allowed = self._sliding_window(state, now)
+            else:
+                state, allowed = self._token_bucket(state, now)
+            self._states[key] = state
+            if len(self._states) > self.max_keys:
+                self._states.popitem(last=False)
+        return allowed
+
+    def cleanup(self, now: Optional[float] = None) -> int:
+        """
+        Drop keys whose budget is fully restored.
+
+        Returns:
+            int:
+                Number of dropped keys.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            if self.algorithm == SLIDING_WINDOW:
+                current = math.floor(now / self.window)
+                expired = [key for key, state in self._states.items() if state[0] < current - 1]
+            else:
+                expired = [key for key, state in self._states.items() if now - state[1] >= self.window]
+            for key in expired:
+                del self._states[key]
+        return len(expired)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._states.clear()
+
+
+class RateLimitManager:
+    """
+    Global and per-route rate limits of the security config.
+
+    A request to a route with its own budget (the longest
+    matching path prefix in `rate_limit_routes`) is counted
+    against that budget first and then against the global one.
+    """
+
+    def __init__(self, config: object) -> None:
+        """
+        Initialize the RateLimitManager.
+
+        Args:
+            config (SecurityConfig):
+                Configuration object for security settings.
+        """
+        algorithm = config.rate_limit_algorithm
+        max_keys = config.rate_limit_max_keys
+        self.default = RateLimiter(config.rate_limit, config.rate_limit_window, algorithm, max_keys)
+        self.routes: Dict[str, RateLimiter] = {
+            prefix: RateLimiter(limit, window, algorithm, max_keys)
+            for prefix, (limit, window) in config.rate_limit_routes.items()
+        }
+        self._prefixes = sorted(self.routes, key=len, reverse=True)
+
+    def route_for(self, path: str) -> Optional[str]:
+        for prefix in self._prefixes:
+            if path.startswith(prefix):
+                return prefix
+        return None
+
+    def check(self, key: str, path: str, now: Optional[float] = None) -> Optional[str]:
+        """
+        Count a request against its budgets.
+
+        Args:
+            key (str):
+                The client IP.
+            path (str):
+                The request path.
+            now (Optional[float]):
+                Current time, `time.time()` by default.
+
+        Returns:
+            Optional[str]:
+                None if allowed, otherwise the exceeded budget:
+                the route prefix or `"global"`.
+        """
+        route = self.route_for(path)
+        if route is not None and not self.routes[route].hit(key, now):
+            return route
+        if not self.default.hit(key, now):
+            return "global"
+        return None
+
+    def cleanup(self, now: Optional[float] = None) -> int:
+        return sum(limiter.cleanup(now) for limiter in [self.default, *self.routes.values()])
+
+    def reset(self) -> None:
+        for limiter in [self.default, *self.routes.values()]:
+            limiter.reset()
@@ -1,5 +1,70 @@
 import re
-from typing import Any, ClassVar, Optional, List, Set
+from typing import Any, ClassVar, Dict, FrozenSet, Optional, List, Set, Tuple
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # python < 3.11
+    import sre_parse
+
+_FLAGS = re.IGNORECASE | re.MULTILINE
+# a character class is used as a prefilter only if it is this small
+_MAX_CLASS_LITERALS = 8
+# non-ASCII characters that IGNORECASE matches to ASCII letters
+# but str.lower() does not turn into them
+_CASE_FOLDS = str.maketrans({"\u0130": "i", "\u0131": "i", "\u017f": "s", "\u212a": "k"})
+
+
+def _required(items: Any) -> Optional[Set[str]]:
+    """
+    Literals one of which must occur in any match of a parsed
+    sequence, None if no such set can be derived.
+    """
+    best: Optional[Set[str]] = None
+    run = ""
+    candidates = []
+    for op, arg in list(items) + [(None, None)]:
+        if op == sre_parse.LITERAL:
+            run += chr(arg).lower()
+            continue
+        if run:
+            candidates.append({run})
+            run = ""
+        if op is None:
+            break
+        if op == sre_parse.SUBPATTERN:
+            candidates.append(_required(arg[-1]))
+        elif op == sre_parse.BRANCH:
+            branches = [_required(branch) for branch in arg[1]]
+            if all(branch is not None for branch in branches):
+                candidates.append(set().union(*branches))
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and arg[0] >= 1:
+            candidates.append(_required(arg[2]))
+        elif op == sre_parse.IN and len(arg) <= _MAX_CLASS_LITERALS \
+                and all(item_op == sre_parse.LITERAL for item_op, _ in arg):
+            candidates.append({chr(value).lower() for _, value in arg})
+    for candidate in candidates:
+        # the rarer the literals, the more values the prefilter skips
+        if candidate and (best is None or min(map(len, candidate)) > min(map(len, best))):
+            best = candidate
+    return best
+
+
+def required_literals(pattern: str) -> Optional[FrozenSet[str]]:
+    """
+    Lowercase literals one of which every match of
+    the pattern contains, None if they cannot be derived.
+
+    Args:
+        pattern (str): The regex source.
+
+    Returns:
+        Optional[FrozenSet[str]]: The literals or None.
+    """
+    try:
+        literals = _required(sre_parse.parse(pattern, _FLAGS))
+    except Exception:
+        return None
+    return frozenset(literals) if literals else None
 
 
 class SusPatterns:
@@ -115,6 +180,8 @@ class SusPatterns:
     compiled_patterns: List[re.Pattern]
     compiled_custom_patterns: Set[re.Pattern]
     redis_handler: Any = None
+    # patterns indexed by required literals, rebuilt after add/remove
+    _rules: Optional[Tuple[List[re.Pattern], Tuple[str, ...], Dict[str, Tuple[int, ...]], Set[int]]] = None
 
     def __new__(cls) -> "SusPatterns":
         """
@@ -133,6 +200,7 @@ class SusPatterns:
             ]
             cls._instance.compiled_custom_patterns = set()
             cls._instance.redis_handler = None
+            cls._instance._rules = None
         return cls._instance
 
     async def initialize_redis(self, redis_handler: Any) -> None:
@@ -161,6 +229,7 @@ class SusPatterns:
         instance = cls()
 
         compiled_pattern = re.compile(pattern, re.IGNORECASE | re.MULTILINE)
+        instance._rules = None
         if custom:
             instance.compiled_custom_patterns.add(compiled_pattern)
             instance.custom_patterns.add(pattern)
@@ -188,6 +257,7 @@ class SusPatterns:
         instance = cls()
 
         compiled_pattern = re.compile(pattern, re.IGNORECASE | re.MULTILINE)
+        instance._rules = None
         if custom:
             instance.compiled_custom_patterns.discard(compiled_pattern)
             instance.custom_patterns.discard(pattern)
@@ -228,4 +298,62 @@ class SusPatterns:
         """
         instance = cls()
 
-        return instance.compiled_patterns + list(instance.compiled_custom_patterns)
\ No newline at end of file
+        return instance.compiled_patterns + list(instance.compiled_custom_patterns)
+
+    def _compile_rules(self) -> Tuple[List[re.Pattern], Tuple[str, ...], Dict[str, Tuple[int, ...]], Set[int]]:
+        """
+        Index all patterns by the literals they require,
+        so a value is checked with one pass of substring
+        lookups and only the candidate patterns run.
+
+        Returns:
+            Tuple: compiled patterns, all literals,
+            literal -> pattern indices, indices of
+            patterns without literals (always run).
+        """
+        compiled = self.compiled_patterns + sorted(self.compiled_custom_patterns, key=lambda p: p.pattern)
+        by_literal: Dict[str, List[int]] = {}
+        always: Set[int] = set()
+        for index, pattern in enumerate(compiled):
+            literals = required_literals(pattern.pattern)
+            if literals is None:
+                always.add(index)
+                continue
+            for literal in literals:
+                by_literal.setdefault(literal, []).append(index)
+        return (
+            compiled,
+            tuple(by_literal),
+            {literal: tuple(indexes) for literal, indexes in by_literal.items()},
+            always,
+        )
+
+    @classmethod
+    def match(cls, value: str) -> Optional[str]:
+        """
+        Scan a value against all patterns.
+
+        The value is case folded once, the way IGNORECASE
+        folds it; a pattern runs only if one of its
+        required literals occurs in it.
+
+        Args:
+            value (str): The value to scan.
+
+        Returns:
+            Optional[str]: The pattern that matched,
+            None if the value looks clean.
+        """
+        instance = cls()
+        rules = instance._rules
+        if rules is None:
+            rules = instance._rules = instance._compile_rules()
+        compiled, literals, by_literal, always = rules
+        lowered = value.lower() if value.isascii() else value.translate(_CASE_FOLDS).lower()
+        candidates = set(always)
+        for literal in [literal for literal in literals if literal in lowered]:
+            candidates.update(by_literal[literal])
+        for index in sorted(candidates):
+            if compiled[index].search(value):
+                return compiled[index].pattern
+        return None
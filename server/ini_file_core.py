@@ -1,82 +1,211 @@
-import pydantic
 import re
 import os
+import pathlib
 import ipaddress
 import datetime
 from server.schemas import Client, ListClients
 from server.utils import get_file_source
+from server.config_pool import POOL_MARKER
+from server.ip_allocator import IPAllocator
 
-from sqlalchemy.util import counter
 
+def peer_ip(allowed_ips) -> ipaddress.ip_address:
+    '''
+    IP адрес клиента из AllowedIPs (берем первую сеть из списка)
+    '''
+    first_network = str(allowed_ips).split(",")[0].strip()
+    return ipaddress.ip_network(first_network, strict=False).network_address
 
-class BaseModel(pydantic.BaseModel, extra="allow"):
-    _sequence: int = 0
 
-    def model_to_str(self, exclude=["_sequence"]):
-        respond = ""
-        if len([val for val in self]) > len(exclude):
-            respond += f"[{self.__class__.__name__}]\n"
-            for name, value in self:
-                if name not in exclude:
-                    respond += f"{name} = {value}\n"
-            respond += "\n"
-        return respond
+class Section:
+    '''
+    Секция конфига: [Interface], [Peer] ...
+
+    Значения доступны как атрибуты (section.PublicKey) и хранятся в словаре
+    в порядке добавления. Один класс на все секции, тип секции - в name.
+    '''
+    __slots__ = ("name", "_sequence", "_values", "_deleted")
+
+    def __init__(self, name, _sequence=0, **values):
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "_sequence", _sequence)
+        object.__setattr__(self, "_values", dict(values))
+        object.__setattr__(self, "_deleted", False)
+
+    def __getattr__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def __setattr__(self, key, value):
+        if key in Section.__slots__:
+            object.__setattr__(self, key, value)
+        else:
+            self._values[key] = value
+
+    def __iter__(self):
+        return iter(self._values.items())
+
+    def __repr__(self):
+        return f"Section({self.name!r}, {self._values!r})"
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def to_str(self):
+        if not self._values:
+            return ""
+        rows = [] if self.name is None else [f"[{self.name}]"]
+        rows += [f"{name} = {value}" for name, value in self._values.items()]
+        return "\n".join(rows) + "\n\n"
 
 
 class CfgFile:
+    '''
+    Конфиг в формате wireguard (ini).
+
+    Запись инкрементальная: если с момента чтения/записи секции только добавлялись
+    и файл на диске не менялся, новые секции дописываются в конец файла.
+    Удаления копятся и сжимаются при следующей записи полной перезаписью
+    через временный файл + fsync + rename, поэтому падение посреди записи не портит конфиг.
+    Пачка изменений - одна запись на диск.
+    '''
+
     def __init__(self):
         self.cfg = []
-        self.reg_name_sect = re.compile(r"\[(.*?)\]")
-        self.value_sect = re.compile(r"(.*?)=(.*?)$")
         self.max_AllowedIPs = None
         self.file_source = None
+        # секции, добавленные после последнего чтения/записи
+        self._appended = []
+        # количество удаленных, но еще не вычищенных из self.cfg секций
+        self._deleted = 0
+        # (размер, mtime) файла после последнего чтения/записи
+        self._file_stat = None
+        self._max_sequence = 0
 
     def __iter__(self):
         for x in self.cfg:
-            yield x
+            if not x._deleted:
+                yield x
 
     def read_from_file(self, file_name):
         try:
             with open(file_name) as f:
-                lines = [line.rstrip() for line in f]
+                lines = f.read().splitlines()
         except FileNotFoundError as ex:
             lines = []
         except Exception as ex:
             raise ex
         self.file_source = file_name
+        self._file_stat = self._get_file_stat(file_name)
 
-        curr_model = pydantic.create_model("Default", __base__=BaseModel)()
+        # значения до первого заголовка попадают в секцию без имени
+        curr_section = Section(None)
         counter = 0
         for row in lines:
-            group = self.reg_name_sect.search(row)
-            if group:
+            row = row.strip()
+            if row.startswith("[") and row.endswith("]"):
                 counter += 1
-                self.cfg.append(curr_model)
-                name_sect = group.group(1).strip()
-                curr_model = pydantic.create_model(name_sect, __base__=BaseModel)()
-                setattr(curr_model, "_sequence", counter)
+                self.cfg.append(curr_section)
+                curr_section = Section(row[1:-1].strip(), _sequence=counter)
             else:
-                value_re = self.value_sect.search(row)
-                if value_re:
-                    name_value = value_re.group(1).strip()
-                    _value = value_re.group(2).strip()
-                    setattr(curr_model, name_value, _value)
+                name_value, sep, _value = row.partition("=")
+                if sep:
+                    curr_section._values[name_value.strip()] = _value.strip()
 
-        self.cfg.append(curr_model)
+        self.cfg.append(curr_section)
+        self._max_sequence = counter
+
+    def next_sequence(self):
+        self._max_sequence += 1
+        return self._max_sequence
 
     def append_section(self, section):
         self.cfg.append(section)
+        self._appended.append(section)
+        self._max_sequence = max(self._max_sequence, section._sequence)
+
+    def remove_section(self, section):
+        '''
+        Секция помечается удаленной, из списка она вычищается при записи
+        '''
+        if section._deleted:
+            return
+        section._deleted = True
+        self._deleted += 1
 
     def get_len(self):
-        return len(self.cfg)
+        return len(self.cfg) - self._deleted
 
-    def write(self, file_name):
-        rows = sorted(self.cfg, key=lambda x: x._sequence)
-        res = ""
-        for row in rows:
-            res += row.model_to_str()
-        with open(file_name, "w") as f:
-            f.write(res)
+    @staticmethod
+    def _get_file_stat(file_name):
+        try:
+            stat = os.stat(file_name)
+        except FileNotFoundError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def _can_append(self, file_name) -> bool:
+        return (self._deleted == 0
+                and file_name == self.file_source
+                and self._file_stat is not None
+                and self._get_file_stat(file_name) == self._file_stat)
+
+    def _append_to_file(self, file_name, fsync=True):
+        res = "".join(row.to_str() for row in self._appended)
+        with open(file_name, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() >= 2:
+                # файл мог быть создан не нами и не заканчиваться пустой строкой
+                f.seek(-2, os.SEEK_END)
+                tail = f.read(2)
+                if tail != b"\n\n":
+                    res = ("\n" if tail.endswith(b"\n") else "\n\n") + res
+            f.write(res.encode())
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+
+    def _rewrite_file(self, file_name, fsync=True):
+        rows = sorted(self, key=lambda x: x._sequence)
+        res = "".join(row.to_str() for row in rows)
+        folder = os.path.dirname(os.path.abspath(file_name))
+        tmp_file = os.path.join(folder, f".{os.path.basename(file_name)}.tmp")
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(res)
+                f.flush()
+                if fsync:
+                    os.fsync(f.fileno())
+            os.replace(tmp_file, file_name)
+        except Exception:
+            pathlib.Path(tmp_file).unlink(missing_ok=True)
+            raise
+        if fsync:
+            dir_fd = os.open(folder, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def write(self, file_name, fsync=True):
+        '''
+        Сохраняем конфиг: дописываем новые секции или перезаписываем файл целиком
+        :param fsync: дожидаться записи на диск
+        '''
+        if self._can_append(file_name):
+            if self._appended:
+                self._append_to_file(file_name, fsync=fsync)
+        else:
+            self._rewrite_file(file_name, fsync=fsync)
+        if file_name == self.file_source:
+            self._file_stat = self._get_file_stat(file_name)
+            self._appended = []
+            if self._deleted:
+                self.cfg = [section for section in self.cfg if not section._deleted]
+                self._deleted = 0
 
 
 class ServerConfig:
@@ -86,10 +215,14 @@ class ServerConfig:
         self.conf_file.read_from_file(serv_conf)
         self.max_AllowedIPs = None
         self.file_source = None
+        self.ip_allocator = None
+        # PublicKey -> секция Peer
+        self.peers = {row.PublicKey: row for row in self.conf_file
+                      if row.name == "Peer" and row.get("PublicKey")}
 
     def get_max_peer_network(self):
-        for row in self.conf_file.cfg:
-            if row.__class__.__name__ == "Peer" and getattr(row, "AllowedIPs"):
+        for row in self.conf_file:
+            if row.name == "Peer" and row.get("AllowedIPs"):
                 if self.max_AllowedIPs:
                     self.max_AllowedIPs = max(ipaddress.ip_network(getattr(row, "AllowedIPs")), self.max_AllowedIPs)
                 else:
@@ -106,35 +239,54 @@ class ServerConfig:
             pass
 
     def delete_peer(self, peer):
-        for row in self.conf_file:
-            if row.__class__.__name__ == "Peer":
-                if row.PublicKey == peer.pub_key:
-                    self.conf_file.cfg.remove(row)
-                    break
+        row = self.peers.pop(peer.pub_key, None)
+        if row is not None:
+            self.conf_file.remove_section(row)
+            if self.ip_allocator and row.get("AllowedIPs"):
+                self.ip_allocator.release(peer_ip(row.AllowedIPs))
         # else:
         #    raise Exception("Такой Peer не найден в конфиге")
-        self.conf_file.write(self.serv_conf)
+        # на диск попадет при следующем write() - одна запись на всю пачку удалений
 
     def append_peer(self, peer):
-        for row in self.conf_file:
-            if row.__class__.__name__ == "Peer":
-                if row.PublicKey == peer.PublicKey:
-                    raise Exception("Такой Peer уже существует в конфиге")
+        if peer.PublicKey in self.peers:
+            raise Exception("Такой Peer уже существует в конфиге")
         if not peer._sequence:
-            peer._sequence = self.conf_file.get_len()
+            peer._sequence = self.conf_file.next_sequence()
         self.conf_file.append_section(peer)
+        self.peers[peer.PublicKey] = peer
+        if self.ip_allocator and peer.get("AllowedIPs"):
+            self.ip_allocator.reserve(peer_ip(peer.AllowedIPs))
 
     def write(self, file_name=None):
 
         if not file_name:
             file_name = self.serv_conf
         self.conf_file.write(file_name)
+        if self.ip_allocator:
+            if file_name == self.serv_conf:
+                # состояние выдачи снова соответствует файлу
+                self.ip_allocator.source_stat = self.conf_file._file_stat
+            self.ip_allocator.save()
+
+    def get_ip_allocator(self) -> IPAllocator:
+        '''
+        Выдача IP адресов клиентам. Одна на файл конфига сервера,
+        состояние хранится рядом с конфигом сервера
+        '''
+        if self.ip_allocator is None:
+            if self.serv_conf:
+                state_file = os.path.join(os.path.dirname(self.serv_conf), "ip_allocator.json")
+                self.ip_allocator = IPAllocator.shared(self, state_file=state_file)
+            else:
+                self.ip_allocator = IPAllocator.from_server_config(self)
+        return self.ip_allocator
 
     def get_section(self, name, numb=None):
         res = []
         count = 0
         for section in self.conf_file:
-            if section.__class__.__name__ == name:
+            if section.name == name:
                 if count == numb:
                     res.append(section)
                 count += 1
@@ -147,9 +299,9 @@ class ServerConfig:
         '''
         ip_adress = None
         for row in self.conf_file:
-            if row.__class__.__name__ == "Interface":
-                if getattr(row, "Address"):
-                    network_adress = getattr(row, "Address")
+            if row.name == "Interface":
+                if row.get("Address"):
+                    network_adress = row.Address
                     ip_adress = network_adress.split("/")[0]
         return ip_adress
 
@@ -160,9 +312,9 @@ class ServerConfig:
         '''
         network_adress = None
         for row in self.conf_file:
-            if row.__class__.__name__ == "Interface":
-                if getattr(row, "Address"):
-                    network_adress = ipaddress.ip_network(getattr(row, "Address"), strict=False)
+            if row.name == "Interface":
+                if row.get("Address"):
+                    network_adress = ipaddress.ip_network(row.Address, strict=False)
 
         return network_adress
 
@@ -172,11 +324,9 @@ class ServerConfig:
         :return: список IP адресов клиентов
         '''
         ip_list = []
-        for row in self.conf_file:
-            if row.__class__.__name__ == "Peer":
-                if getattr(row, "AllowedIPs"):
-                    ip_addr = ipaddress.ip_network(getattr(row, "AllowedIPs")).hosts()[0]
-                    ip_list.append(ipaddress.ip_address(ip_addr))
+        for row in self.peers.values():
+            if row.get("AllowedIPs"):
+                ip_list.append(peer_ip(row.AllowedIPs))
         return ip_list
 
 
@@ -188,21 +338,22 @@ class ClientConfig:
 
     def append_section(self, section):
         if not section._sequence:
-            section._sequence = self.conf_file.get_len()
+            section._sequence = self.conf_file.next_sequence()
         self.conf_file.append_section(section)
 
     def get_section(self, name, numb=None):
         res = []
         count = 0
         for section in self.conf_file:
-            if section.__class__.__name__ == name:
+            if section.name == name:
                 if count == numb:
                     res.append(section)
                 count += 1
         return res
 
     def write(self, file_name):
-        self.conf_file.write(file_name)
+        # конфиг клиента можно перегенерировать, ждать fsync на каждом не нужно
+        self.conf_file.write(file_name, fsync=False)
 
 
 class Clients:
@@ -213,6 +364,38 @@ class Clients:
         pass
 
 
+def client_scan(client_folder, files=None):
+    '''
+    Клиент по его папке
+    :param files: список файлов папки, если уже получен
+    :return: Client или None если папки нет
+    '''
+    try:
+        created_dt = os.stat(client_folder).st_ctime
+        if files is None:
+            files = [entry.name for entry in os.scandir(client_folder) if entry.is_file()]
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    client = Client(name=os.path.basename(client_folder),
+                    conf_created=datetime.datetime.fromtimestamp(created_dt),
+                    )
+    files_list = [os.path.splitext(file_) for file_ in files]
+    for file_ in files_list:
+        if ".conf" in file_[1]:
+            client.cfg_file = os.path.join(client_folder, file_[0] + file_[1])
+            client.path_to_cfg = client_folder
+        if ".lock" in file_[1]:
+            client.used = True
+        if file_[0] + file_[1] == POOL_MARKER:
+            client.pooled = True
+        if ".pub" in file_[1]:
+            try:
+                client.pub_key = get_file_source(os.path.join(client_folder, file_[0] + file_[1]))
+            except FileNotFoundError:
+                pass
+    return client
+
+
 def clients_scan(directory="/etc/wireguard/clients"):
     list_clients = ListClients()
     tree = list(os.walk(directory))
@@ -220,19 +403,7 @@ def clients_scan(directory="/etc/wireguard/clients"):
         if row[0] == directory:
             pass
         else:
-            subdirname = row[0].split("/")[-1]
-            created_dt = os.stat(row[0]).st_ctime
-            client = Client(name=subdirname,
-                            conf_created = datetime.datetime.fromtimestamp(created_dt),
-                            )
-            files_list = [os.path.splitext(file_) for file_ in row[2]]
-            for file_ in files_list:
-                if ".conf" in file_[1]:
-                    client.cfg_file = os.path.join(row[0], file_[0] + file_[1])
-                    client.path_to_cfg = row[0]
-                if ".lock" in file_[1]:
-                    client.used = True
-                if ".pub" in file_[1]:
-                    client.pub_key = get_file_source(os.path.join(row[0], file_[0] + file_[1]))
-            list_clients.clients.append(client)
+            client = client_scan(row[0], row[2])
+            if client is not None:
+                list_clients.clients.append(client)
     return list_clients
@@ -0,0 +1,199 @@
+import ipaddress
+import json
+import logging
+import os
+import pathlib
+import threading
+from typing import Dict, Iterable, Optional
+
+# один экземпляр на конфиг сервера: путь к wg0.conf -> IPAllocator
+_shared: Dict[str, "IPAllocator"] = {}
+_shared_lock = threading.Lock()
+
+
+class IPAllocator:
+    '''
+    Выдача IP адресов клиентам из сети сервера.
+
+    Адреса не перебираются: всё что не ниже курсора ни разу не выдавалось,
+    освобожденные адреса ниже курсора лежат в free-list, занятые - в множестве.
+    Поэтому allocate/release/reserve работают за O(1) амортизированно,
+    а память зависит от количества клиентов, а не от размера сети (/16, /8, IPv6).
+    '''
+
+    def __init__(self, network, state_file: Optional[str] = None):
+        self.network = ipaddress.ip_network(str(network), strict=False)
+        self.state_file = state_file
+        if self.network.num_addresses > 2:
+            self._first = int(self.network.network_address) + 1
+            self._last = int(self.network.broadcast_address) - 1
+        else:
+            # /31 и /32 - все адреса рабочие
+            self._first = int(self.network.network_address)
+            self._last = int(self.network.broadcast_address)
+        self._cursor = self._first
+        self._free = []
+        self._used = set()
+        # (размер, mtime) wg0.conf, которому соответствует состояние; None - состояние менялось после
+        self.source_stat = None
+
+    def __len__(self):
+        return len(self._used)
+
+    def _to_int(self, ip) -> Optional[int]:
+        ip_int = int(ipaddress.ip_address(str(ip).split("/")[0]))
+        if self._first <= ip_int <= self._last:
+            return ip_int
+        return None
+
+    def _to_address(self, ip_int: int):
+        return ipaddress.ip_address(ip_int)
+
+    def allocate(self):
+        '''
+        Выдаем свободный IP адрес
+        :return: IP адрес
+        '''
+        self.source_stat = None
+        while self._free:
+            ip_int = self._free.pop()
+            # адрес мог быть зарезервирован после освобождения
+            if ip_int not in self._used:
+                self._used.add(ip_int)
+                return self._to_address(ip_int)
+        while self._cursor <= self._last:
+            ip_int = self._cursor
+            self._cursor += 1
+            if ip_int not in self._used:
+                self._used.add(ip_int)
+                return self._to_address(ip_int)
+        raise Exception("no free IPs")
+
+    def reserve(self, ip) -> bool:
+        '''
+        Помечаем адрес занятым (адрес сервера, уже существующие клиенты)
+        :return: False если адрес не из сети сервера
+        '''
+        ip_int = self._to_int(ip)
+        if ip_int is None:
+            return False
+        self._used.add(ip_int)
+        self.source_stat = None
+        return True
+
+    def release(self, ip) -> bool:
+        '''
+        Возвращаем адрес в пул свободных
+        :return: False если адрес не был занят
+        '''
+        ip_int = self._to_int(ip)
+        if ip_int is None or ip_int not in self._used:
+            return False
+        self.source_stat = None
+        self._used.discard(ip_int)
+        if ip_int < self._cursor:
+            self._free.append(ip_int)
+        return True
+
+    def is_used(self, ip) -> bool:
+        ip_int = self._to_int(ip)
+        return ip_int is not None and ip_int in self._used
+
+    def sync(self, used_ips: Iterable):
+        '''
+        Приводим состояние в соответствие со списком реально занятых адресов.
+        Если какие-то адреса ниже курсора потерялись (клиента удалили из wg0.conf руками),
+        пересобираем free-list, перебирая только уже выданный диапазон.
+        '''
+        self._used = set()
+        for ip in used_ips:
+            self.reserve(ip)
+        self._cursor = max([self._cursor] + [ip_int + 1 for ip_int in self._used])
+        self._free = [ip_int for ip_int in dict.fromkeys(self._free)
+                      if ip_int < self._cursor and ip_int not in self._used]
+        used_below = sum(1 for ip_int in self._used if ip_int < self._cursor)
+        if used_below + len(self._free) != self._cursor - self._first:
+            free = set(self._free)
+            self._free = [ip_int for ip_int in range(self._cursor - 1, self._first - 1, -1)
+                          if ip_int not in self._used and ip_int not in free] + self._free
+
+    def save(self, state_file: Optional[str] = None):
+        state_file = state_file or self.state_file
+        if not state_file:
+            return
+        state = {"network": str(self.network),
+                 "cursor": self._cursor,
+                 "free": self._free,
+                 "used": sorted(self._used),
+                 }
+        # как CfgFile._rewrite_file: после сбоя остается либо старое, либо новое состояние целиком
+        folder = os.path.dirname(os.path.abspath(state_file))
+        tmp_file = os.path.join(folder, f".{os.path.basename(state_file)}.tmp")
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, state_file)
+        except Exception:
+            pathlib.Path(tmp_file).unlink(missing_ok=True)
+            raise
+        dir_fd = os.open(folder, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def load(self, state_file: Optional[str] = None) -> bool:
+        '''
+        Загружаем сохраненное состояние
+        :return: True если состояние загружено и относится к этой же сети
+        '''
+        state_file = state_file or self.state_file
+        if not state_file or not os.path.exists(state_file):
+            return False
+        try:
+            with open(state_file) as f:
+                state = json.load(f)
+            if state.get("network") != str(self.network):
+                return False
+            self._cursor = min(max(int(state["cursor"]), self._first), self._last + 1)
+            self._free = [int(ip_int) for ip_int in state.get("free", [])]
+            self._used = set(int(ip_int) for ip_int in state.get("used", []))
+        except Exception as ex:
+            logging.warning(f"не удалось прочитать состояние выдачи IP {state_file}: {ex}")
+            return False
+        return True
+
+    @classmethod
+    def from_server_config(cls, srv_cfg_file, state_file: Optional[str] = None) -> "IPAllocator":
+        '''
+        Строим выдачу IP по конфигу сервера: адрес сервера и адреса всех Peer заняты
+        '''
+        allocator = cls(srv_cfg_file.get_serv_network(), state_file=state_file)
+        allocator.load()
+        allocator.sync_server_config(srv_cfg_file)
+        return allocator
+
+    def sync_server_config(self, srv_cfg_file):
+        used_ips = srv_cfg_file.get_all_clients_ips()
+        used_ips.append(srv_cfg_file.get_serv_ip())
+        self.sync(used_ips)
+        self.source_stat = srv_cfg_file.conf_file._file_stat
+
+    @classmethod
+    def shared(cls, srv_cfg_file, state_file: Optional[str] = None) -> "IPAllocator":
+        '''
+        Выдача IP для конфига сервера, одна на файл wg0.conf на весь процесс.
+        Пересверяется с конфигом, только если файл изменился не через нее
+        (правка руками, удаление без выдачи IP) или ее состояние не было сохранено
+        '''
+        key = os.path.abspath(srv_cfg_file.serv_conf)
+        with _shared_lock:
+            allocator = _shared.get(key)
+            if allocator is None or str(allocator.network) != str(srv_cfg_file.get_serv_network()):
+                allocator = _shared[key] = cls.from_server_config(srv_cfg_file, state_file=state_file)
+            elif allocator.source_stat is None or allocator.source_stat != srv_cfg_file.conf_file._file_stat:
+                allocator.sync_server_config(srv_cfg_file)
+        return allocator
@@ -0,0 +1,111 @@
+import base64
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+try:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+except ImportError:  # pragma: no cover - без cryptography считаем на чистом python
+    X25519PrivateKey = None
+
+# параметры Curve25519 из RFC 7748
+_P = 2 ** 255 - 19
+_A24 = 121665
+_BASE_POINT = 9
+
+# пачки меньше этого размера быстрее посчитать в текущем процессе
+_MIN_CHUNK = 256
+
+
+def _clamp(priv: bytes) -> bytes:
+    '''
+    Clamp приватного ключа, как это делает `wg genkey`
+    '''
+    key = bytearray(priv)
+    key[0] &= 248
+    key[31] = (key[31] & 127) | 64
+    return bytes(key)
+
+
+def _x25519_base(priv: bytes) -> bytes:
+    '''
+    Умножение базовой точки на скаляр (montgomery ladder из RFC 7748)
+    '''
+    k = int.from_bytes(_clamp(priv), "little")
+    x_1 = _BASE_POINT
+    x_2, z_2, x_3, z_3 = 1, 0, x_1, 1
+    swap = 0
+    for t in reversed(range(255)):
+        k_t = (k >> t) & 1
+        swap ^= k_t
+        if swap:
+            x_2, x_3, z_2, z_3 = x_3, x_2, z_3, z_2
+        swap = k_t
+        a = (x_2 + z_2) % _P
+        aa = a * a % _P
+        b = (x_2 - z_2) % _P
+        bb = b * b % _P
+        e = (aa - bb) % _P
+        c = (x_3 + z_3) % _P
+        d = (x_3 - z_3) % _P
+        da = d * a % _P
+        cb = c * b % _P
+        x_3 = (da + cb) ** 2 % _P
+        z_3 = x_1 * (da - cb) ** 2 % _P
+        x_2 = aa * bb % _P
+        z_2 = e * (aa + _A24 * e) % _P
+    if swap:
+        x_2, z_2 = x_3, z_3
+    return (x_2 * pow(z_2, _P - 2, _P) % _P).to_bytes(32, "little")
+
+
+def public_key(priv_key: str) -> str:
+    '''
+    Аналог `wg pubkey`
+    :param priv_key: приватный ключ в base64
+    :return: публичный ключ в base64
+    '''
+    priv = base64.b64decode(priv_key)
+    if X25519PrivateKey is not None:
+        pub = X25519PrivateKey.from_private_bytes(priv).public_key().public_bytes(
+            encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+    else:
+        pub = _x25519_base(priv)
+    return base64.b64encode(pub).decode()
+
+
+def gen_keypair() -> Tuple[str, str]:
+    '''
+    Аналог `wg genkey | tee client.key | wg pubkey`
+    :return: (приватный ключ, публичный ключ) в base64
+    '''
+    priv = _clamp(os.urandom(32))
+    priv_key = base64.b64encode(priv).decode()
+    return priv_key, public_key(priv_key)
+
+
+def _gen_chunk(count: int) -> List[Tuple[str, str]]:
+    return [gen_keypair() for _ in range(count)]
+
+
+def gen_keypairs(count: int, workers: Optional[int] = None) -> List[Tuple[str, str]]:
+    '''
+    Генерируем пачку ключей без запуска внешних процессов.
+    :param count: количество пар ключей
+    :param workers: количество процессов для генерации. None или 1 - в текущем процессе.
+        Имеет смысл только без cryptography, когда ключи считаются на чистом python
+    :return: список пар (приватный ключ, публичный ключ) в base64
+    '''
+    if count <= 0:
+        return []
+    if not workers or workers <= 1 or count < _MIN_CHUNK * 2:
+        return _gen_chunk(count)
+
+    chunk = max(_MIN_CHUNK, -(-count // workers))
+    sizes = [min(chunk, count - start) for start in range(0, count, chunk)]
+    keypairs = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for part in executor.map(_gen_chunk, sizes):
+            keypairs.extend(part)
+    return keypairs
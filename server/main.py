@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import pathlib
 from contextlib import asynccontextmanager
@@ -11,8 +12,8 @@ import io
 from typing import Optional
 from sqlmodel import Session, SQLModel, create_engine, select, column
 from typing import List
-from fastapi import Depends, FastAPI, HTTPException, BackgroundTasks, Request, UploadFile
-from fastapi.responses import PlainTextResponse
+from fastapi import Depends, FastAPI, HTTPException, BackgroundTasks, Request, UploadFile, Query
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import RedirectResponse, FileResponse, Response
 from fastapi_utils.tasks import repeat_every
@@ -23,15 +24,28 @@ from server.models import Type_IP_List, IPListAccess
 from server.schemas import IP_List_Response, IP_List_Query, IP_List_Update, List_IP_List_Update, \
     List_IP_List_Update_response
 from server.schemas import ListClients, Client, ListClientsWithTotal, AccessListResponse
+from server.schemas import StatisticClient, StatisticClientPage, PeerTraffic, TrafficAggregate
 from server.handlers.midleware import SecurityMiddleware
+from server.handlers.cidr_handler import access_list_manager
 from server.wireguard_users import gen_users
 from server.utils import get_file_source, run_system_command, get_ip_next_server_config
-from server.utils import remove_client
-from server.user_statistics import status
+from server.utils import remove_client, ip_search_ranges
+from server.user_statistics import status_records
+from server.status_cache import StatusCache
+from server.traffic_store import TrafficStore, parse_range
+from server.status_stream import StatusStream
 from server.ini_file_core import clients_scan, ServerConfig, ClientConfig
+from server.client_registry import ClientRegistry
+from server.clients_watcher import ClientsWatcher
+from server.config_pool import ConfigPool, POOL_MARKER
+from server.wg_peers import PeerBatch
+from server.bulk_export import BULK_FORMATS, iter_bulk
+from server.provisioning import ProvisioningExecutor, ProvisioningTimeout
+from server.qr_render import QRCache, QR_FORMATS
+from server import metrics
 import ipaddress
 import datetime
-from sqlalchemy import func
+from sqlalchemy import func, and_, or_
 
 logging.basicConfig(
     level=logging.INFO,
@@ -59,6 +73,12 @@ engine = create_engine(sqlite_url, connect_args=connect_args)
 
 SQLModel.metadata.create_all(engine)
 
+# реестр клиентов вместо обхода папки clients на каждый запрос
+client_registry = ClientRegistry(engine, clients_folder="/etc/wireguard/clients", logger=logger)
+# ручные правки в папке клиентов и wg0.conf попадают в реестр по событиям inotify
+clients_watcher = ClientsWatcher(client_registry, cfg_folder="/etc/wireguard",
+                                 wg0_file="/etc/wireguard/wg0.conf", logger=logger)
+
 
 def get_session():
     with Session(engine) as session:
@@ -72,8 +92,11 @@ def get_ip_list(type_ip: Type_IP_List):
         results = session.exec(statement)
         for row in results.all():
             try:
-                if ipaddress.ip_address(row.ip_addr):
-                    ip_list.add(row.ip_addr)
+                # адрес или сеть CIDR, в одном виде, чтобы не было дублей
+                if "/" in row.ip_addr:
+                    ip_list.add(str(ipaddress.ip_network(row.ip_addr.strip(), strict=False)))
+                else:
+                    ip_list.add(str(ipaddress.ip_address(row.ip_addr.strip())))
             except Exception as ex:
                 logger.warning(f"ошибка преобразования в IP - id:'{row.id}' IP:'{row.ip_addr}'")
     return [ip for ip in ip_list]
@@ -85,17 +108,41 @@ async def remove_expired_tokens_task(created_but_not_used_minutes=5):
     Удаляем токены которые не использовались более 10 минут
     created_but_not_used_minutes  - время в минутах
     :return:'''
+    # работа с файлами и wg блокирующая - выполняем в пуле потоков, в очереди с генерацией
+    with metrics.cleanup_seconds.time():
+        await provisioning.run_locked(remove_expired_clients, created_but_not_used_minutes)
+
+
+def current_created(client_name: str, client_folder: str) -> datetime.datetime:
+    '''
+    Время создания (выдачи) конфига на момент проверки. В снимке статуса оно могло устареть:
+    конфиг, только что выданный из пула, был бы удален по времени генерации.
+    Берем позднее из реестра и ctime папки (меняется при снятии маркера пула)
+    '''
+    created = datetime.datetime.fromtimestamp(os.stat(client_folder).st_ctime)
+    client = client_registry.get(client_name)
+    if client is not None and client.conf_created and client.conf_created > created:
+        created = client.conf_created
+    return created
+
+
+def remove_expired_clients(created_but_not_used_minutes=5):
     wg0_file = '/etc/wireguard/wg0.conf'
     wg_iface = 'wg0'  # wireguard interface
 
-    status_list = status(logger, wg_iface, wg0_file)
+    status_list = status_cache.get().records
     srv_cfg_file = ServerConfig(wg0_file)
+    peer_batch = PeerBatch(wg_iface, logger=logger)
+    removed = []
 
-    for client in status_list.clients:
+    for client in status_list:
         if not client.is_online:
             pub_key = client.pub_key
             client_folder = os.path.join("/etc/wireguard/clients", client.name) if client.name else None
             if client_folder and os.path.exists(client_folder):
+                # конфиги из пула еще никому не выданы, их не трогаем
+                if os.path.exists(os.path.join(client_folder, POOL_MARKER)):
+                    continue
                 # проверяем есть ли файл блокировки
                 lock_file = None
                 for file in os.listdir(client_folder):
@@ -106,11 +153,12 @@ async def remove_expired_tokens_task(created_but_not_used_minutes=5):
                     logger.info(f"АВТОЧИСТКА. Файл блокировки {lock_file} существует. Конфиг {client.name} не удален")
                     continue
                 # проверяем дату создания конфигурации. если не прошло 10 минут то не удаляем
-                if client.conf_created:
-                    logger.info(f"АВТОЧИСТКА. Конфиг {client.name} был создан {client.conf_created}")
+                conf_created = current_created(client.name, client_folder)
+                if conf_created:
+                    logger.info(f"АВТОЧИСТКА. Конфиг {client.name} был создан {conf_created}")
                     ff = datetime.datetime.now() - datetime.timedelta(minutes=created_but_not_used_minutes)
-                    logger.info(f"АВТОЧИСТКА. Конфиг {client.name} был создан ---- {client.conf_created} - {ff}")
-                    if client.conf_created < datetime.datetime.now() - datetime.timedelta(
+                    logger.info(f"АВТОЧИСТКА. Конфиг {client.name} был создан ---- {conf_created} - {ff}")
+                    if conf_created < datetime.datetime.now() - datetime.timedelta(
                             minutes=created_but_not_used_minutes):
                         logger.info(
                             f"АВТОЧИСТКА. Конфиг {client.name} был создан но не использовался более {created_but_not_used_minutes} минут")
@@ -120,21 +168,61 @@ async def remove_expired_tokens_task(created_but_not_used_minutes=5):
                             f"АВТОЧИСТКА. Конфиг {client.name} был создан но не истек срок {created_but_not_used_minutes} минут")
                         continue
 
-                remove_client(client, logger=logger, srv_cfg_file=srv_cfg_file)
+                remove_client(client, logger=logger, srv_cfg_file=srv_cfg_file, peer_batch=peer_batch)
+                removed.append(pub_key)
                 logger.info(f"АВТОЧИСТКА. Конфиг {client.name} удален")
             else:
 
                 logger.info(f"АВТОЧИСТКА. Конфиг для {pub_key} не найден")
-                remove_client(client, logger=logger, srv_cfg_file=srv_cfg_file)
+                remove_client(client, logger=logger, srv_cfg_file=srv_cfg_file, peer_batch=peer_batch)
+                removed.append(pub_key)
                 logger.info(f"АВТОЧИСТКА. {pub_key} с сервера удален")
 
+    srv_cfg_file.write()
+    client_registry.remove_many(pub_keys=removed)
+    peer_batch.apply()
+    if removed:
+        metrics.cleanup_removed_total.inc(len(removed))
+        status_cache.invalidate()
+
+
+@repeat_every(seconds=30)
+async def refill_config_pool_task():
+    '''
+    Пополняем пул готовых конфигов если он опустился ниже нижней границы
+    '''
+    config_pool.schedule_refill()
+
+
+@repeat_every(seconds=int(os.getenv("WG_TRAFFIC_STEP", 60)))
+async def sample_traffic_task():
+    '''
+    Записываем приращение трафика peers с прошлой выборки
+    '''
+    snapshot = await status_cache.aget()
+    if snapshot.failed:
+        # без выборки peers не должны считаться пропавшими
+        return
+    await asyncio.to_thread(traffic_store.record, snapshot.records)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    watcher_stop = asyncio.Event()
+    watcher_task = asyncio.create_task(clients_watcher.run(watcher_stop))
+    # ручные правки, сделанные при остановленном сервисе
+    await asyncio.to_thread(clients_watcher.full_rescan)
     # create remove task by scheduller
     await remove_expired_tokens_task()
+    config_pool.load()
+    await refill_config_pool_task()
+    await sample_traffic_task()
     yield
     # do any on finish
+    await status_stream.close()
+    watcher_stop.set()
+    await watcher_task
+    provisioning.shutdown()
 
 
 description = """
@@ -178,6 +266,8 @@ config = SecurityConfig(
     # Rate Limiting
     rate_limit=1000,
     rate_limit_window=1000,
+    # выдача конфигов - отдельный, более жесткий лимит на IP
+    rate_limit_routes={"/get-wire": (int(os.getenv("WG_GET_WIRE_RATE_LIMIT", 60)), 60)},
     # Auto-ban Configuration
     enable_ip_banning=True,
     enable_penetration_detection=False,
@@ -196,6 +286,59 @@ config = SecurityConfig(
 )
 
 app.add_middleware(SecurityMiddleware, config=config)
+access_list_manager.load(config)
+
+
+def reload_whitelist():
+    '''
+    Перечитываем whitelist из базы и пересобираем проверку IP.
+    Запросы видят либо старый, либо новый список целиком
+    '''
+    config.whitelist = get_ip_list(Type_IP_List.whitelist)
+    app.state.whitelist_list = config.whitelist
+    access_list_manager.load(config)
+
+# генерация и удаление клиентов - в пуле потоков, изменения wg0.conf строго по одному
+provisioning = ProvisioningExecutor(max_workers=int(os.getenv("WG_PROVISIONING_WORKERS", 4)), logger=logger)
+
+# общий снимок статуса peers: дашборд, удаление и автоочистка не читают интерфейс каждый сам по себе
+status_cache = StatusCache(
+    loader=lambda: status_records(logger, 'wg0', '/etc/wireguard/wg0.conf', client_registry, raise_errors=True),
+    ttl=float(os.getenv("WG_STATUS_TTL", 2)),
+    logger=logger,
+)
+# любое изменение реестра (генерация, удаление, выдача из пула, ручные правки) сбрасывает снимок
+client_registry.on_change = status_cache.invalidate
+
+# изменения статуса для открытых страниц статистики, одно обновление снимка на всех
+status_stream = StatusStream(status_cache, interval=float(os.getenv("WG_STREAM_INTERVAL", 5)), logger=logger,
+                             counters_interval=float(os.getenv("WG_STREAM_COUNTERS_INTERVAL", 30)))
+
+# история трафика peers по выборкам из снимка статуса
+traffic_store = TrafficStore()
+
+# кеш QR кодов конфигов
+qr_cache = QRCache(max_bytes=int(os.getenv("WG_QR_CACHE_MB", 32)) * 1024 * 1024, logger=logger)
+
+
+def on_pool_ready(cfg_files):
+    client_registry.mark_pooled(cfg_files)
+    # QR коды для пула рисуем сразу в потоке пополнения, а не в запросе
+    qr_cache.prerender(cfg_files)
+
+
+# пул заранее сгенерированных конфигов для /get-wire
+config_pool = ConfigPool(
+    generator=lambda number: gen_wireguard_users(number_clients=number),
+    clients_folder="/etc/wireguard/clients",
+    low_watermark=int(os.getenv("WG_POOL_LOW", 10)),
+    high_watermark=int(os.getenv("WG_POOL_HIGH", 50)),
+    executor=provisioning.executor,
+    on_ready=on_pool_ready,
+    # время выдачи пишем до снятия маркера, иначе автоочистка увидит старое время создания
+    on_claim=client_registry.mark_claimed,
+    logger=logger,
+)
 
 
 @app.get("/", include_in_schema=False)
@@ -212,6 +355,31 @@ def ping_pong():
     return "pong"
 
 
+def render_metrics(snapshot, total_: int, used_: int) -> str:
+    lines = metrics.registry.render()
+    lines += metrics.render_peers(snapshot.records)
+    lines += metrics.render_gauge("wg_clients", "Конфиги клиентов в реестре", [(("total",), total_), (("used",), used_),
+                                                                              (("free",), total_ - used_)],
+                                  labels=("state",))
+    lines += metrics.render_gauge("wg_config_pool_size", "Готовые конфиги в пуле", [((), len(config_pool))])
+    lines += metrics.render_gauge("wg_provisioning_waiting", "Операции в очереди на критическую секцию",
+                                  [((), provisioning.waiting)])
+    lines += metrics.render_gauge("wg_status_snapshot_age_seconds", "Возраст снимка статуса peers",
+                                  [((), round(snapshot.age, 3))])
+    return "\n".join(lines) + "\n"
+
+
+@app.get("/metrics", response_class=PlainTextResponse, tags=["work"],
+         description="""Метрики в формате Prometheus. Peers берутся из общего снимка статуса не старше
+         WG_METRICS_MAX_AGE секунд (по умолчанию 60), отдельного чтения интерфейса на каждый сбор нет""",
+         name="Метрики Prometheus")
+async def prometheus_metrics():
+    snapshot = await status_cache.aget(max_age=float(os.getenv("WG_METRICS_MAX_AGE", 60)))
+    total_, used_ = await asyncio.to_thread(client_registry.counts)
+    body = await asyncio.to_thread(render_metrics, snapshot, total_, used_)
+    return PlainTextResponse(body, media_type=metrics.CONTENT_TYPE)
+
+
 @app.get("/access", response_class=HTMLResponse, include_in_schema=False)
 async def read_item(request: Request):
     return templates.TemplateResponse(
@@ -225,6 +393,21 @@ async def favicon():
     return FileResponse("server/static/favicon.ico")
 
 
+async def claim_config() -> Optional[str]:
+    '''
+    Забираем свободный конфиг из пула, а если пул пуст - генерируем на лету
+    :return: путь к client.conf
+    '''
+    cfg_file_ = await asyncio.to_thread(config_pool.claim)
+    config_pool.schedule_refill()
+    if not cfg_file_:
+        # пул пуст - генерируем конфиг на лету
+        new_user_cfg = await provisioning.run(gen_wireguard_users, number_clients=1)
+        if new_user_cfg:
+            cfg_file_ = new_user_cfg[0]
+    return cfg_file_
+
+
 @app.get("/get-wire", response_class=PlainTextResponse,
          tags=["work"],
          description="""Возвращает свободный конфиг и маркирует его как выданный. при следующем запросе выдаст новый
@@ -237,12 +420,9 @@ async def favicon():
          name="Получить свободный конфиг"
          )
 async def get_wire(response: Response):
-    new_user_cfg = gen_wireguard_users(number_clients=1)
     file_cnt = None
-    # print(new_user_cfg)
-    if new_user_cfg:
-        cfg_file_ = new_user_cfg[0]
-        # print(cfg_file_)
+    cfg_file_ = await claim_config()
+    if cfg_file_:
         file_cnt = get_file_source(cfg_file_)
     if file_cnt:
         return file_cnt
@@ -251,6 +431,97 @@ async def get_wire(response: Response):
         return {"message": "no_serts_available"}
 
 
+def stream_bulk(cfg_files, format_):
+    '''
+    Отдаем конфиги потоком. Конфиг считается выданным, как только кусок с его записью
+    отдан клиенту. Если поток оборвался, в пул возвращаются только конфиги, которые
+    еще не отправлялись - и взятые из пула, и сгенерированные для запроса
+    '''
+    pulled = 0
+    issued = 0
+
+    def pull():
+        nonlocal pulled
+        for cfg_file in cfg_files:
+            pulled += 1
+            yield cfg_file
+
+    try:
+        for chunk in iter_bulk(pull(), format_):
+            # записи всех взятых конфигов уже в этом или прошлых кусках
+            issued = pulled
+            yield chunk
+    except BaseException:
+        unsent = cfg_files[issued:]
+        config_pool.release(unsent)
+        client_registry.mark_pooled(unsent)
+        raise
+
+
+@app.get("/get-wire/bulk",
+         tags=["work"],
+         description="""Возвращает сразу несколько свободных конфигов и маркирует их как выданные.
+         Конфиги отдаются потоком в архиве zip, tar.gz или построчно в ndjson
+
+         пример получения :
+
+             $ wget -O clients.zip "http://<domain>/get-wire/bulk?count=100&format=zip"
+
+         """,
+         name="Получить несколько свободных конфигов"
+         )
+async def get_wire_bulk(count: int = Query(ge=1, le=5000),
+                        format_: str = Query(default="zip", alias="format", pattern="^(zip|tar|ndjson)$")):
+    claimed = await asyncio.to_thread(config_pool.claim_many, count)
+    cfg_files = list(claimed)
+    try:
+        if len(cfg_files) < count:
+            # пула не хватило - остаток генерируем одной пачкой
+            cfg_files += await provisioning.run(gen_wireguard_users, number_clients=count - len(cfg_files))
+    except BaseException:
+        # выдача не состоялась - забранные конфиги снова в пуле
+        config_pool.release(claimed)
+        await asyncio.to_thread(client_registry.mark_pooled, claimed)
+        raise
+    finally:
+        config_pool.schedule_refill()
+    if not cfg_files:
+        raise HTTPException(status_code=400, detail="no_serts_available")
+    media_type, extension = BULK_FORMATS[format_]
+    return StreamingResponse(stream_bulk(cfg_files, format_),
+                             media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="clients.{extension}"'})
+
+
+@app.get("/get-wire/qr",
+         tags=["work"],
+         description="""То же что /get-wire, но возвращает QR код свободного конфига для мобильного приложения Wireguard.
+         format - png или svg
+         """,
+         name="Получить QR код свободного конфига"
+         )
+async def get_wire_qr(format_: str = Query(default="png", alias="format", pattern="^(png|svg)$")):
+    cfg_file_ = await claim_config()
+    if not cfg_file_:
+        raise HTTPException(status_code=400, detail="no_serts_available")
+    image = await asyncio.to_thread(qr_cache.render, cfg_file_, format_)
+    return Response(image, media_type=QR_FORMATS[format_])
+
+
+@app.get("/client/{name}/qr",
+         tags=["wireguard"],
+         description="QR код конфига клиента по имени его папки. format - png или svg",
+         name="QR код конфига клиента"
+         )
+async def client_qr(name: str, format_: str = Query(default="png", alias="format", pattern="^(png|svg)$")):
+    clients_folder = "/etc/wireguard/clients"
+    cfg_file_ = os.path.join(clients_folder, name, "client.conf")
+    if name != os.path.basename(name) or name in ("", ".", "..") or not os.path.exists(cfg_file_):
+        raise HTTPException(status_code=404, detail=f"Конфиг {name} не найден")
+    image = await asyncio.to_thread(qr_cache.render, cfg_file_, format_)
+    return Response(image, media_type=QR_FORMATS[format_])
+
+
 async def get_wire_old(response: Response):
     file_ = None
     data = clients_scan()
@@ -270,29 +541,72 @@ async def get_wire_old(response: Response):
         return {"message": "no_serts_available"}
 
 
+def int_param(params, name: str, default: int) -> int:
+    '''
+    Числовой параметр DataTables, нечисловое значение - значение по умолчанию
+    '''
+    try:
+        return int(params.get(name, default))
+    except ValueError:
+        return default
+
+
 @app.get("/whitelist",
          response_model=AccessListResponse,
          tags=["access"],
-         description="Полный список всех разрешенных IP для доступа к сервису.",
+         description="""Список разрешенных IP для доступа к сервису.
+         Поддерживает постраничный вывод DataTables (draw, start, length, order[0][column], order[0][dir]).
+         Поиск (search[value] или ip_addr) - по началу адреса (10.1.) или по сети (10.1.0.0/16)""",
          name="Получить список IP адресов и их Id"
          )
 async def list_whitelist(request: Request, params: IP_List_Query = Depends()):
-    draw = request.query_params.get('draw', 1)
-    search = request.query_params.get("search[value]", False)
-    length_ = int(request.query_params.get('length', 300))
-    start = int(request.query_params.get('start', 0))
-    page = int((length_ + start) / length_)
+    draw = int_param(request.query_params, 'draw', 1)
+    search = request.query_params.get("search[value]", "") or params.ip_addr or ""
+    # без length (не DataTables) отдаем все записи, как раньше
+    length_ = int_param(request.query_params, 'length', -1)
+    start = max(int_param(request.query_params, 'start', 0), 0)
+    order_column = {"0": IPListAccess.id, "1": IPListAccess.ip_addr}.get(
+        request.query_params.get("order[0][column]"), IPListAccess.id)
+    order_desc = request.query_params.get("order[0][dir]") == "desc"
     with Session(engine) as session:
-        statement = select(IPListAccess).where(IPListAccess.type_rec == Type_IP_List.whitelist)
-        if params.ip_addr:
-            statement = statement.where(column("ip_addr").ilike(f"%{params.ip_addr}%"))
+        base = select(IPListAccess).where(IPListAccess.type_rec == Type_IP_List.whitelist)
+        total = session.exec(select(func.count()).select_from(base.subquery())).one()
+        statement = base
         if params.id:
             statement = statement.where(IPListAccess.id == params.id)
-        heroes = session.exec(statement).all()
-    resp = AccessListResponse(
-        data=heroes
-    )
-    return resp
+        try:
+            ranges = ip_search_ranges(search)
+        except ValueError:
+            # сеть IPv6 - индекс по строке не поможет, проверяем вхождение адресов в сеть
+            return whitelist_in_network(session, statement, search, draw, total, start, length_)
+        if ranges:
+            statement = statement.where(or_(*[and_(IPListAccess.ip_addr >= low, IPListAccess.ip_addr < high)
+                                              for low, high in ranges]))
+        filtered = session.exec(select(func.count()).select_from(statement.subquery())).one() \
+            if (ranges or params.id) else total
+        statement = statement.order_by(order_column.desc() if order_desc else order_column)
+        if length_ >= 0:
+            statement = statement.offset(start).limit(length_)
+        elif start:
+            statement = statement.offset(start)
+        rows = session.exec(statement).all()
+    return AccessListResponse(draw=draw, recordsTotal=total, recordsFiltered=filtered, data=rows)
+
+
+def whitelist_in_network(session, statement, search, draw, total, start, length_):
+    try:
+        network = ipaddress.ip_network(search.strip(), strict=False)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Некорректная сеть {search}")
+    rows = []
+    for row in session.exec(statement.where(column("ip_addr").contains(":")).order_by(IPListAccess.id)):
+        try:
+            if ipaddress.ip_network(row.ip_addr, strict=False).subnet_of(network):
+                rows.append(row)
+        except (ValueError, TypeError):
+            continue
+    page = rows[start:] if length_ < 0 else rows[start:start + length_]
+    return AccessListResponse(draw=draw, recordsTotal=total, recordsFiltered=len(rows), data=page)
 
 
 @app.post("/whitelist_file",
@@ -317,8 +631,7 @@ def whitelist_upload_file(file: UploadFile):
             fill_resp = IP_List_Response(**{"id": rec.id, "ip_addr": rec.ip_addr})
             result.append(fill_resp)
     resp = List_IP_List_Update_response(items=result)
-    for row in result:
-        config.whitelist.append(row.ip_addr)
+    reload_whitelist()
     return resp
 
 
@@ -346,8 +659,7 @@ def post_whitelist(params: List_IP_List_Update = Depends()):
 
             result.append(fill_resp)
         resp = List_IP_List_Update_response(items=result)
-        for row in result:
-            config.whitelist.append(row.ip_addr)
+    reload_whitelist()
     return resp
 
 
@@ -368,8 +680,7 @@ def update_whitelist(id: int, while_ip: IP_List_Update):
         session.add(rec)
         session.commit()
         session.refresh(rec)
-
-        config.whitelist.append(rec.ip_addr)
+    reload_whitelist()
     return rec
 
 
@@ -385,10 +696,7 @@ def delete_from_whitelist(id: int):
             raise HTTPException(status_code=404, detail=f"Record {id} not found")
         session.delete(rec)
         session.commit()
-        try:
-            config.whitelist.remove(rec.ip_addr)
-        except Exception as ex:
-            logger.exception(f"при удалении из списка доступа {rec.ip_addr}")
+    reload_whitelist()
     return {"status": "success"}
 
 
@@ -399,7 +707,7 @@ def delete_from_whitelist(id: int):
          name="Просмотр конфигов на сервере"
          )
 def scan_wireguard_user_configs(background_tasks: BackgroundTasks):
-    data = clients_scan()
+    data = client_registry.list_clients()
     return data
 
 
@@ -411,18 +719,10 @@ def scan_wireguard_user_configs(background_tasks: BackgroundTasks):
          )
 def free_for_use_wireguard_user_configs(background_tasks: BackgroundTasks):
     selected_clients = ListClientsWithTotal()
-    data = clients_scan()
-    selected_clients.total = len(data.clients)
-    used_ = 0
-    free_ = 0
-    for row in data.clients:
-        if not row.used:
-            # selected_clients.clients.append(row)
-            free_ += 1
-        else:
-            used_ += 1
+    total_, used_ = client_registry.counts()
+    selected_clients.total = total_
     selected_clients.used = used_
-    selected_clients.free = free_
+    selected_clients.free = total_ - used_
     return selected_clients
 
 
@@ -435,36 +735,79 @@ def free_for_use_wireguard_user_configs(background_tasks: BackgroundTasks):
 #         include_in_schema=False
 #         )
 def gen_wireguard_users(number_clients: int = 300):
+    '''
+    Генерируем клиентов в критической секции. Если идет другая генерация - ждем своей очереди
+    '''
     # number_clients = 300
     cfg_folder = "/etc/wireguard"
-    blk_file_path = "generated.lock"
-    fname = pathlib.Path(blk_file_path)
-    new_user_list = []
-    if fname.exists():
-        mtime = datetime.datetime.fromtimestamp(fname.stat().st_mtime, tz=datetime.timezone.utc)
-        now = datetime.datetime.now(tz=datetime.timezone.utc)
-        how_long = now - mtime
-        if datetime.timedelta(minutes=10) < how_long:
-            new_user_list = gen_users(number_clients, cfg_folder, logger)
-        else:
-            raise HTTPException(status_code=400,
-                                detail=f"В текущий момент идет генерация. Повторите попозже (запущено {how_long} назад)")
-    else:
-        new_user_list = gen_users(number_clients, cfg_folder, logger)
-    return new_user_list
+    try:
+        new_users = provisioning.call_locked(gen_users, number_clients, cfg_folder, logger, client_registry,
+                                             timeout=600)
+        status_cache.invalidate()
+        return new_users
+    except ProvisioningTimeout as ex:
+        raise HTTPException(status_code=400,
+                            detail=f"В текущий момент идет генерация. Повторите попозже ({ex})")
 
 
 @app.get("/wireguard_user_status",
          tags=["wireguard"],
-         description="Возвращает статус всех клиентов Wireguard. аналогично wg show",
+         description="""Возвращает статус всех клиентов Wireguard. аналогично wg show.
+         Если передан draw - отвечает постранично по протоколу serverSide DataTables
+         (start, length, search[value], order[0][column], order[0][dir], columns[i][data])""",
          name="Получить статус всех клиентов Wireguard", )
-def wireguard_user_status():
-    wg0_file = '/etc/wireguard/wg0.conf'  # wireguard config file
-    wg_iface = 'wg0'  # wireguard interface
-    status_list = status(logger, wg_iface, wg0_file)
-    if not status_list:
-        status_list = {"clients": []}
-    return status_list
+async def wireguard_user_status(request: Request, response: Response):
+    snapshot = await status_cache.aget()
+    response.headers["X-Status-Version"] = str(snapshot.version)
+    params = request.query_params
+    if "draw" not in params:
+        return snapshot.statistic()
+    # протокол serverSide DataTables: поиск, сортировка и страница по снимку
+    order_column = None
+    order_index = params.get("order[0][column]")
+    if order_index is not None:
+        order_column = params.get(f"columns[{order_index}][data]")
+    filtered, records = snapshot.page(start=max(int_param(params, "start", 0), 0),
+                                      length=min(int_param(params, "length", 10), 1000),
+                                      search=params.get("search[value]", ""),
+                                      order_column=order_column,
+                                      descending=params.get("order[0][dir]") == "desc")
+    return StatisticClientPage.model_construct(
+        draw=int_param(params, "draw", 1),
+        recordsTotal=len(snapshot.records),
+        recordsFiltered=filtered,
+        clients=[StatisticClient.model_construct(**record.to_dict()) for record in records])
+
+
+@app.get("/wireguard_user_status/stream",
+         tags=["wireguard"],
+         description="""Server-Sent Events с изменениями статуса клиентов: event delta с added, removed и changed
+         (строки как в /wireguard_user_status), resync - нужно перечитать таблицу""",
+         name="Поток изменений статуса клиентов")
+async def wireguard_user_status_stream():
+    return StreamingResponse(status_stream.events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/peer/{pub_key:path}/traffic",
+         tags=["wireguard"],
+         description="""Трафик клиента за период range (30m, 24h, 7d).
+         До 2 часов - по минутам, до 2 суток - по часам, дальше - по суткам (хранится 30 дней)""",
+         name="Трафик клиента", response_model=PeerTraffic)
+def peer_traffic(pub_key: str, range_: str = Query(default="1h", alias="range", pattern=r"^\d+[mhd]$")):
+    series = traffic_store.peer_series(pub_key, parse_range(range_))
+    if series is None:
+        raise HTTPException(status_code=404, detail=f"Клиент {pub_key} не найден")
+    return series
+
+
+@app.get("/traffic",
+         tags=["wireguard"],
+         description="Суммарный трафик всех клиентов за период range (30m, 24h, 7d) и самые активные клиенты",
+         name="Трафик всех клиентов", response_model=TrafficAggregate)
+def traffic(range_: str = Query(default="1h", alias="range", pattern=r"^\d+[mhd]$"),
+            top: int = Query(default=10, ge=0, le=1000)):
+    return traffic_store.aggregate(parse_range(range_), top=top)
 
 
 @app.put("/wireguard_config_not_removed_flg",
@@ -483,6 +826,9 @@ def wireguard_config_not_removed_flg(config_name: str):
             blk_f.unlink()
         else:
             blk_f.touch()
+        # флаг used - наличие любого .lock в папке клиента
+        is_used = any(file.suffix == ".lock" for file in cfg_file.iterdir())
+        client_registry.set_flags([config_name], used=is_used)
     return "success"
 
 
@@ -493,11 +839,16 @@ def wireguard_config_not_removed_flg(config_name: str):
 def wireguard_config_remove(pub_key: str):
     wg0_file = '/etc/wireguard/wg0.conf'
     wg_iface = 'wg0'  # wireguard interface
-    status_list = status(logger, wg_iface, wg0_file)
-    srv_cfg_file = ServerConfig(wg0_file)
-    for row in status_list.clients:
-        if row.pub_key == pub_key:
-            remove_client(row, logger=logger, srv_cfg_file=srv_cfg_file)
+    row = status_cache.get().by_pub_key.get(pub_key)
+    with provisioning.critical_section():
+        srv_cfg_file = ServerConfig(wg0_file)
+        peer_batch = PeerBatch(wg_iface, logger=logger)
+        if row is not None:
+            remove_client(row, logger=logger, srv_cfg_file=srv_cfg_file, peer_batch=peer_batch)
+        srv_cfg_file.write()
+        client_registry.remove_many(pub_keys=[pub_key])
+        peer_batch.apply()
+    status_cache.invalidate()
     return "success"
 
 
@@ -508,14 +859,20 @@ def wireguard_config_remove(pub_key: str):
          Если в папке есть файл .lock то такой конфиг не удаяется в автоматическом режиме. зайдите на сервер с правами администратора и удалите файл .lock""",
             name="Удаление ВСЕХ конфигов клиентов и пользователей в Wireguard", )
 def del_all_cfg():
+    # удаление меняет wg0.conf - в очереди с генерацией клиентов
+    return provisioning.call_locked(remove_all_clients)
+
+
+def remove_all_clients():
     wg0_file = '/etc/wireguard/wg0.conf'
     wg_iface = 'wg0'  # wireguard interface
     logger.info("Удаляем все конфиги клиентов")
-    status_list = status(logger, wg_iface, wg0_file)
+    status_list = status_cache.get().records
     client_removed_list = []
     srv_cfg_file = ServerConfig(wg0_file)
+    peer_batch = PeerBatch(wg_iface, logger=logger)
 
-    for row in status_list.clients:
+    for row in status_list:
         pub_key = row.pub_key
         client_folder = os.path.join("/etc/wireguard/clients", row.name) if row.name else None
         if client_folder and os.path.exists(client_folder):
@@ -529,16 +886,23 @@ def del_all_cfg():
                 client_removed_list.append({"name": row.name, "pub_key": pub_key, "status": "lock_file"})
                 continue
             else:
-                remove_client(row, logger=logger, srv_cfg_file=srv_cfg_file)
+                remove_client(row, logger=logger, srv_cfg_file=srv_cfg_file, peer_batch=peer_batch)
                 client_removed_list.append({"name": row.name, "pub_key": pub_key, "status": "deleted"})
                 logger.info(f"Конфиг {row.name} удален")
         else:
             logger.info(f"Конфиг для {pub_key} не найден")
-            remove_client(row, logger=logger, srv_cfg_file=srv_cfg_file)
+            remove_client(row, logger=logger, srv_cfg_file=srv_cfg_file, peer_batch=peer_batch)
             client_removed_list.append({"name": row.name, "pub_key": pub_key, "status": "deleted"})
             logger.info(f"{pub_key} с сервера удален")
 
     srv_cfg_file.write()
+    client_registry.remove_many(pub_keys=[row["pub_key"] for row in client_removed_list
+                                          if row["status"] == "deleted"])
+    applied = peer_batch.apply()
+    status_cache.invalidate()
+    for row in client_removed_list:
+        if row["status"] == "deleted" and not applied.get(row["pub_key"], True):
+            row["status"] = "deleted_from_config"
 
     return client_removed_list
 
@@ -0,0 +1,207 @@
+import abc
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+# границы гистограмм по умолчанию, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class _Metric(abc.ABC):
+    kind = ""
+
+    def __init__(self, name: str, help_: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, object] = {}
+
+    def _key(self, labels: dict) -> Tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    @abc.abstractmethod
+    def render(self) -> List[str]:
+        '''
+        Строки метрики в текстовом формате Prometheus
+        '''
+
+
+class Counter(_Metric):
+    '''
+    Счетчик, только растет
+    '''
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"
+                                for key, value in items]
+
+
+class Histogram(_Metric):
+    '''
+    Гистограмма длительностей с фиксированными границами
+    '''
+    kind = "histogram"
+
+    def __init__(self, name: str, help_: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        numb = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [количество в каждой границе + inf, сумма]
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][numb] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        '''
+        Замеряем длительность блока, в том числе завершившегося ошибкой
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(state[0]), state[1]) for key, state in self._values.items()]
+        lines = self.header()
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + format_value(float(bound)) + '"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}")
+            labels = format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render_gauge(name: str, help_: str, samples: Iterable[Tuple[Sequence, float]],
+                 labels: Sequence[str] = ()) -> List[str]:
+    '''
+    Значения, которые считаются в момент запроса (из снимка статуса, реестра)
+    :param samples: [(значения меток, значение)]
+    '''
+    lines = [f"# HELP {name} {help_}", f"# TYPE {name} gauge"]
+    lines.extend(f"{name}{format_labels(labels, values)} {format_value(value)}" for values, value in samples)
+    return lines
+
+
+class MetricsRegistry:
+    '''
+    Накопительные метрики процесса в текстовом формате Prometheus
+    '''
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help_, labels))
+
+    def histogram(self, name: str, help_: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_, labels, buckets))
+
+    def render(self) -> List[str]:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return lines
+
+
+registry = MetricsRegistry()
+
+provisioning_wait_seconds = registry.histogram(
+    "wg_provisioning_wait_seconds", "Ожидание очереди в критическую секцию изменения конфигов")
+provisioning_seconds = registry.histogram(
+    "wg_provisioning_seconds", "Длительность операций с конфигами в критической секции", labels=("operation",))
+subprocess_calls_total = registry.counter(
+    "wg_subprocess_calls_total", "Запуски внешних команд", labels=("command",))
+http_rejected_total = registry.counter(
+    "wg_http_rejected_total", "Запросы, отклоненные SecurityMiddleware", labels=("reason",))
+cleanup_seconds = registry.histogram(
+    "wg_cleanup_seconds", "Длительность автоочистки неиспользуемых конфигов")
+cleanup_removed_total = registry.counter(
+    "wg_cleanup_removed_total", "Клиенты, удаленные автоочисткой")
+
+
+def count_subprocess(args) -> None:
+    '''
+    Учитываем запуск внешней команды, sudo пропускаем
+    '''
+    argv = args.split() if isinstance(args, str) else list(args)
+    if argv and argv[0] == "sudo":
+        argv = argv[1:]
+    subprocess_calls_total.inc(command=argv[0] if argv else "")
+
+
+def render_peers(records: Iterable, now: Optional[float] = None) -> List[str]:
+    '''
+    Метрики peers из снимка статуса за один проход
+    '''
+    now = time.time() if now is None else now
+    rx, tx, age = [], [], []
+    online = 0
+    for record in records:
+        labels = (record.pub_key, record.name or "")
+        rx.append(f"wg_peer_rx_bytes{format_labels(('pub_key', 'name'), labels)} {record.rx or 0}")
+        tx.append(f"wg_peer_tx_bytes{format_labels(('pub_key', 'name'), labels)} {record.tx or 0}")
+        if record.latest_handshake:
+            age.append(f"wg_peer_handshake_age_seconds{format_labels(('pub_key', 'name'), labels)} "
+                       f"{max(int(now - record.latest_handshake), 0)}")
+            if record.is_online:
+                online += 1
+    return (["# HELP wg_peer_rx_bytes Принято от peer, байт", "# TYPE wg_peer_rx_bytes counter"] + rx
+            + ["# HELP wg_peer_tx_bytes Отправлено peer, байт", "# TYPE wg_peer_tx_bytes counter"] + tx
+            + ["# HELP wg_peer_handshake_age_seconds Секунд с последнего handshake",
+               "# TYPE wg_peer_handshake_age_seconds gauge"] + age
+            + render_gauge("wg_peers_online", "Peers с handshake за последние 5 минут", [((), online)]))
@@ -1,11 +1,11 @@
 #from collections.abc import Awaitable
-from ipaddress import IPv4Address, ip_network
+from ipaddress import ip_address, ip_network
 from pathlib import Path
 from typing import Any, Set
-from typing import Optional, List, Dict, Callable, Awaitable
+from typing import Optional, List, Dict, Callable, Awaitable, Literal, Tuple
 import enum
 from fastapi import Request, Response
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, Field, NaiveDatetime, field_validator
 from sqlmodel import Field, Session, SQLModel, create_engine, select
 from sqlmodel import Column, Enum, Field
 from sqlalchemy import UniqueConstraint
@@ -31,9 +31,17 @@ class IPListAccess(SQLModel, table=True):
                                    )
 
 class UserConfigs(SQLModel, table=True):
+    """Реестр клиентов: одна запись на папку клиента в /etc/wireguard/clients."""
+    __tablename__ = "user_configs"
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    user_num: int
-    file_name: str
+    name: str = Field(index=True, unique=True)
+    pub_key: Optional[str] = Field(default=None, index=True)
+    ip: Optional[str] = None
+    created: Optional[NaiveDatetime] = None
+    used: bool = Field(default=False, index=True)
+    pooled: bool = False
+    cfg_path: Optional[str] = None
 
 
 class SecurityConfig(BaseModel):
@@ -191,6 +199,34 @@ class SecurityConfig(BaseModel):
         The time window in seconds for rate limiting.
     """
 
+    rate_limit_algorithm: Literal["sliding_window", "token_bucket"] = Field(
+        default="sliding_window", description="Rate limiting algorithm"
+    )
+    """
+    str:
+        `sliding_window` - weighted counters of the current
+        and previous window; `token_bucket` - allows bursts
+        up to rate_limit, refilled over rate_limit_window.
+    """
+
+    rate_limit_max_keys: int = Field(
+        default=10000, description="Maximum number of IPs tracked per rate limit"
+    )
+    """
+    int:
+        How many client IPs each rate limit remembers.
+        The least recently seen IP is forgotten first.
+    """
+
+    rate_limit_routes: Dict[str, Tuple[int, int]] = Field(
+        default={}, description="Per-route rate limits: path prefix -> (requests, window seconds)"
+    )
+    """
+    Dict[str, Tuple[int, int]]:
+        Own budgets for path prefixes, applied
+        in addition to the global rate limit.
+    """
+
     enforce_https: bool = Field(default=False, description="Whether to enforce HTTPS connections")
     """
     bool:
@@ -339,6 +375,37 @@ class SecurityConfig(BaseModel):
         Whether to enable penetration attempt detection.
     """
 
+    body_inspection_limits: Dict[str, int] = Field(
+        default={
+            "application/json": 64 * 1024,
+            "application/x-www-form-urlencoded": 64 * 1024,
+            "multipart/form-data": 64 * 1024,
+            "text/*": 64 * 1024,
+            "application/octet-stream": 0,
+            "application/zip": 0,
+            "application/pdf": 0,
+            "image/*": 0,
+            "audio/*": 0,
+            "video/*": 0,
+        },
+        description="Max request body bytes inspected per media type, 0 - not inspected",
+    )
+    """
+    Dict[str, int]:
+        How much of the body is scanned for suspicious
+        patterns, per media type (`type/subtype` or
+        `type/*`). The rest of the body is not buffered.
+    """
+
+    body_inspection_default_limit: int = Field(
+        default=64 * 1024, description="Max inspected body bytes for other media types"
+    )
+    """
+    int:
+        Inspection limit for media types not listed
+        in body_inspection_limits.
+    """
+
     @field_validator("whitelist", "blacklist")
     def validate_ip_lists(cls, v: Optional[List[str]]) -> Optional[List[str]]:
         """Validate IP addresses and CIDR ranges in whitelist/blacklist."""
@@ -352,7 +419,7 @@ class SecurityConfig(BaseModel):
                     network = ip_network(entry, strict=False)
                     validated.append(str(network))
                 else:
-                    addr = IPv4Address(entry)
+                    addr = ip_address(entry)
                     validated.append(str(addr))
             except ValueError:
                 raise ValueError(f"Invalid IP or CIDR range: {entry}") from None
@@ -0,0 +1,180 @@
+import errno
+import ipaddress
+import logging
+import os
+import socket
+import struct
+from typing import Callable, Dict, List, Optional, Tuple
+
+# linux/netlink.h, linux/rtnetlink.h
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_CREATE = 0x400
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RT_SCOPE_LINK = 253
+RT_SCOPE_NOWHERE = 255
+RTN_UNICAST = 1
+RTA_DST = 1
+RTA_OIF = 4
+
+_NLMSGHDR = struct.Struct("=IHHII")
+_RTMSG = struct.Struct("=BBBBBBBBI")
+_RTATTR = struct.Struct("=HH")
+_NLMSGERR = struct.Struct("=i")
+
+# сколько сообщений отправляем одним send, чтобы не упереться в буфер сокета
+_CHUNK = 256
+
+
+def _align(length: int) -> int:
+    return (length + 3) & ~3
+
+
+def _rtattr(attr_type: int, payload: bytes) -> bytes:
+    length = _RTATTR.size + len(payload)
+    return _RTATTR.pack(length, attr_type) + payload + b"\0" * (_align(length) - length)
+
+
+def build_route_msg(msg_type: int, network, ifindex: int, seq: int) -> bytes:
+    '''
+    Сообщение RTM_NEWROUTE / RTM_DELROUTE для маршрута `<network> dev <iface>`
+    '''
+    network = ipaddress.ip_network(str(network), strict=False)
+    family = socket.AF_INET if network.version == 4 else socket.AF_INET6
+    if msg_type == RTM_NEWROUTE:
+        flags = NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE
+        protocol, scope, route_type = RTPROT_BOOT, RT_SCOPE_LINK, RTN_UNICAST
+    else:
+        # при удалении не ограничиваем протокол и тип, как `ip route delete`
+        flags = NLM_F_REQUEST | NLM_F_ACK
+        protocol, scope, route_type = 0, RT_SCOPE_NOWHERE, 0
+    body = _RTMSG.pack(family, network.prefixlen, 0, 0, RT_TABLE_MAIN, protocol, scope, route_type, 0)
+    body += _rtattr(RTA_DST, network.network_address.packed)
+    body += _rtattr(RTA_OIF, struct.pack("=I", ifindex))
+    return _NLMSGHDR.pack(_NLMSGHDR.size + len(body), msg_type, flags, seq, 0) + body
+
+
+def parse_acks(data: bytes) -> List[Tuple[int, int]]:
+    '''
+    Разбираем ответы ядра
+    :return: список (seq, errno), errno = 0 - успех
+    '''
+    acks = []
+    offset = 0
+    while offset + _NLMSGHDR.size <= len(data):
+        length, msg_type, _, seq, _ = _NLMSGHDR.unpack_from(data, offset)
+        if length < _NLMSGHDR.size:
+            break
+        if msg_type == NLMSG_ERROR:
+            error, = _NLMSGERR.unpack_from(data, offset + _NLMSGHDR.size)
+            acks.append((seq, -error))
+        elif msg_type == NLMSG_DONE:
+            acks.append((seq, 0))
+        offset += _align(length)
+    return acks
+
+
+def _netlink_socket() -> socket.socket:
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    sock.bind((0, 0))
+    return sock
+
+
+class RouteManager:
+    '''
+    Маршруты клиентов через rtnetlink, без запуска `ip -4 route ...`.
+
+    Изменения копятся и отправляются в ядро пачками в одном сокете, ответ ядра
+    разбирается по каждому маршруту. Если задан collapse_into (сеть интерфейса,
+    Address из wg0.conf), то /32 клиентов внутри этой сети не ставятся по одному:
+    вместо них ставится один маршрут на всю сеть через тот же интерфейс, что
+    для wireguard эквивалентно - дальше маршрутизирует сам wireguard по allowed-ips.
+
+    socket_factory позволяет подставить network namespace или фейковый netlink для проверки.
+    '''
+
+    def __init__(self,
+                 ifname: str = "wg0",
+                 collapse_into=None,
+                 socket_factory: Optional[Callable[[], socket.socket]] = None,
+                 ifindex: Optional[int] = None,
+                 logger: Optional[logging.Logger] = None):
+        self.ifname = ifname
+        self.collapse_into = ipaddress.ip_network(str(collapse_into), strict=False) if collapse_into else None
+        self.socket_factory = socket_factory or _netlink_socket
+        self._ifindex = ifindex
+        self.logger = logger or logging.getLogger(__name__)
+        self._ops: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self._ops)
+
+    @property
+    def ifindex(self) -> int:
+        if self._ifindex is None:
+            self._ifindex = socket.if_nametoindex(self.ifname)
+        return self._ifindex
+
+    def _queue(self, network, msg_type: int):
+        network = str(ipaddress.ip_network(str(network).strip(), strict=False))
+        self._ops.pop(network, None)
+        self._ops[network] = msg_type
+
+    def add(self, network):
+        network = ipaddress.ip_network(str(network).strip(), strict=False)
+        if self.collapse_into and network.version == self.collapse_into.version \
+                and network.subnet_of(self.collapse_into):
+            network = self.collapse_into
+        self._queue(network, RTM_NEWROUTE)
+
+    def delete(self, network):
+        network = ipaddress.ip_network(str(network).strip(), strict=False)
+        if network == self.collapse_into:
+            # маршрут на сеть интерфейса общий для всех клиентов - не удаляем
+            return
+        self._queue(network, RTM_DELROUTE)
+
+    def apply(self) -> Dict[str, int]:
+        '''
+        Отправляем накопленные изменения в ядро
+        :return: сеть -> errno (0 - успех; уже существующий маршрут при добавлении
+                 и отсутствующий при удалении тоже считаются успехом)
+        '''
+        ops = list(self._ops.items())
+        self._ops.clear()
+        result: Dict[str, int] = {}
+        if not ops:
+            return result
+        sock = self.socket_factory()
+        try:
+            sock.settimeout(5)
+            seq_base = int.from_bytes(os.urandom(2), "little") << 16
+            for start in range(0, len(ops), _CHUNK):
+                chunk = ops[start:start + _CHUNK]
+                pending = {}
+                buffer = b""
+                for numb, (network, msg_type) in enumerate(chunk):
+                    seq = seq_base + start + numb
+                    pending[seq] = (network, msg_type)
+                    buffer += build_route_msg(msg_type, network, self.ifindex, seq)
+                sock.send(buffer)
+                while pending:
+                    for seq, error in parse_acks(sock.recv(65536)):
+                        if seq not in pending:
+                            continue
+                        network, msg_type = pending.pop(seq)
+                        if (msg_type == RTM_NEWROUTE and error == errno.EEXIST) or \
+                                (msg_type == RTM_DELROUTE and error == errno.ESRCH):
+                            error = 0
+                        result[network] = error
+                        if error:
+                            self.logger.warning(f"маршрут {network} dev {self.ifname}: {os.strerror(error)}")
+        finally:
+            sock.close()
+        return result
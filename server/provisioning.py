@@ -0,0 +1,85 @@
+import asyncio
+import contextlib
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from server.metrics import provisioning_seconds, provisioning_wait_seconds
+
+
+class ProvisioningTimeout(Exception):
+    '''
+    Не дождались своей очереди на изменение конфигов
+    '''
+
+
+class ProvisioningExecutor:
+    '''
+    Исполнитель для генерации и удаления клиентов.
+
+    Тяжелая синхронная работа (файлы, wg, netlink) выполняется в ограниченном пуле потоков,
+    чтобы async endpoints не блокировали event loop. Изменения wg0.conf и выдачи IP
+    выполняются строго по одному в критической секции: остальные ждут своей очереди на lock,
+    а не получают ошибку, как было с файлом generated.lock.
+    '''
+
+    def __init__(self, max_workers: int = 4, logger: Optional[logging.Logger] = None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="provisioning")
+        self.lock = threading.Lock()
+        self.logger = logger or logging.getLogger(__name__)
+        self._waiting = 0
+        self._counter_lock = threading.Lock()
+
+    @property
+    def waiting(self) -> int:
+        '''
+        Сколько вызовов ждут входа в критическую секцию
+        '''
+        return self._waiting
+
+    @contextlib.contextmanager
+    def critical_section(self, timeout: Optional[float] = None):
+        '''
+        Критическая секция для изменения wg0.conf и выдачи IP.
+        :param timeout: сколько ждать очереди, None - без ограничения
+        '''
+        with self._counter_lock:
+            self._waiting += 1
+        try:
+            with provisioning_wait_seconds.time():
+                acquired = self.lock.acquire(timeout=-1 if timeout is None else timeout)
+        finally:
+            with self._counter_lock:
+                self._waiting -= 1
+        if not acquired:
+            raise ProvisioningTimeout(f"критическая секция занята дольше {timeout} секунд")
+        try:
+            yield
+        finally:
+            self.lock.release()
+
+    def call_locked(self, func: Callable, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+        '''
+        Синхронно выполняем func в критической секции.
+        '''
+        with self.critical_section(timeout=timeout):
+            with provisioning_seconds.time(operation=getattr(func, "__name__", "unknown")):
+                return func(*args, **kwargs)
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        '''
+        Выполняем синхронную func в пуле потоков, не блокируя event loop
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def run_locked(self, func: Callable, *args, **kwargs) -> Any:
+        '''
+        Выполняем синхронную func в пуле потоков внутри критической секции
+        '''
+        return await self.run(self.call_locked, func, *args, **kwargs)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
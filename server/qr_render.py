@@ -0,0 +1,80 @@
+import io
+import logging
+import os
+import threading
+from typing import Iterable, Optional
+
+import qrcode
+import qrcode.image.pure
+import qrcode.image.svg
+from cachetools import LRUCache
+
+from server.utils import get_file_source
+
+# формат -> media type
+QR_FORMATS = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+}
+
+
+def render_qr(text: str, format_: str = "png") -> bytes:
+    '''
+    Рисуем QR код конфига
+    :param format_: png или svg
+    '''
+    if format_ == "svg":
+        return qrcode.make(text, image_factory=qrcode.image.svg.SvgPathImage).to_string()
+    buffer = io.BytesIO()
+    qrcode.make(text, image_factory=qrcode.image.pure.PyPNGImage).save(buffer)
+    return buffer.getvalue()
+
+
+class QRCache:
+    '''
+    Кеш отрисованных QR кодов конфигов клиентов.
+
+    Ключ - публичный ключ клиента, время изменения конфига и формат, поэтому
+    перегенерированный конфиг не отдаст старую картинку. Размер кеша ограничен
+    в байтах, вытесняются давно не запрошенные картинки.
+    '''
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, logger: Optional[logging.Logger] = None):
+        self._cache: LRUCache = LRUCache(maxsize=max_bytes, getsizeof=len)
+        self._lock = threading.Lock()
+        self.logger = logger or logging.getLogger(__name__)
+
+    @staticmethod
+    def _cache_key(cfg_file: str, format_: str):
+        pub_file = os.path.join(os.path.dirname(cfg_file), "client.pub")
+        pub_key = get_file_source(pub_file) if os.path.exists(pub_file) else cfg_file
+        return pub_key, os.stat(cfg_file).st_mtime_ns, format_
+
+    def render(self, cfg_file: str, format_: str = "png") -> bytes:
+        '''
+        QR код конфига из кеша или отрисованный заново
+        :param cfg_file: путь к client.conf
+        '''
+        key = self._cache_key(cfg_file, format_)
+        with self._lock:
+            image = self._cache.get(key)
+        if image is not None:
+            return image
+        image = render_qr(get_file_source(cfg_file), format_)
+        with self._lock:
+            try:
+                self._cache[key] = image
+            except ValueError:
+                # картинка больше всего кеша
+                pass
+        return image
+
+    def prerender(self, cfg_files: Iterable[str], format_: str = "png"):
+        '''
+        Заранее рисуем QR коды, например для конфигов из пула
+        '''
+        for cfg_file in cfg_files:
+            try:
+                self.render(cfg_file, format_)
+            except Exception as ex:
+                self.logger.warning(f"не удалось отрисовать QR код {cfg_file}: {ex}")
@@ -10,11 +10,11 @@ class IP_List_Response(SQLModel):
     ip_addr: Optional[str]
 
 class AccessListResponse(BaseModel):
-    #draw: int
+    draw: int = 1
     #current_page: int
     #per_page: int
-    #recordsTotal: int
-    #recordsFiltered: int
+    recordsTotal: int = 0
+    recordsFiltered: int = 0
     data: Optional[List[IP_List_Response]] = []
 
 
@@ -42,6 +42,7 @@ class Client(BaseModel):
     cfg_file: Optional[str] = None
     path_to_cfg: Optional[str] = None
     pub_key: Optional[str] = None
+    pooled: Optional[bool] = False
 
 
 class ListClients(BaseModel):
@@ -100,3 +101,34 @@ class StatisticClient(BaseModel):
 class ListStatisticClient(BaseModel):
     clients: Optional[List[StatisticClient]] = []
 
+
+class StatisticClientPage(ListStatisticClient):
+    # ответ для DataTables в режиме serverSide
+    draw: int = 1
+    recordsTotal: int = 0
+    recordsFiltered: int = 0
+
+
+
+class TrafficPoint(BaseModel):
+    # ts - начало интервала, unix time
+    ts: int
+    rx: int = 0
+    tx: int = 0
+
+
+class PeerTraffic(BaseModel):
+    pub_key: str
+    step: int
+    rx: int = 0
+    tx: int = 0
+    points: List[TrafficPoint] = []
+
+
+class TrafficAggregate(BaseModel):
+    step: int
+    peers: int = 0
+    rx: int = 0
+    tx: int = 0
+    points: List[TrafficPoint] = []
+    top: List[PeerTraffic] = []
@@ -3,6 +3,9 @@ $(document).ready(function() {
 var table = new DataTable('#example', {
     info: true,
     order: [[1, 'desc']],
+    // страницы, сортировка и поиск (по началу IP или по сети 10.1.0.0/16) - на сервере
+    serverSide: true,
+    searchDelay: 400,
     ajax: {
         url: '/whitelist',
         type: 'GET'
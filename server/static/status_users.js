@@ -4,6 +4,9 @@ var table = new DataTable('#status_table', {
     info: true,
     order: [[1, 'desc']],
     stateSave: true,
+    // поиск, сортировка и страницы считаются на сервере
+    serverSide: true,
+    searchDelay: 400,
     ajax: {
         //url: '/wireguard_user_status_blank',
         url: '/wireguard_user_status',
@@ -107,6 +110,61 @@ function delete_cong_user(pub_key) {
 }
 
 
+// изменения статуса приходят с сервера, строки текущей страницы обновляются на месте
+var reloadTimer = null;
+function reload_page() {
+    // добавленные и удаленные клиенты меняют состав страницы - перечитываем только ее
+    if (reloadTimer) {
+        return;
+    }
+    reloadTimer = setTimeout(function() {
+        reloadTimer = null;
+        table.ajax.reload(null, false);
+    }, 1000);
+}
+
+function patch_rows(clients) {
+    var by_pub_key = {};
+    $.each(clients, function(index, client) {
+        by_pub_key[client.pub_key] = client;
+    });
+    table.rows({ page: 'current' }).every(function() {
+        var client = by_pub_key[this.data().pub_key];
+        if (client) {
+            // приходят только изменившиеся поля
+            var data = Object.assign({}, this.data(), client);
+            // без draw(): в режиме serverSide он запросит страницу с сервера
+            this.data(data);
+            $(this.node()).toggleClass('bg-success', data.used === true);
+        }
+    });
+}
+
+if (window.EventSource) {
+    var connected = false;
+    var status_stream = new EventSource('/wireguard_user_status/stream');
+    status_stream.addEventListener('hello', function(e) {
+        // после переподключения могли пропустить изменения
+        if (connected) {
+            reload_page();
+        }
+        connected = true;
+    });
+    status_stream.addEventListener('delta', function(e) {
+        var delta = JSON.parse(e.data);
+        if (delta.added.length > 0 || delta.removed.length > 0) {
+            reload_page();
+        }
+        if (delta.changed.length > 0) {
+            patch_rows(delta.changed);
+        }
+    });
+    status_stream.addEventListener('resync', function(e) {
+        reload_page();
+    });
+}
+
+
 table.on( 'select deselect', function (e, dt, type, indexes) {
     var selectedRows = table.rows( { selected: true } ).count();
     table.button( 1 ).enable( selectedRows >0);
@@ -0,0 +1,238 @@
+import asyncio
+import collections
+import ipaddress
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Executor, Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+from server.schemas import ListStatisticClient, StatisticClient
+from server.user_statistics import PeerStatus
+
+
+def _ip_key(record: PeerStatus):
+    try:
+        network = ipaddress.ip_network(str(record.allowed_ips).split(",")[0].strip(), strict=False)
+        return network.version, int(network.network_address)
+    except ValueError:
+        return 99, 0
+
+
+def _handshake_age_key(record: PeerStatus):
+    # last_seen по возрастанию - сначала недавние, never в конце
+    return (not record.latest_handshake, -(record.latest_handshake or 0))
+
+
+# колонка таблицы статуса -> ключ сортировки
+SORT_KEYS = {
+    "name": lambda record: record.name or "",
+    "pub_key": lambda record: record.pub_key or "",
+    "allowed_ips": _ip_key,
+    "rx": lambda record: record.rx or 0,
+    "tx": lambda record: record.tx or 0,
+    "last_seen": _handshake_age_key,
+    "is_online": lambda record: record.is_online,
+    "latest_handshake_dt": lambda record: record.latest_handshake or 0,
+    "latest_handshake": lambda record: record.latest_handshake or 0,
+}
+# сколько последних поисковых запросов помним на снимок
+_SEARCH_CACHE_SIZE = 16
+
+
+class StatusSnapshot:
+    '''
+    Статус всех peers на один момент времени.
+    version растет с каждым обновлением, по нему можно понять, что данные изменились.
+    failed - интерфейс прочитать не удалось, records пустой, но peers никуда не делись
+    '''
+    __slots__ = ("version", "created", "records", "failed", "_by_pub_key", "_statistic", "_orders", "_haystack",
+                 "_searches", "_lock")
+
+    def __init__(self, version: int, records: List[PeerStatus], failed: bool = False):
+        self.version = version
+        self.created = time.monotonic()
+        self.records = records
+        self.failed = failed
+        self._by_pub_key = None
+        self._statistic = None
+        # колонка -> номера записей по возрастанию
+        self._orders: Dict[str, List[int]] = {}
+        self._haystack: Optional[List[str]] = None
+        self._searches: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.created
+
+    @property
+    def by_pub_key(self) -> Dict[str, PeerStatus]:
+        if self._by_pub_key is None:
+            self._by_pub_key = {record.pub_key: record for record in self.records}
+        return self._by_pub_key
+
+    def statistic(self) -> ListStatisticClient:
+        '''
+        Ответ для /wireguard_user_status, собирается один раз на снимок
+        '''
+        if self._statistic is None:
+            self._statistic = ListStatisticClient.model_construct(
+                clients=[StatisticClient.model_construct(**record.to_dict()) for record in self.records])
+        return self._statistic
+
+    def _order(self, column: str) -> List[int]:
+        order = self._orders.get(column)
+        if order is None:
+            key = SORT_KEYS[column]
+            order = sorted(range(len(self.records)), key=lambda numb: key(self.records[numb]))
+            self._orders[column] = order
+        return order
+
+    def _search(self, search: str) -> Optional[set]:
+        '''
+        Номера записей, в имени, ключе или IP которых есть строка поиска
+        '''
+        search = search.strip().lower()
+        if not search:
+            return None
+        found = self._searches.get(search)
+        if found is not None:
+            self._searches.move_to_end(search)
+            return found
+        if self._haystack is None:
+            self._haystack = [f"{record.name or ''}\t{record.pub_key or ''}\t{record.allowed_ips or ''}".lower()
+                              for record in self.records]
+        found = {numb for numb, text in enumerate(self._haystack) if search in text}
+        self._searches[search] = found
+        if len(self._searches) > _SEARCH_CACHE_SIZE:
+            self._searches.popitem(last=False)
+        return found
+
+    def page(self, start: int = 0, length: int = 10, search: str = "",
+             order_column: Optional[str] = None, descending: bool = False) -> Tuple[int, List[PeerStatus]]:
+        '''
+        Страница записей для таблицы: поиск, сортировка и срез.
+        Сортировки и результаты поиска строятся один раз на снимок
+        :param length: -1 - все записи
+        :return: (сколько записей подошло под поиск, записи страницы)
+        '''
+        with self._lock:
+            found = self._search(search)
+            if order_column in SORT_KEYS:
+                order = self._order(order_column)
+            else:
+                order = range(len(self.records))
+        if descending:
+            order = reversed(order)
+        if found is not None:
+            order = (numb for numb in order if numb in found)
+        total = len(self.records) if found is None else len(found)
+        stop = None if length < 0 else start + length
+        page = [self.records[numb] for numb in itertools.islice(order, start, stop)]
+        return total, page
+
+
+class StatusCache:
+    '''
+    Общий снимок статуса peers с TTL.
+
+    Одновременные запросы не запускают по своему чтению интерфейса: первый обновляет
+    снимок, остальные ждут его результат (single-flight), и из потоков через get(), и из
+    event loop через aget(). invalidate() вызывается при добавлении и удалении клиентов,
+    чтобы следующий запрос получил свежие данные, не дожидаясь TTL.
+    '''
+
+    def __init__(self,
+                 loader: Callable[[], List[PeerStatus]],
+                 ttl: float = 2.0,
+                 executor: Optional[Executor] = None,
+                 logger: Optional[logging.Logger] = None):
+        '''
+        :param loader: синхронная функция, которая читает статус всех peers;
+            OSError - чтение не удалось, в кеш попадает пустой снимок с failed
+        :param ttl: сколько секунд снимок считается свежим
+        :param executor: в каком пуле потоков обновлять для aget(), None - пул по умолчанию
+        '''
+        self.loader = loader
+        self.ttl = ttl
+        self.executor = executor
+        self.logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._snapshot: Optional[StatusSnapshot] = None
+        self._inflight: Optional[Future] = None
+        self._version = 0
+
+    @property
+    def version(self) -> int:
+        '''
+        Версия последнего снимка
+        '''
+        return self._version
+
+    def invalidate(self):
+        '''
+        Сбрасываем снимок. Обновление, начатое до сброса, в кеш уже не попадет
+        '''
+        with self._lock:
+            self._snapshot = None
+            self._inflight = None
+
+    def _acquire(self, max_age: Optional[float]):
+        '''
+        :return: (свежий снимок или None, future обновления, нужно ли запускать обновление)
+        '''
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            if self._snapshot is not None and self._snapshot.age <= max_age:
+                return self._snapshot, None, False
+            if self._inflight is not None:
+                return None, self._inflight, False
+            self._inflight = Future()
+            return None, self._inflight, True
+
+    def _refresh(self, future: Future):
+        failed = False
+        try:
+            records = self.loader()
+        except OSError:
+            # страницы получат пустой статус, как и раньше, а фоновые задачи пропустят снимок
+            records, failed = [], True
+        except BaseException as ex:
+            with self._lock:
+                if self._inflight is future:
+                    self._inflight = None
+            future.set_exception(ex)
+            return
+        with self._lock:
+            self._version += 1
+            snapshot = StatusSnapshot(self._version, records, failed)
+            if self._inflight is future:
+                # за время чтения не было invalidate()
+                self._snapshot = snapshot
+                self._inflight = None
+        future.set_result(snapshot)
+
+    def get(self, max_age: Optional[float] = None) -> StatusSnapshot:
+        '''
+        Снимок статуса из потока
+        :param max_age: допустимый возраст снимка в секундах, None - ttl
+        '''
+        snapshot, future, leader = self._acquire(max_age)
+        if snapshot is not None:
+            return snapshot
+        if leader:
+            self._refresh(future)
+        return future.result()
+
+    async def aget(self, max_age: Optional[float] = None) -> StatusSnapshot:
+        '''
+        Снимок статуса из event loop, чтение интерфейса - в пуле потоков
+        '''
+        snapshot, future, leader = self._acquire(max_age)
+        if snapshot is not None:
+            return snapshot
+        if leader:
+            asyncio.get_running_loop().run_in_executor(self.executor, self._refresh, future)
+        return await asyncio.wrap_future(future)
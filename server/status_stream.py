@@ -0,0 +1,195 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, Optional, Set, Tuple
+
+from server.schemas import StatisticClient
+from server.status_cache import StatusCache, StatusSnapshot
+from server.user_statistics import PeerStatus
+
+# поля, изменение которых отправляется на страницу статуса
+_WATCHED_FIELDS = ("name", "allowed_ips", "endpoint", "latest_handshake", "rx", "tx", "used")
+# счетчики трафика меняются у каждого активного peer, их отправляем реже
+_COUNTER_FIELDS = frozenset(("rx", "tx"))
+# поля строки, которые считаются из latest_handshake
+_HANDSHAKE_FIELDS = ("latest_handshake", "last_seen", "is_online", "latest_handshake_dt")
+# сколько непрочитанных событий держим на одного слушателя
+_QUEUE_SIZE = 16
+# комментарий SSE, чтобы прокси не закрывали тихое соединение
+KEEPALIVE = ": ping\n\n"
+
+
+def _state(record: PeerStatus) -> Tuple:
+    return tuple(getattr(record, field) for field in _WATCHED_FIELDS) + (record.is_online,)
+
+
+def _row(record: PeerStatus) -> dict:
+    # та же строка, что отдает /wireguard_user_status
+    return StatisticClient.model_construct(**record.to_dict()).model_dump(mode="json", warnings=False)
+
+
+def _changes(record: PeerStatus, old: Tuple, new: Tuple) -> dict:
+    # только изменившиеся поля строки, страница дописывает их в свою строку
+    changes = {"pub_key": record.pub_key}
+    for field, before, after in zip(_WATCHED_FIELDS, old, new):
+        if before != after:
+            changes[field] = after
+    if "latest_handshake" in changes or old[-1] != new[-1]:
+        row = _row(record)
+        changes.update((field, row[field]) for field in _HANDSHAKE_FIELDS)
+    return changes
+
+
+def _counters_only(old: Tuple, new: Tuple) -> bool:
+    return all(before == after or field in _COUNTER_FIELDS
+               for field, before, after in zip(_WATCHED_FIELDS, old, new)) and old[-1] == new[-1]
+
+
+def format_event(event: str, data: dict, event_id: Optional[int] = None) -> str:
+    lines = [f"event: {event}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append("data: " + json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+    return "\n".join(lines) + "\n\n"
+
+
+def diff_snapshots(previous: Dict[str, Tuple], snapshot: StatusSnapshot,
+                   counters: bool = True) -> Tuple[Dict[str, Tuple], dict]:
+    '''
+    Изменения между двумя снимками статуса
+    :param previous: pub_key -> отправленное состояние
+    :param counters: отправлять ли изменения только rx/tx; если нет, они копятся до следующего раза
+    :return: (отправленное состояние, {"added": [...], "removed": [...], "changed": [...]}),
+        в changed - pub_key и изменившиеся поля строки
+    '''
+    current = {}
+    added, changed = [], []
+    for record in snapshot.records:
+        state = _state(record)
+        old = previous.get(record.pub_key)
+        if old is None:
+            added.append(_row(record))
+        elif old != state:
+            if not counters and _counters_only(old, state):
+                state = old
+            else:
+                changed.append(_changes(record, old, state))
+        current[record.pub_key] = state
+    removed = [pub_key for pub_key in previous if pub_key not in current]
+    return current, {"added": added, "removed": removed, "changed": changed}
+
+
+class StatusStream:
+    '''
+    Рассылка изменений статуса peers открытым страницам (Server-Sent Events).
+
+    Пока есть хотя бы один слушатель, одна фоновая задача раз в interval берет общий
+    снимок из StatusCache, сравнивает с предыдущим и один раз кодирует событие, которое
+    получают все слушатели. N открытых страниц - одно обновление снимка за интервал.
+    Слушатель, который не успевает читать, получает resync и перечитывает таблицу сам.
+    Изменения только счетчиков rx/tx отправляются не чаще раза в counters_interval.
+    Снимок с ошибкой чтения интерфейса пропускается.
+    '''
+
+    def __init__(self, cache: StatusCache, interval: float = 5.0, logger: Optional[logging.Logger] = None,
+                 counters_interval: float = 30.0):
+        self.cache = cache
+        self.interval = interval
+        self.counters_interval = counters_interval
+        self._counters_sent = 0.0
+        self.logger = logger or logging.getLogger(__name__)
+        self._listeners: Set[asyncio.Queue] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._state: Optional[Dict[str, Tuple]] = None
+        self.version = 0
+
+    @property
+    def listeners(self) -> int:
+        return len(self._listeners)
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=_QUEUE_SIZE)
+        self._listeners.add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._produce())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._listeners.discard(queue)
+
+    def _publish(self, message: Optional[str]):
+        for queue in list(self._listeners):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # слушатель отстал - старые изменения ему уже не помогут
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(format_event("resync", {"version": self.version}))
+
+    async def _produce(self):
+        try:
+            while self._listeners:
+                try:
+                    snapshot = await self.cache.aget()
+                except Exception as ex:
+                    self.logger.warning(f"СТАТУС. Не удалось получить снимок для рассылки: {ex}")
+                else:
+                    self._step(snapshot)
+                await asyncio.sleep(self.interval)
+        finally:
+            # без слушателей история изменений не нужна, новый слушатель загрузит таблицу заново
+            self._state = None
+
+    def _step(self, snapshot: StatusSnapshot):
+        if snapshot.version == self.version and self._state is not None:
+            return
+        if snapshot.failed:
+            # иначе все peers ушли бы в removed, а на следующем шаге вернулись в added
+            return
+        self.version = snapshot.version
+        if self._state is None:
+            self._state = {record.pub_key: _state(record) for record in snapshot.records}
+            return
+        now = time.monotonic()
+        counters = now - self._counters_sent >= self.counters_interval
+        if counters:
+            self._counters_sent = now
+        self._state, delta = diff_snapshots(self._state, snapshot, counters)
+        if delta["added"] or delta["removed"] or delta["changed"]:
+            delta["version"] = snapshot.version
+            self._publish(format_event("delta", delta, snapshot.version))
+
+    async def close(self):
+        '''
+        Завершаем рассылку: слушатели получают None и закрывают ответы
+        '''
+        self._publish(None)
+        self._listeners.clear()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def events(self, keepalive: float = 15.0):
+        '''
+        Поток SSE для одного слушателя
+        '''
+        queue = self.subscribe()
+        try:
+            yield format_event("hello", {"version": self.version, "interval": self.interval})
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    yield KEEPALIVE
+                    continue
+                if message is None:
+                    return
+                yield message
+        finally:
+            self.unsubscribe(queue)
@@ -0,0 +1,217 @@
+import array
+import re
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+# (шаг в секундах, сколько шагов храним, тип элемента array)
+# минутные дельты помещаются в 4 байта, часовые и суточные - нет
+DEFAULT_RESOLUTIONS = (
+    (60, 120, "I"),  # 2 часа по минутам
+    (3600, 48, "Q"),  # двое суток по часам
+    (86400, 30, "Q"),  # 30 дней по суткам
+)
+_RANGE_RE = re.compile(r"^(\d+)([mhd])$")
+_UNITS = {"m": 60, "h": 3600, "d": 86400}
+
+
+def parse_range(range_: str) -> int:
+    '''
+    '30m', '24h', '7d' -> секунды
+    '''
+    match = _RANGE_RE.match(range_)
+    if not match:
+        raise ValueError(f"некорректный интервал {range_}")
+    return int(match.group(1)) * _UNITS[match.group(2)]
+
+
+class _Ring:
+    '''
+    Кольцевой буфер одного разрешения, по колонкам: на каждую позицию кольца -
+    array со значением для каждой строки (peer). Переход к новому интервалу -
+    замена одной колонки нулями, без обхода peers
+    '''
+
+    def __init__(self, step: int, slots: int, typecode: str, capacity: int):
+        self.step = step
+        self.slots = slots
+        self.typecode = typecode
+        self.max_value = (1 << (8 * array.array(typecode).itemsize)) - 1
+        self.capacity = capacity
+        self.rx = [self._zeros(capacity) for _ in range(slots)]
+        self.tx = [self._zeros(capacity) for _ in range(slots)]
+        # номер интервала, который сейчас лежит в позиции кольца
+        self.buckets = array.array("q", [-1] * slots)
+
+    def _zeros(self, count: int) -> array.array:
+        return array.array(self.typecode, bytes(count * array.array(self.typecode).itemsize))
+
+    def grow(self, capacity: int):
+        extra = capacity - self.capacity
+        for column in self.rx + self.tx:
+            column.extend(self._zeros(extra))
+        self.capacity = capacity
+
+    def _position(self, bucket: int) -> int:
+        pos = bucket % self.slots
+        if self.buckets[pos] != bucket:
+            self.rx[pos] = self._zeros(self.capacity)
+            self.tx[pos] = self._zeros(self.capacity)
+            self.buckets[pos] = bucket
+        return pos
+
+    def add(self, ts: float, row: int, rx: int, tx: int):
+        pos = self._position(int(ts // self.step))
+        self.rx[pos][row] = min(self.rx[pos][row] + rx, self.max_value)
+        self.tx[pos][row] = min(self.tx[pos][row] + tx, self.max_value)
+
+    def clear_row(self, row: int):
+        for column in self.rx + self.tx:
+            column[row] = 0
+
+    def positions(self, since: float, until: float) -> List[Tuple[int, int]]:
+        '''
+        :return: [(начало интервала, позиция в кольце)] по времени
+        '''
+        first, last = int(since // self.step), int(until // self.step)
+        result = []
+        for bucket in range(max(first, last - self.slots + 1), last + 1):
+            pos = bucket % self.slots
+            if self.buckets[pos] == bucket:
+                result.append((bucket * self.step, pos))
+        return result
+
+
+class TrafficStore:
+    '''
+    Трафик peers во времени по дельтам счетчиков rx/tx из снимков статуса.
+
+    Каждая выборка раскладывается сразу в минутные, часовые и суточные интервалы,
+    каждый со своим сроком хранения. Данные хранятся колонками array по номеру строки
+    peer, поэтому 10k peers занимают десятки мегабайт, а не объекты на каждую точку.
+    Хранится в памяти, после перезапуска история начинается заново.
+    '''
+
+    def __init__(self, resolutions: Sequence[Tuple[int, int, str]] = DEFAULT_RESOLUTIONS, capacity: int = 1024,
+                 evict_after: int = 3):
+        '''
+        :param evict_after: через сколько выборок подряд без peer его история удаляется
+        '''
+        self._lock = threading.Lock()
+        self._capacity = capacity
+        self.evict_after = evict_after
+        self._rows: Dict[str, int] = {}
+        # сколько выборок подряд peer отсутствует
+        self._missing: Dict[str, int] = {}
+        self._free: List[int] = []
+        self._last_rx = array.array("Q", bytes(8 * capacity))
+        self._last_tx = array.array("Q", bytes(8 * capacity))
+        self.rings = [_Ring(step, slots, typecode, capacity) for step, slots, typecode in resolutions]
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _grow(self):
+        capacity = self._capacity * 2
+        extra = capacity - self._capacity
+        self._last_rx.extend(array.array("Q", bytes(8 * extra)))
+        self._last_tx.extend(array.array("Q", bytes(8 * extra)))
+        for ring in self.rings:
+            ring.grow(capacity)
+        self._capacity = capacity
+
+    def _new_row(self, pub_key: str) -> int:
+        if self._free:
+            row = self._free.pop()
+        else:
+            row = len(self._rows)
+            if row >= self._capacity:
+                self._grow()
+        self._rows[pub_key] = row
+        return row
+
+    def record(self, records: Iterable, ts: Optional[float] = None) -> int:
+        '''
+        Добавляем выборку: записи статуса с pub_key, rx и tx (PeerStatus).
+        Для нового peer первая выборка только запоминает счетчики.
+        Peers, которых нет в evict_after выборках подряд, удаляются вместе с историей.
+        Неудачное чтение интерфейса сюда передавать не нужно, иначе все peers считаются пропавшими
+        :return: количество peers в выборке
+        '''
+        ts = time.time() if ts is None else ts
+        seen = set()
+        with self._lock:
+            for record in records:
+                pub_key = record.pub_key
+                seen.add(pub_key)
+                rx, tx = record.rx or 0, record.tx or 0
+                row = self._rows.get(pub_key)
+                if row is None:
+                    row = self._new_row(pub_key)
+                    self._last_rx[row], self._last_tx[row] = rx, tx
+                    continue
+                # счетчики сбрасываются при перезапуске интерфейса или переустановке peer
+                delta_rx = rx - self._last_rx[row] if rx >= self._last_rx[row] else rx
+                delta_tx = tx - self._last_tx[row] if tx >= self._last_tx[row] else tx
+                self._last_rx[row], self._last_tx[row] = rx, tx
+                if delta_rx or delta_tx:
+                    for ring in self.rings:
+                        ring.add(ts, row, delta_rx, delta_tx)
+            for pub_key in seen:
+                self._missing.pop(pub_key, None)
+            for pub_key in [key for key in self._rows if key not in seen]:
+                missing = self._missing.get(pub_key, 0) + 1
+                if missing < self.evict_after:
+                    self._missing[pub_key] = missing
+                    continue
+                del self._missing[pub_key]
+                row = self._rows.pop(pub_key)
+                for ring in self.rings:
+                    ring.clear_row(row)
+                self._free.append(row)
+        return len(seen)
+
+    def _ring_for(self, seconds: int) -> _Ring:
+        '''
+        Самое подробное разрешение, которое покрывает интервал
+        '''
+        for ring in self.rings:
+            if ring.step * ring.slots >= seconds:
+                return ring
+        return self.rings[-1]
+
+    def peer_series(self, pub_key: str, seconds: int, now: Optional[float] = None) -> Optional[dict]:
+        '''
+        Трафик одного peer за последние seconds секунд
+        :return: None если peer неизвестен
+        '''
+        now = time.time() if now is None else now
+        ring = self._ring_for(seconds)
+        with self._lock:
+            row = self._rows.get(pub_key)
+            if row is None:
+                return None
+            points = [{"ts": ts, "rx": ring.rx[pos][row], "tx": ring.tx[pos][row]}
+                      for ts, pos in ring.positions(now - seconds, now)]
+        return {"pub_key": pub_key, "step": ring.step, "points": points,
+                "rx": sum(point["rx"] for point in points), "tx": sum(point["tx"] for point in points)}
+
+    def aggregate(self, seconds: int, top: int = 10, now: Optional[float] = None) -> dict:
+        '''
+        Суммарный трафик всех peers за последние seconds секунд и самые активные peers
+        '''
+        now = time.time() if now is None else now
+        ring = self._ring_for(seconds)
+        with self._lock:
+            positions = ring.positions(now - seconds, now)
+            points = [{"ts": ts, "rx": sum(ring.rx[pos]), "tx": sum(ring.tx[pos])} for ts, pos in positions]
+            totals = []
+            for pub_key, row in self._rows.items():
+                rx = sum(ring.rx[pos][row] for _, pos in positions)
+                tx = sum(ring.tx[pos][row] for _, pos in positions)
+                if rx or tx:
+                    totals.append({"pub_key": pub_key, "rx": rx, "tx": tx})
+        totals.sort(key=lambda peer: peer["rx"] + peer["tx"], reverse=True)
+        return {"step": ring.step, "peers": len(self._rows), "points": points,
+                "rx": sum(point["rx"] for point in points), "tx": sum(point["tx"] for point in points),
+                "top": totals[:top]}
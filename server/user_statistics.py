@@ -1,53 +1,109 @@
-import json
-import re
-import subprocess
-import math
-import argparse
-from datetime import datetime
-from operator import attrgetter
-from server.schemas import StatisticClient, ListStatisticClient
-from server.ini_file_core import ServerConfig, clients_scan
+import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+from server.schemas import StatisticClient, ListStatisticClient, Client
+from server.ini_file_core import clients_scan
+from server.wg_netlink import get_backend
 import logging
 
+# поля строки peer в `wg show <iface> dump`, по порядку
+PEER_FIELDS = ("pub_key", "shared_key", "endpoint", "allowed_ips", "latest_handshake", "rx", "tx", "keepalive")
+# поля из реестра клиентов
+CLIENT_FIELDS = ("name", "conf_created", "used")
+_INT_FIELDS = {"latest_handshake", "rx", "tx", "keepalive"}
+# клиент онлайн, если handshake был не позже чем столько секунд назад
+ONLINE_SECONDS = 300
+
+
+class PeerStatus:
+    '''
+    Статус одного peer без валидации pydantic.
+    Поля, не попавшие в проекцию, остаются None
+    '''
+    __slots__ = PEER_FIELDS + CLIENT_FIELDS
+
+    def __init__(self, **values):
+        for field in self.__slots__:
+            setattr(self, field, values.get(field))
+
+    @property
+    def is_online(self) -> bool:
+        if not self.latest_handshake:
+            return False
+        return datetime.datetime.now().timestamp() - self.latest_handshake < ONLINE_SECONDS
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __repr__(self):
+        values = ", ".join(f"{field}={getattr(self, field)!r}" for field in self.__slots__
+                           if getattr(self, field) is not None)
+        return f"PeerStatus({values})"
 
-def status(loger: logging.Logger, wg_iface: str, wg0_file: str) -> ListStatisticClient:
-    loger.info("Получаем статус клиентов")
-    clients_cfgs = clients_scan()
-    status_list = []
-    stats = subprocess.run(['sudo', 'wg', 'show', wg_iface, 'dump'], capture_output=True)
-    if stats.returncode != 0:
-        loger.error(f"Error running wg show: {stats.stderr.decode()}")
-        return status_list
-    stats = stats.stdout.decode()
-    loger.info(stats)
-    stats = stats.split('\n')
-
-    # remove first line
-    stats.pop(0)
-    stats.pop(len(stats) - 1)
-    client_list = ListStatisticClient()
-    for line in stats:
-        row = line.split('\t')
-        curr_client = None
-        for client in clients_cfgs.clients:
-            if row[0] == client.pub_key:
-                curr_client = client
-                break
-        client_ = StatisticClient.model_validate({"pub_key": row[0],
-                                                  "shared_key": row[1],
-                                                  "endpoint": row[2],
-                                                  "allowed_ips": row[3],
-                                                  "latest_handshake": int(row[4]),
-                                                  "rx": int(row[5]),
-                                                  "tx": int(row[6]),
-                                                  "keepalive": int(row[7]) if row[7] != 'off' else 0,
-                                                  "name": None if curr_client is None else curr_client.name,
-                                                  "conf_created": None if curr_client is None else curr_client.conf_created,
-                                                  "used": None if curr_client is None else curr_client.used,
-
-                                                  }
-                                                 )
-        client_list.clients.append(client_)
 
+def _to_int(value) -> int:
+    # из netlink приходят числа, из текста dump - строки, keepalive = off
+    if isinstance(value, int):
+        return value
+    return int(value) if value.isdigit() else 0
+
+
+def build_peers(rows: Iterable[Sequence[str]],
+                clients: Dict[str, Client],
+                fields: Optional[Iterable[str]] = None) -> Iterator[PeerStatus]:
+    '''
+    Соединяем строки dump с клиентами по публичному ключу
+    :param clients: публичный ключ -> клиент из реестра
+    :param fields: какие поля заполнять, None - все
+    '''
+    fields = set(fields) if fields else set(PeerStatus.__slots__)
+    fields.add("pub_key")
+    peer_fields = [(numb, field, field in _INT_FIELDS) for numb, field in enumerate(PEER_FIELDS) if field in fields]
+    client_fields = [field for field in CLIENT_FIELDS if field in fields]
+    for row in rows:
+        values = {field: (_to_int(row[numb]) if is_int else row[numb]) for numb, field, is_int in peer_fields}
+        client = clients.get(row[0])
+        if client is not None:
+            for field in client_fields:
+                values[field] = getattr(client, field)
+        yield PeerStatus(**values)
+
+
+def status_records(loger: logging.Logger, wg_iface: str, wg0_file: str, registry=None,
+                   fields: Optional[Iterable[str]] = None, backend=None,
+                   raise_errors: bool = False) -> List[PeerStatus]:
+    '''
+    Статус клиентов интерфейса в виде легких записей
+    :param registry: ClientRegistry, без него клиенты берутся обходом папки clients
+    :param fields: проекция - какие поля нужны, например для автоочистки
+    :param backend: источник peers (см. wg_netlink), по умолчанию netlink с запасным `wg show dump`
+    :param raise_errors: ошибка чтения интерфейса - OSError, а не пустой список,
+        чтобы ее можно было отличить от интерфейса без peers
+    '''
+    backend = backend or get_backend(wg_iface, loger)
+    try:
+        rows = list(backend.peers())
+    except OSError as ex:
+        loger.error(f"Error reading {wg_iface} peers: {ex}")
+        if raise_errors:
+            raise
+        return []
+    if fields is None or set(fields) & set(CLIENT_FIELDS):
+        clients_cfgs = clients_scan() if registry is None else registry.list_clients()
+        clients = {client.pub_key: client for client in clients_cfgs.clients if client.pub_key}
+    else:
+        clients = {}
+    return list(build_peers(rows, clients, fields))
+
+
+def status(loger: logging.Logger, wg_iface: str, wg0_file: str, registry=None) -> ListStatisticClient:
+    '''
+    Статус клиентов интерфейса, аналогично `wg show dump`
+    :param registry: ClientRegistry, без него клиенты берутся обходом папки clients
+    '''
+    loger.info("Получаем статус клиентов")
+    records = status_records(loger, wg_iface, wg0_file, registry)
+    # данные уже проверены при разборе - собираем модели без валидации
+    client_list = ListStatisticClient.model_construct(
+        clients=[StatisticClient.model_construct(**record.to_dict()) for record in records])
     loger.info(f"Получено {len(client_list.clients)} клиентов")
-    return client_list
\ No newline at end of file
+    return client_list
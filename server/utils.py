@@ -1,10 +1,11 @@
 # fastapi_guard/utils.py
+import json
 import logging
 import os
 import pathlib
 import re
-from ipaddress import IPv4Address, ip_network
-from typing import Any, Optional, Union
+from ipaddress import ip_address, ip_network
+from typing import Any, List, Optional, Tuple, Union
 import subprocess
 import math
 import datetime
@@ -12,8 +13,12 @@ import datetime
 from fastapi import Request
 
 from server.models import SecurityConfig
+from server.handlers.body_inspector import BodyInspector
+from server.handlers.cidr_handler import access_list_manager
 from server.handlers.ipinfo_handler import IPInfoManager
 from server.handlers.sus_patterns import SusPatterns
+from server.wg_peers import PeerBatch
+from server.metrics import count_subprocess
 
 
 async def setup_custom_logging(log_file: str) -> logging.Logger:
@@ -190,26 +195,17 @@ async def is_ip_allowed(ip: str, config: SecurityConfig, ipinfo_db: Optional[IPI
             True if the IP is allowed, False otherwise.
     """
     try:
-        ip_addr = IPv4Address(ip)
+        ip_addr = ip_address(ip)
+        # lists are compiled once, see access_list_manager.load
+        whitelist, blacklist = access_list_manager.lists(config)
 
         # Blacklist
-        if config.blacklist:
-            for blocked in config.blacklist:
-                if "/" in blocked:  # CIDR
-                    if ip_addr in ip_network(blocked, strict=False):
-                        return False
-                elif ip == blocked:  # Direct match
-                    return False
+        if blacklist is not None and blacklist.match(ip_addr):
+            return False
 
         # Whitelist
-        if config.whitelist:
-            for allowed in config.whitelist:
-                if "/" in allowed:  # CIDR
-                    if ip_addr in ip_network(allowed, strict=False):
-                        return True
-                elif ip == allowed:  # Direct match
-                    return True
-            return False  # If whitelist exists but IP not in it
+        if whitelist is not None:
+            return whitelist.match(ip_addr)  # If whitelist exists but IP not in it
 
         # Blocked countries
         if config.blocked_countries and ipinfo_db:
@@ -230,7 +226,106 @@ async def is_ip_allowed(ip: str, config: SecurityConfig, ipinfo_db: Optional[IPI
         return True
 
 
-async def detect_penetration_attempt(request: Request) -> bool:
+def match_value(value: str) -> Optional[str]:
+    """
+    Scan one request value.
+
+    A JSON object is decoded once and its string
+    values are scanned; anything else is scanned as is.
+
+    Args:
+        value (str):
+            Query param, header, path or body.
+
+    Returns:
+        Optional[str]:
+            The suspicious pattern that matched, None otherwise.
+    """
+    if value.lstrip()[:1] == "{":
+        try:
+            data = json.loads(value)
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            for item in data.values():
+                if isinstance(item, str):
+                    rule = SusPatterns.match(item)
+                    if rule:
+                        return rule
+            return None
+    return SusPatterns.match(value)
+
+
+# headers that are not scanned for suspicious patterns
+PENETRATION_EXCLUDED_HEADERS = frozenset({
+    "host",
+    "user-agent",
+    "accept",
+    "accept-encoding",
+    "connection",
+    "origin",
+    "referer",
+    "sec-fetch-site",
+    "sec-fetch-mode",
+    "sec-fetch-dest",
+})
+
+
+async def find_penetration_attempt(
+    request: Request, body_inspector: Optional[BodyInspector] = None
+) -> Optional[Tuple[str, str, str]]:
+    """
+    Find the first suspicious value in the request.
+
+    Query params, path, headers and body are each
+    decoded at most once and scanned in a single pass
+    against all patterns (see SusPatterns.match).
+
+    Args:
+        request (Request):
+            The FastAPI request object to analyze.
+        body_inspector (Optional[BodyInspector]):
+            Streams the body with bounded memory; without
+            it the whole body is read into memory.
+
+    Returns:
+        Optional[Tuple[str, str, str]]:
+            (request part, value, matched pattern),
+            None if nothing suspicious was found.
+    """
+    for value in request.query_params.values():
+        rule = match_value(value)
+        if rule:
+            return "query param", value, rule
+
+    rule = match_value(request.url.path)
+    if rule:
+        return "path", request.url.path, rule
+
+    for key, value in request.headers.items():
+        if key.lower() not in PENETRATION_EXCLUDED_HEADERS:
+            rule = match_value(value)
+            if rule:
+                return "header", f"{key}={value}", rule
+
+    if body_inspector is not None:
+        found = await body_inspector.inspect_request(request)
+        if found:
+            return "body", found[0], found[1]
+        return None
+
+    try:
+        body = (await request.body()).decode()
+    except Exception:
+        body = ""
+    if body:
+        rule = match_value(body)
+        if rule:
+            return "body", body, rule
+    return None
+
+
+async def detect_penetration_attempt(request: Request, body_inspector: Optional[BodyInspector] = None) -> bool:
     """
     Detect potential penetration
     attempts in the request.
@@ -244,94 +339,23 @@ async def detect_penetration_attempt(request: Request) -> bool:
     Args:
         request (Request):
             The FastAPI request object to analyze.
+        body_inspector (Optional[BodyInspector]):
+            Streaming body inspection, see find_penetration_attempt.
 
     Returns:
         bool:
             True if a potential attack is
             detected, False otherwise.
     """
-
-    suspicious_patterns = await SusPatterns().get_all_compiled_patterns()
-
-    async def check_value(value: str) -> bool:
-        try:
-            import json
-
-            data = json.loads(value)
-            if isinstance(data, dict):
-                return any(
-                    pattern.search(str(v))
-                    for v in data.values()
-                    if isinstance(v, str)
-                    for pattern in suspicious_patterns
-                )
-        except json.JSONDecodeError:
-            return any(pattern.search(value) for pattern in suspicious_patterns)
+    found = await find_penetration_attempt(request, body_inspector)
+    if found is None:
         return False
-
-    # Query params
-    for value in request.query_params.values():
-        if await check_value(value):
-            message = "Potential attack detected from"
-            client_ip = "unknown"
-            if request.client:
-                client_ip = request.client.host
-            details = f"{client_ip}: {value}"
-            reason_message = "Suspicious pattern: query param"
-            logging.warning(f"{message} {details} - {reason_message}")
-            return True
-
-    # Path
-    if await check_value(request.url.path):
-        message = "Potential attack detected from"
-        client_ip = "unknown"
-        if request.client:
-            client_ip = request.client.host
-        details = f"{client_ip}: {request.url.path}"
-        reason_message = "Suspicious pattern: path"
-        logging.warning(f"{message} {details} - {reason_message}")
-        return True
-
-    # Headers
-    excluded_headers = {
-        "host",
-        "user-agent",
-        "accept",
-        "accept-encoding",
-        "connection",
-        "origin",
-        "referer",
-        "sec-fetch-site",
-        "sec-fetch-mode",
-        "sec-fetch-dest",
-    }
-    for key, value in request.headers.items():
-        if key.lower() not in excluded_headers and await check_value(value):
-            message = "Potential attack detected from"
-            client_ip = "unknown"
-            if request.client:
-                client_ip = request.client.host
-            details = f"{client_ip}: {key}={value}"
-            reason_message = "Suspicious pattern: header"
-            logging.warning(f"{message} {details} - {reason_message}")
-            return True
-
-    # Body
-    try:
-        body = (await request.body()).decode()
-        if await check_value(body):
-            message = "Potential attack detected from"
-            client_ip = "unknown"
-            if request.client:
-                client_ip = request.client.host
-            details = f"{client_ip}: {body}"
-            reason_message = "Suspicious pattern: body"
-            logging.warning(f"{message} {details} - {reason_message}")
-            return True
-    except Exception:
-        pass
-
-    return False
+    part, value, rule = found
+    client_ip = "unknown"
+    if request.client:
+        client_ip = request.client.host
+    logging.warning(f"Potential attack detected from {client_ip}: {value} - Suspicious pattern: {part}, rule {rule}")
+    return True
 
 def mess_window(mess, type_mess="error"):
     print("\n\n")
@@ -353,6 +377,7 @@ def get_file_source(file_name):
 
 def run_system_command(command: str) -> Optional[str]:
     """Выполняет системную команду и возвращает её вывод."""
+    count_subprocess(command)
     result = os.system(command)
     return result
 
@@ -361,6 +386,7 @@ def get_host_server_ip(file_name="/etc/wireguard/ip_host"):
     if pathlib.Path(file_name).exists():
         res = get_file_source(file_name)
     if not res:
+        count_subprocess(["curl"])
         res = str(subprocess.check_output(["curl", "https://checkip.amazonaws.com/"]))[2:-3]
     return res
 
@@ -380,30 +406,18 @@ def since1(date):
     return duration
 
 def get_ip_next_server_config(srv_cfg_file):
-    #srv_cfg_file = ServerConfig(wg0_file)
-    free_ip = None
-
-    srv_ip = IPv4Address(srv_cfg_file.get_serv_ip())
-    srv_network = srv_cfg_file.get_serv_network()
-    list_srv_ip_network = list(srv_network.hosts())
-
-    all_clients_ips = srv_cfg_file.get_all_clients_ips()
-    all_excluded_ips = set(all_clients_ips)
-    all_excluded_ips.add(srv_ip)
-
-    for excl_ip in all_excluded_ips:
-        try:
-            list_srv_ip_network.remove(excl_ip)
-        except Exception as ex:
-            logging.exception(f"при попытке удалить {excl_ip}: \n")
-
-    if len(list_srv_ip_network) == 0:
-        raise Exception("no free IPs")
-    else:
-        free_ip = list_srv_ip_network[0]
-    return free_ip
+    """
+    Выдаем следующий свободный IP из сети сервера.
+    Выдача строится по конфигу один раз и дальше живет в srv_cfg_file.
+    """
+    return srv_cfg_file.get_ip_allocator().allocate()
 
-def remove_client(client, logger:logging.Logger, srv_cfg_file):
+def remove_client(client, logger:logging.Logger, srv_cfg_file, peer_batch=None):
+    """
+    Удаляем клиента: папку с конфигом, Peer из конфига сервера и из интерфейса.
+    Если передан peer_batch, удаление из интерфейса только ставится в очередь,
+    применять его должен вызывающий через peer_batch.apply()
+    """
     logger.info(f"Удаляем конфиг клиента: \n{client}")
     pub_key = client.pub_key
     client_folder = os.path.join("/etc/wireguard/clients", client.name) if client.name else None
@@ -419,7 +433,47 @@ def remove_client(client, logger:logging.Logger, srv_cfg_file):
     # удаляем динамически в wireguard
     #wg set wg0 peer "K30I8eIxuBL3OA43Xl34x0Tc60wqyDBx4msVm8VLkAE=" remove
     #ip -4 route delete 10.101.1.2/32 dev wg0
-    run_system_command(f'wg set wg0 peer "{pub_key}" remove')
-    run_system_command(f'ip -4 route delete {client.allowed_ips} dev wg0')
+    if peer_batch is None:
+        single_batch = PeerBatch("wg0", logger=logger)
+        single_batch.remove(pub_key, client.allowed_ips)
+        single_batch.apply()
+    else:
+        peer_batch.remove(pub_key, client.allowed_ips)
+
 
 
+
+def _next_prefix(prefix: str) -> str:
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def ip_search_ranges(search: str) -> Optional[List[Tuple[str, str]]]:
+    """
+    Диапазоны строк ip_addr для поиска по индексу, без LIKE '%x%'.
+    Обычная строка ищется как префикс ('10.1.'), сеть IPv4 ('10.1.0.0/20') - как все
+    адреса сети: сеть делится на подсети по границе октета и каждая дает свой префикс.
+    :return: список (от, до) для условия ip_addr >= от AND ip_addr < до, None - без фильтра
+    """
+    search = search.strip()
+    if not search:
+        return None
+    if "/" not in search:
+        return [(search, _next_prefix(search))]
+    network = ip_network(search, strict=False)
+    if network.version != 4:
+        raise ValueError(f"{search}: поиск по индексу только для сетей IPv4")
+    if network.prefixlen == 0:
+        # вся адресная область - фильтр не нужен
+        return None
+    octets = -(-network.prefixlen // 8)
+    ranges = []
+    for subnet in network.subnets(new_prefix=octets * 8):
+        parts = str(subnet.network_address).split(".")[:octets]
+        if octets == 4:
+            # сам адрес и записи вида адрес/маска
+            address = ".".join(parts)
+            ranges.append((address, address + "\0"))
+            ranges.append((address + "/", address + "0"))
+        else:
+            prefix = ".".join(parts) + "."
+            ranges.append((prefix, _next_prefix(prefix)))
+    return ranges
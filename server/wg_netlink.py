@@ -0,0 +1,371 @@
+import base64
+import errno
+import logging
+import os
+import socket
+import struct
+import subprocess
+import sys
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence
+
+from server.metrics import count_subprocess
+
+# linux/netlink.h, linux/genetlink.h, linux/wireguard.h
+NETLINK_GENERIC = 16
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_DUMP = 0x300
+NLA_TYPE_MASK = 0x3fff
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+
+WG_GENL_NAME = b"wireguard"
+WG_GENL_VERSION = 1
+WG_CMD_GET_DEVICE = 0
+WGDEVICE_A_IFNAME = 2
+WGDEVICE_A_PEERS = 8
+WGPEER_A_PUBLIC_KEY = 1
+WGPEER_A_PRESHARED_KEY = 2
+WGPEER_A_ENDPOINT = 4
+WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL = 5
+WGPEER_A_LAST_HANDSHAKE_TIME = 6
+WGPEER_A_RX_BYTES = 7
+WGPEER_A_TX_BYTES = 8
+WGPEER_A_ALLOWEDIPS = 9
+WGALLOWEDIP_A_FAMILY = 1
+WGALLOWEDIP_A_IPADDR = 2
+WGALLOWEDIP_A_CIDR_MASK = 3
+
+_NLMSGHDR = struct.Struct("=IHHII")
+_GENLMSGHDR = struct.Struct("=BBH")
+_NLATTR = struct.Struct("=HH")
+_NLMSGERR = struct.Struct("=i")
+_U16 = struct.Struct("=H")
+_U64 = struct.Struct("=Q")
+_TIMESPEC = struct.Struct("=qq")
+_PORT = struct.Struct("!H")
+
+_EMPTY_KEY = bytes(32)
+_RECV_SIZE = 1 << 20
+
+# строка peer как в `wg show <iface> dump`:
+# (pub_key, preshared_key, endpoint, allowed_ips, latest_handshake, rx, tx, keepalive)
+PeerRow = Sequence
+
+
+def _align(length: int) -> int:
+    return (length + 3) & ~3
+
+
+def _nlattr(attr_type: int, payload: bytes) -> bytes:
+    length = _NLATTR.size + len(payload)
+    return _NLATTR.pack(length, attr_type) + payload + b"\0" * (_align(length) - length)
+
+
+def _iter_attrs(data, offset: int = 0, end: Optional[int] = None):
+    end = len(data) if end is None else end
+    while offset + _NLATTR.size <= end:
+        length, attr_type = _NLATTR.unpack_from(data, offset)
+        if length < _NLATTR.size:
+            break
+        yield attr_type & NLA_TYPE_MASK, data[offset + _NLATTR.size:offset + length]
+        offset += _align(length)
+
+
+def _iter_messages(data):
+    '''
+    Сообщения netlink из одного recv
+    :return: (тип, флаги, payload)
+    '''
+    offset = 0
+    while offset + _NLMSGHDR.size <= len(data):
+        length, msg_type, flags, _, _ = _NLMSGHDR.unpack_from(data, offset)
+        if length < _NLMSGHDR.size:
+            break
+        yield msg_type, flags, data[offset + _NLMSGHDR.size:offset + length]
+        offset += _align(length)
+
+
+def _check_error(msg_type: int, payload):
+    if msg_type in (NLMSG_ERROR, NLMSG_DONE) and len(payload) >= _NLMSGERR.size:
+        error, = _NLMSGERR.unpack_from(payload)
+        if error < 0:
+            raise OSError(-error, os.strerror(-error))
+
+
+def _genl_request(family: int, flags: int, cmd: int, version: int, attrs: bytes, seq: int) -> bytes:
+    body = _GENLMSGHDR.pack(cmd, version, 0) + attrs
+    return _NLMSGHDR.pack(_NLMSGHDR.size + len(body), family, flags, seq, 0) + body
+
+
+def format_endpoint(sockaddr) -> str:
+    '''
+    sockaddr_in / sockaddr_in6 в виде `ip:port` / `[ip]:port`
+    '''
+    family, = _U16.unpack_from(sockaddr)
+    port, = _PORT.unpack_from(sockaddr, 2)
+    if family == socket.AF_INET:
+        return f"{socket.inet_ntop(socket.AF_INET, bytes(sockaddr[4:8]))}:{port}"
+    if family == socket.AF_INET6:
+        return f"[{socket.inet_ntop(socket.AF_INET6, bytes(sockaddr[8:24]))}]:{port}"
+    return "(none)"
+
+
+def _parse_allowed_ip(data) -> Optional[str]:
+    family = address = cidr = None
+    for attr_type, payload in _iter_attrs(data):
+        if attr_type == WGALLOWEDIP_A_FAMILY:
+            family, = _U16.unpack_from(payload)
+        elif attr_type == WGALLOWEDIP_A_IPADDR:
+            address = bytes(payload)
+        elif attr_type == WGALLOWEDIP_A_CIDR_MASK:
+            cidr = payload[0]
+    if family not in (socket.AF_INET, socket.AF_INET6) or address is None or cidr is None:
+        return None
+    return f"{socket.inet_ntop(family, address)}/{cidr}"
+
+
+def _parse_peer(data) -> list:
+    '''
+    Вложенный атрибут peer -> [pub_key, preshared_key, endpoint, [allowed_ips], handshake, rx, tx, keepalive]
+    '''
+    peer = [None, "(none)", "(none)", [], 0, 0, 0, 0]
+    for attr_type, payload in _iter_attrs(data):
+        if attr_type == WGPEER_A_PUBLIC_KEY:
+            peer[0] = base64.b64encode(payload).decode()
+        elif attr_type == WGPEER_A_PRESHARED_KEY:
+            if bytes(payload) != _EMPTY_KEY:
+                peer[1] = base64.b64encode(payload).decode()
+        elif attr_type == WGPEER_A_ENDPOINT:
+            peer[2] = format_endpoint(payload)
+        elif attr_type == WGPEER_A_ALLOWEDIPS:
+            for _, allowed_ip in _iter_attrs(payload):
+                network = _parse_allowed_ip(allowed_ip)
+                if network:
+                    peer[3].append(network)
+        elif attr_type == WGPEER_A_LAST_HANDSHAKE_TIME:
+            peer[4], _ = _TIMESPEC.unpack_from(payload)
+        elif attr_type == WGPEER_A_RX_BYTES:
+            peer[5], = _U64.unpack_from(payload)
+        elif attr_type == WGPEER_A_TX_BYTES:
+            peer[6], = _U64.unpack_from(payload)
+        elif attr_type == WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL:
+            peer[7], = _U16.unpack_from(payload)
+    return peer
+
+
+def parse_device_message(payload) -> List[list]:
+    '''
+    Peers из одного сообщения ответа на WG_CMD_GET_DEVICE
+    '''
+    peers = []
+    for attr_type, data in _iter_attrs(payload, _GENLMSGHDR.size):
+        if attr_type == WGDEVICE_A_PEERS:
+            for _, peer in _iter_attrs(data):
+                peers.append(_parse_peer(peer))
+    return peers
+
+
+def _finish(peer: list) -> tuple:
+    peer[3] = ",".join(peer[3]) or "(none)"
+    return tuple(peer)
+
+
+def _netlink_socket() -> socket.socket:
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
+    sock.bind((0, 0))
+    return sock
+
+
+class NetlinkBackend:
+    '''
+    Peers интерфейса напрямую из ядра через generic netlink (семейство wireguard),
+    без запуска `sudo wg show <iface> dump`.
+
+    Ответ на WG_CMD_GET_DEVICE приходит multipart-дампом, peers отдаются по мере
+    разбора сообщений, поэтому чтение можно прервать на середине. Если allowed-ips
+    одного peer не поместились в сообщение, ядро продолжает его в следующем -
+    такие части склеиваются, как это делает `wg`.
+
+    socket_factory позволяет подставить network namespace или записанные ответы ядра для проверки.
+    '''
+
+    def __init__(self,
+                 ifname: str = "wg0",
+                 socket_factory: Optional[Callable[[], socket.socket]] = None,
+                 logger: Optional[logging.Logger] = None):
+        self.ifname = ifname
+        self.socket_factory = socket_factory or _netlink_socket
+        self.logger = logger or logging.getLogger(__name__)
+        self._family: Optional[int] = None
+
+    @staticmethod
+    def _recv_messages(sock: socket.socket):
+        while True:
+            for msg_type, flags, payload in _iter_messages(sock.recv(_RECV_SIZE)):
+                _check_error(msg_type, payload)
+                if msg_type == NLMSG_DONE:
+                    return
+                if msg_type == NLMSG_ERROR:
+                    # подтверждение без ошибки
+                    continue
+                yield msg_type, payload
+                if not flags & NLM_F_MULTI:
+                    return
+
+    def _resolve_family(self, sock: socket.socket) -> int:
+        seq = int.from_bytes(os.urandom(4), "little")
+        sock.send(_genl_request(GENL_ID_CTRL, NLM_F_REQUEST, CTRL_CMD_GETFAMILY, 1,
+                                _nlattr(CTRL_ATTR_FAMILY_NAME, WG_GENL_NAME + b"\0"), seq))
+        for msg_type, payload in self._recv_messages(sock):
+            for attr_type, data in _iter_attrs(payload, _GENLMSGHDR.size):
+                if attr_type == CTRL_ATTR_FAMILY_ID:
+                    family, = _U16.unpack_from(data)
+                    return family
+        raise OSError(errno.ENOENT, "семейство wireguard в netlink не найдено")
+
+    def peers(self) -> Iterator[PeerRow]:
+        sock = self.socket_factory()
+        try:
+            sock.settimeout(5)
+            if self._family is None:
+                self._family = self._resolve_family(sock)
+            seq = int.from_bytes(os.urandom(4), "little")
+            sock.send(_genl_request(self._family, NLM_F_REQUEST | NLM_F_DUMP, WG_CMD_GET_DEVICE, WG_GENL_VERSION,
+                                    _nlattr(WGDEVICE_A_IFNAME, self.ifname.encode() + b"\0"), seq))
+            pending = None
+            for _, payload in self._recv_messages(sock):
+                peers = parse_device_message(payload)
+                if pending is not None and peers and peers[0][0] == pending[0]:
+                    # продолжение peer из предыдущего сообщения
+                    pending[3].extend(peers.pop(0)[3])
+                for peer in peers:
+                    if pending is not None:
+                        yield _finish(pending)
+                    pending = peer
+            if pending is not None:
+                yield _finish(pending)
+        except OSError:
+            # модуль wireguard могли перезагрузить - id семейства определим заново
+            self._family = None
+            raise
+        finally:
+            sock.close()
+
+
+def iter_dump_text(lines: Iterable[str], logger: Optional[logging.Logger] = None) -> Iterator[PeerRow]:
+    '''
+    Разбираем текст `wg show <iface> dump` построчно.
+    Первая строка - сам интерфейс (4 поля), строки peer - 8 полей через табуляцию
+    '''
+    debug = logger is not None and logger.isEnabledFor(logging.DEBUG)
+    for line in lines:
+        line = line.rstrip("\n")
+        if debug:
+            logger.debug(line)
+        row = line.split("\t")
+        if len(row) < 8:
+            continue
+        yield row
+
+
+class SubprocessBackend:
+    '''
+    Peers через `sudo wg show <iface> dump`, если netlink недоступен
+    '''
+
+    def __init__(self, ifname: str = "wg0", logger: Optional[logging.Logger] = None):
+        self.ifname = ifname
+        self.logger = logger or logging.getLogger(__name__)
+
+    def peers(self) -> Iterator[PeerRow]:
+        count_subprocess(['sudo', 'wg', 'show'])
+        with subprocess.Popen(['sudo', 'wg', 'show', self.ifname, 'dump'], stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, text=True) as proc:
+            yield from iter_dump_text(proc.stdout, self.logger)
+            stderr = proc.stderr.read()
+        if proc.returncode != 0:
+            raise OSError(errno.EIO, f"wg show завершился с ошибкой: {stderr.strip()}")
+
+
+class ReplayBackend:
+    '''
+    Peers из записанного вывода `wg show <iface> dump` - для проверки без root и wireguard
+    '''
+
+    def __init__(self, dump_file: str, logger: Optional[logging.Logger] = None):
+        self.dump_file = dump_file
+        self.logger = logger or logging.getLogger(__name__)
+
+    def peers(self) -> Iterator[PeerRow]:
+        with open(self.dump_file) as f:
+            yield from iter_dump_text(f, self.logger)
+
+
+class AutoBackend:
+    '''
+    Netlink, а если он недоступен (нет прав, нет модуля) - `wg show dump`.
+    Неудачная попытка netlink запоминается, чтобы не повторять ее на каждом запросе
+    '''
+
+    def __init__(self, ifname: str = "wg0", logger: Optional[logging.Logger] = None):
+        self.netlink = NetlinkBackend(ifname, logger=logger)
+        self.fallback = SubprocessBackend(ifname, logger=logger)
+        self.logger = logger or logging.getLogger(__name__)
+        self._use_netlink = True
+
+    def peers(self) -> Iterator[PeerRow]:
+        if self._use_netlink:
+            rows = self.netlink.peers()
+            try:
+                # ошибка прав или отсутствие модуля видны до первой строки
+                first = next(rows, None)
+            except OSError as ex:
+                if ex.errno == errno.ENODEV:
+                    raise
+                self.logger.warning(f"netlink wireguard недоступен ({ex}), используем wg show dump")
+                self._use_netlink = False
+            else:
+                if first is not None:
+                    yield first
+                    yield from rows
+                return
+        yield from self.fallback.peers()
+
+
+_backends = {}
+
+
+def get_backend(ifname: str = "wg0", logger: Optional[logging.Logger] = None):
+    '''
+    Источник статуса peers для интерфейса.
+    WG_DUMP_REPLAY=<файл> подставляет записанный `wg show dump` вместо интерфейса
+    '''
+    replay_file = os.getenv("WG_DUMP_REPLAY")
+    if replay_file:
+        return ReplayBackend(replay_file, logger=logger)
+    if ifname not in _backends:
+        _backends[ifname] = AutoBackend(ifname, logger=logger)
+    return _backends[ifname]
+
+
+def format_dump(rows: Iterable[PeerRow]) -> Iterator[str]:
+    '''
+    Строки peer в формате `wg show <iface> dump`, например для записи файла для ReplayBackend
+    '''
+    for row in rows:
+        row = list(row)
+        if row[7] in (0, "0"):
+            row[7] = "off"
+        yield "\t".join(str(value) for value in row)
+
+
+if __name__ == "__main__":
+    # запись текущего состояния интерфейса для ReplayBackend:
+    # python -m server.wg_netlink wg0 > dump.txt
+    for text_row in format_dump(NetlinkBackend(sys.argv[1] if len(sys.argv) > 1 else "wg0").peers()):
+        print(text_row)
@@ -0,0 +1,126 @@
+import logging
+import re
+import subprocess
+from typing import Dict, List, Optional, Tuple
+
+from server.metrics import count_subprocess
+from server.netlink_routes import RouteManager
+
+# ip -batch пишет номер строки упавшей команды: "Command failed -:12"
+_IP_BATCH_FAILED = re.compile(r"Command failed [^:]*:(\d+)")
+
+
+class PeerBatch:
+    '''
+    Очередь изменений Peer в интерфейсе wireguard.
+
+    Добавления и удаления копятся и применяются в apply() одной командой
+    `wg set <iface> peer A allowed-ips ... peer B remove ...` (с разбиением на пачки
+    по chunk_size, чтобы не упереться в длину командной строки). Маршруты ставятся
+    через rtnetlink (RouteManager), а если netlink недоступен - одним `ip -batch`.
+    1000 клиентов - это несколько запусков процессов, а не 2000.
+
+    subnet - сеть интерфейса, в которую сворачиваются /32 маршруты клиентов.
+    '''
+
+    def __init__(self, wg_iface: str = "wg0", chunk_size: int = 500, subnet=None,
+                 logger: Optional[logging.Logger] = None):
+        self.wg_iface = wg_iface
+        self.chunk_size = chunk_size
+        self.subnet = subnet
+        self.logger = logger or logging.getLogger(__name__)
+        # pub_key -> (операция, allowed_ips). Последняя операция по ключу побеждает
+        self._ops: Dict[str, Tuple[str, Optional[str]]] = {}
+
+    def __len__(self):
+        return len(self._ops)
+
+    def add(self, pub_key: str, allowed_ips):
+        self._ops.pop(pub_key, None)
+        self._ops[pub_key] = ("add", str(allowed_ips))
+
+    def remove(self, pub_key: str, allowed_ips=None):
+        self._ops.pop(pub_key, None)
+        self._ops[pub_key] = ("remove", str(allowed_ips) if allowed_ips else None)
+
+    @staticmethod
+    def _peer_args(pub_key: str, op: str, allowed_ips: Optional[str]) -> List[str]:
+        if op == "add":
+            return ["peer", pub_key, "allowed-ips", allowed_ips]
+        return ["peer", pub_key, "remove"]
+
+    def _run(self, args: List[str], input_: Optional[str] = None) -> subprocess.CompletedProcess:
+        count_subprocess(args)
+        return subprocess.run(args, input=input_, capture_output=True, text=True)
+
+    def _apply_peers(self, ops: List[Tuple[str, str, Optional[str]]]) -> Dict[str, bool]:
+        result = {}
+        for start in range(0, len(ops), self.chunk_size):
+            chunk = ops[start:start + self.chunk_size]
+            args = ["wg", "set", self.wg_iface]
+            for pub_key, op, allowed_ips in chunk:
+                args += self._peer_args(pub_key, op, allowed_ips)
+            res = self._run(args)
+            if res.returncode == 0 or len(chunk) == 1:
+                result.update({pub_key: res.returncode == 0 for pub_key, _, _ in chunk})
+                if res.returncode != 0:
+                    self.logger.error(f"wg set peer {chunk[0][0]} {chunk[0][1]}: {res.stderr.strip()}")
+                continue
+            # wg set не сообщает на каком peer споткнулся - повторяем пачку по одному
+            self.logger.warning(f"wg set для {len(chunk)} peer закончился с ошибкой: {res.stderr.strip()}")
+            for pub_key, op, allowed_ips in chunk:
+                res = self._run(["wg", "set", self.wg_iface] + self._peer_args(pub_key, op, allowed_ips))
+                result[pub_key] = res.returncode == 0
+                if res.returncode != 0:
+                    self.logger.error(f"wg set peer {pub_key} {op}: {res.stderr.strip()}")
+        return result
+
+    def _route_networks(self, ops: List[Tuple[str, str, Optional[str]]]) -> List[Tuple[str, str]]:
+        networks = []
+        for pub_key, op, allowed_ips in ops:
+            if not allowed_ips or allowed_ips == "(none)":
+                continue
+            for network in allowed_ips.split(","):
+                networks.append((op, network.strip()))
+        return networks
+
+    def _apply_routes(self, ops: List[Tuple[str, str, Optional[str]]]):
+        networks = self._route_networks(ops)
+        if not networks:
+            return
+        try:
+            routes = RouteManager(self.wg_iface, collapse_into=self.subnet, logger=self.logger)
+            for op, network in networks:
+                if op == "add":
+                    routes.add(network)
+                else:
+                    routes.delete(network)
+            routes.apply()
+        except OSError as ex:
+            self.logger.warning(f"netlink недоступен ({ex}), маршруты ставим через ip -batch")
+            self._apply_routes_ip_batch(networks)
+
+    def _apply_routes_ip_batch(self, networks: List[Tuple[str, str]]):
+        commands = []
+        for op, network in networks:
+            action = "add" if op == "add" else "delete"
+            commands.append(f"route {action} {network} dev {self.wg_iface}")
+        res = self._run(["ip", "-4", "-force", "-batch", "-"], input_="\n".join(commands) + "\n")
+        if res.returncode != 0:
+            for line_numb in _IP_BATCH_FAILED.findall(res.stderr):
+                self.logger.warning(f"ip {commands[int(line_numb) - 1]} закончился с ошибкой")
+
+    def apply(self) -> Dict[str, bool]:
+        '''
+        Применяем накопленные изменения к интерфейсу
+        :return: pub_key -> удалось ли применить изменение Peer
+        '''
+        ops = [(pub_key, op, allowed_ips) for pub_key, (op, allowed_ips) in self._ops.items()]
+        self._ops.clear()
+        if not ops:
+            return {}
+        result = self._apply_peers(ops)
+        # маршрут ставим только тем, кого удалось добавить в интерфейс
+        self._apply_routes([row for row in ops if row[1] == "remove" or result.get(row[0])])
+        self.logger.info(f"Применено изменений peer: {sum(result.values())} из {len(ops)}")
+        return result